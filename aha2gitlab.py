@@ -1,24 +1,51 @@
+import os
 import json
-import requests
+import re
+import hashlib
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import gitlab
 from markdownify import markdownify
+from migration_http import make_session
+from migration_metrics import Metrics
+from migration_config import apply_settings, argument_parser, read_settings, script_defaults
 
 
 # URL for Aha! Instance.  XXXX should be set to your company
 AHA_URL = 'https://XXXX.aha.io/api/v1/'
 # Aha! API Token
 AHA_TOKEN = 'API TOKEN HERE'
-#Aha headers for calls.  Allows us to use the API key
+#Aha headers for calls, besides the AHA_TOKEN one
 AHA_HEADERS = {
-    "Authorization": "Bearer {}".format(AHA_TOKEN),
     'Content-Type': 'application/json',
     'Accept': 'application/json'
 }
 # Name of the project in Titan, used for filtering
 AHA_PROJECT = 'PROJECT'
 
-# Release to migrate.  This is the internal ID not the Release Name
-AHA_RELEASE = '1'
+# Releases to migrate.  These are the internal IDs not the Release Names.
+# Leave empty to migrate every release of AHA_PROJECT.
+AHA_RELEASES = ['1']
+
+# Sync mode, for running the script repeatedly. Only epics and features whose
+# updated_at changed since the last run are fetched, and only the fields that
+# changed are applied to their Gitlab epics. Every run records what it
+# migrated in AHA_SYNC_STATE_FILE, so a first full run can be followed by syncs.
+AHA_SYNC = False
+AHA_SYNC_STATE_FILE = "aha_sync_state.json"
+
+# Number of records requested per page from Aha! list endpoints (max 200)
+AHA_PAGE_SIZE = 100
+
+# Number of epics / features fetched from Aha! in parallel
+AHA_CONCURRENCY = 5
+
+# Requests per second sent to Aha!, which allows 20 per second and 300 per
+# minute. Throttled requests are sent again after the delay the server asks
+# for, and the rate adapts as for HTTP_RATE.
+AHA_RATE = 5
+AHA_MAX_RATE = 5
 
 #URL for your Gitlab Instance.  if you are using hosted, then it will just be gitlab.com
 GITLAB_URL = 'https://gitlab.com/'
@@ -31,6 +58,28 @@ GITLAB_TOKEN = 'PERSONAL TOKEN'
 # set this to false if JIRA / Gitlab is using self-signed certificate.
 VERIFY_SSL_CERTIFICATE = True
 
+# HTTP settings shared by all Aha! and Gitlab calls. Connections are kept alive
+# and pooled per server. None for AHA_CONCURRENCY + 2.
+HTTP_POOL_SIZE = None
+HTTP_RETRIES = 3  # transport level retries on connection errors and 5xx
+HTTP_TIMEOUT = 60  # seconds
+
+# Requests per second sent to Gitlab to start with. The rate then adapts:
+# it follows the RateLimit headers of the server, slows down on 429 and 503
+# responses (requests rejected with a 429 are sent again after Retry-After)
+# and speeds up again while the server keeps up, to at most HTTP_MAX_RATE
+# (None for no limit). Set HTTP_RATE to None to disable the limiter.
+HTTP_RATE = 30  # Gitlab.com allows 2000 API requests per minute
+HTTP_MAX_RATE = None
+
+# Run metrics: time per phase, requests and latency per endpoint, bytes
+# transferred and rate limit waits. Written every METRICS_INTERVAL seconds and
+# at the end of the run; set a file to None to skip it. The .prom file is in
+# the format of the node_exporter textfile collector.
+METRICS_JSON_FILE = "aha2gitlab_metrics.json"
+METRICS_PROM_FILE = "aha2gitlab_metrics.prom"
+METRICS_INTERVAL = 30  # seconds
+
 # Map of projects.  This is used for epic creation in Gitlab
 PROJECT_MAP = {
     'project': 10000
@@ -47,20 +96,87 @@ GL_AHA_LABELS = {
 # IMPORTANT !!!
 # make sure that user (in gitlab) has access to the project you are trying to
 # import into. Otherwise the API request will fail.
-#use the gitlab python module
+
+# The settings above are the defaults. A run can change any of them, from
+# config files (see migration_config.py) or the command line:
+#   python aha2gitlab.py --config aha.yaml --set AHA_SYNC=True
+DEFAULTS = script_defaults(globals())
+
+# Run metrics. Without configured files they are only kept in memory; run()
+# starts the ones of the run.
+metrics = Metrics('aha2gitlab')
+
+# The clients are created on first use, so importing the script makes no
+# network call. One pooled session per remote.
+clients = {}
+clients_lock = threading.Lock()
+
+def get_aha_session():
+    with clients_lock:
+        if 'aha' not in clients:
+            headers = {"Authorization": "Bearer {}".format(AHA_TOKEN)}
+            headers.update(AHA_HEADERS)
+            clients['aha'] = metrics.instrument(make_session(
+                headers=headers,
+                verify=VERIFY_SSL_CERTIFICATE,
+                pool_size=HTTP_POOL_SIZE or AHA_CONCURRENCY + 2,
+                retries=HTTP_RETRIES,
+                timeout=HTTP_TIMEOUT,
+                rate=AHA_RATE,
+                max_rate=AHA_MAX_RATE
+            ), 'aha')
+        return clients['aha']
+
 # connect to Gitlab
-gl = gitlab.Gitlab(GITLAB_URL,private_token=GITLAB_TOKEN)
-gl.auth()
+def get_gl():
+    with clients_lock:
+        if 'gl' not in clients:
+            gitlab_session = metrics.instrument(make_session(
+                verify=VERIFY_SSL_CERTIFICATE,
+                pool_size=HTTP_POOL_SIZE or AHA_CONCURRENCY + 2,
+                retries=HTTP_RETRIES,
+                timeout=HTTP_TIMEOUT,
+                rate=HTTP_RATE,
+                max_rate=HTTP_MAX_RATE
+            ), 'gitlab')
+            gl = gitlab.Gitlab(GITLAB_URL,private_token=GITLAB_TOKEN,ssl_verify=VERIFY_SSL_CERTIFICATE,session=gitlab_session)
+            gl.auth()
+            clients['gl'] = gl
+        return clients['gl']
+
+# Epics are loaded once (every page) and indexed by title and by the Aha!
+# reference found in the resource link at the end of their description, so
+# lookups cost no API calls. New epics are added to the index as they are created.
+def aha_reference_pattern():
+    return re.compile(re.escape(AHA_URL) + r'(?:epics|features)/([^/\s]+)\s*$')
 
+AHA_REFERENCE_PATTERN = aha_reference_pattern()
+gl_group = None
+epic_index = None
+
+def get_epic_index():
+    global gl_group, epic_index
+    if epic_index is None:
+        gl_group = get_gl().groups.get(PROJECT_MAP['project']) #get group info for project parent
+        epic_index = {'title': {}, 'reference': {}}
+        with metrics.phase('epic_index'):
+            for epic in gl_group.epics.list(all=True):
+                index_epic(epic)
+    return epic_index
+
+def index_epic(epic):
+    epic_index['title'].setdefault(epic.title, epic)
+    match = AHA_REFERENCE_PATTERN.search(epic.description or '')
+    if match:
+        epic_index['reference'].setdefault(match.group(1), epic)
 
 # Get epic or create one if it doesn't exist
-def get_epic_id(epic_title,epic_description,extralabel,parent_id):
-    group = gl.groups.get(PROJECT_MAP['project']) #get group info for project parent
-    epics = group.epics.list() #get all the epics
-    # existing_epic = False
-    for epic in epics:
-        if epic.title == epic_title:
-            return epic
+def get_epic_id(epic_title,epic_description,extralabel,parent_id,reference=None):
+    index = get_epic_index()
+    if reference in index['reference']:
+        return index['reference'][reference]
+    if epic_title in index['title']:
+        return index['title'][epic_title]
     # Epic doesn't exist, so let's create it
     nl = DEFAULT_LABELS.copy()
     nl.append(extralabel)
@@ -71,39 +187,186 @@ def get_epic_id(epic_title,epic_description,extralabel,parent_id):
     }
     if parent_id:
         newepic['parent_id']=parent_id
-    new_epic = group.epics.create(newepic)
+    with metrics.phase('epic_create'):
+        new_epic = gl_group.epics.create(newepic)
+    metrics.count('epics_created')
+    index_epic(new_epic)
 
     return new_epic
 
 
-# Get all of the epics for this release
+# What the last runs migrated, by Aha! reference: the updated_at reported by
+# Aha!, the migrated fields (the description as a hash) and the Gitlab epic
+def load_sync_state():
+    try:
+        with open(AHA_SYNC_STATE_FILE, 'r') as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return {}
+
+def save_sync_state():
+    with open(AHA_SYNC_STATE_FILE + '.tmp', 'w') as state_file:
+        json.dump(sync_state, state_file)
+    os.replace(AHA_SYNC_STATE_FILE + '.tmp', AHA_SYNC_STATE_FILE)
+
+sync_state = {}
+
+# In sync mode, an item Aha! reports with the same updated_at as last time is skipped
+def is_unchanged(reference, updated_at):
+    known = sync_state.get(reference)
+    return AHA_SYNC and known is not None and updated_at is not None and known['updated_at'] == updated_at
+
+# Create the Gitlab epic for an Aha! epic or feature. In sync mode an epic that
+# was migrated before only gets the fields that changed since then, and
+# markdownify only runs when the description did. Returns the Gitlab epic id.
+def sync_epic(item, extralabel, parent_id):
+    reference = item['reference_num']
+    fields = {
+        'title': item['name'],
+        'description': hashlib.sha256(item['description']['body'].encode('utf-8')).hexdigest(),
+        'parent_id': parent_id or None
+    }
+    known = sync_state.get(reference)
+    if AHA_SYNC and known:
+        changed = [name for name in fields if known['fields'].get(name) != fields[name]]
+        if changed:
+            get_epic_index()
+            epic = gl_group.epics.get(known['epic_iid'], lazy=True)
+            if 'title' in changed:
+                epic.title = item['name']
+            if 'description' in changed:
+                with metrics.phase('convert'):
+                    epic.description = markdownify(item['description']['body']) + "\n\n{}\n".format(item['resource'])
+            if 'parent_id' in changed:
+                epic.parent_id = fields['parent_id']
+            with metrics.phase('epic_update'):
+                epic.save()
+            metrics.count('epics_updated')
+            print("Updated {} ({})".format(reference, ', '.join(changed)))
+        else:
+            metrics.count('items_unchanged')
+        epic_id, epic_iid = known['epic_id'], known['epic_iid']
+    else:
+        with metrics.phase('convert'):
+            description = markdownify(item['description']['body']) + "\n\n{}\n".format(item['resource'])
+        epic = get_epic_id(item['name'],description,extralabel,parent_id,reference)
+        epic_id, epic_iid = epic.id, epic.iid
+    sync_state[reference] = {
+        'updated_at': item.get('updated_at'),
+        'fields': fields,
+        'epic_id': epic_id,
+        'epic_iid': epic_iid
+    }
+    return epic_id
+
+
 # Aha API documentation : https://www.aha.io/api
-aha_release_epics = requests.get(
-    AHA_URL + 'releases/{}-R-{}/epics'.format(AHA_PROJECT,AHA_RELEASE),
-    headers=AHA_HEADERS,
-).json()['epics']
-
-# release_epic is the epics associated with a release in Aha
-for release_epic in aha_release_epics:
-    #now that we have a list of epics, get specific info about each one
-    print("Processing Epic {}".format(release_epic['reference_num']))
-    aha_specific_epics = requests.get(
-        AHA_URL + 'epics/{}'.format(release_epic['reference_num']),
-        headers=AHA_HEADERS,
-    ).json()['epic']
-
-    epic_milestone = aha_specific_epics['release']['name']
-    epic_description = markdownify(aha_specific_epics['description']['body']) + "\n\n{}\n".format(aha_specific_epics['resource'])
-    epic_name = aha_specific_epics['name']
-    gitlabepic = get_epic_id(epic_name,epic_description,GL_AHA_LABELS['epic'],False)
-    epic_parent_id = gitlabepic.id
-
-    for feature in aha_specific_epics['features']:
-        print(feature['name'])
-        aha_epic_features = requests.get(
-            feature['resource'],
-            headers=AHA_HEADERS
-        ).json()['feature']
-
-        feature_description = markdownify(aha_epic_features['description']['body']) + "\n\n{}\n".format(aha_epic_features['resource'])
-        gl_feature_epic_id = get_epic_id(aha_epic_features['name'],feature_description,GL_AHA_LABELS['feature'],epic_parent_id)
+
+# Yield every record of a paginated Aha! list endpoint
+def aha_list(path, key, params=None):
+    page = 1
+    while True:
+        query = dict(params or {})
+        query['page'] = page
+        query['per_page'] = AHA_PAGE_SIZE
+        response = get_aha_session().get(AHA_URL + path, params=query)
+        response.raise_for_status()
+        data = response.json()
+        for record in data[key]:
+            yield record
+        if page >= data.get('pagination', {}).get('total_pages', page):
+            return
+        page += 1
+
+# References of the releases to migrate
+def get_release_references():
+    if AHA_RELEASES:
+        return ['{}-R-{}'.format(AHA_PROJECT, release) for release in AHA_RELEASES]
+    return [release['reference_num'] for release in aha_list('products/{}/releases'.format(AHA_PROJECT), 'releases')]
+
+def get_aha_feature(resource):
+    with metrics.phase('aha_fetch'):
+        return get_aha_session().get(resource).json()['feature']
+
+# Fetch an epic and queue the fetches of all of its features right away.
+# In sync mode an unchanged epic isn't fetched; its features are listed with
+# their updated_at instead, and only the changed ones are fetched.
+# The epic is None when it was skipped.
+def fetch_aha_epic(release_epic, fetcher):
+    reference = release_epic['reference_num']
+    if is_unchanged(reference, release_epic.get('updated_at')):
+        epic = None
+        metrics.count('epics_skipped')
+        features = aha_list('epics/{}/features'.format(reference), 'features', {'fields': 'reference_num,updated_at,resource'})
+    else:
+        with metrics.phase('aha_fetch'):
+            epic = get_aha_session().get(AHA_URL + 'epics/{}'.format(reference)).json()['epic']
+        features = epic['features']
+    return reference, epic, [
+        fetcher.submit(get_aha_feature, feature['resource']) for feature in features
+        if not is_unchanged(feature['reference_num'], feature.get('updated_at'))
+    ]
+
+# Yield the epics of a release with their features, in release order. Every
+# epic and feature is fetched on the fetcher pool as soon as it is known, so
+# the downloads run ahead of the Gitlab side.
+def extract_release(release, fetcher):
+    epic_futures = [
+        fetcher.submit(fetch_aha_epic, release_epic, fetcher)
+        for release_epic in aha_list('releases/{}/epics'.format(release), 'epics', {'fields': 'reference_num,updated_at'})
+    ]
+    for epic_future in epic_futures:
+        reference, epic, feature_futures = epic_future.result()
+        yield reference, epic, (feature_future.result() for feature_future in feature_futures)
+
+# Apply a configuration: the defaults updated with settings, by name. The
+# clients and caches of the previous one are dropped, so one process can run
+# several configurations one after the other.
+def configure(settings=None):
+    global AHA_REFERENCE_PATTERN, gl_group, epic_index
+    apply_settings(globals(), DEFAULTS, settings or {})
+    AHA_REFERENCE_PATTERN = aha_reference_pattern()
+    gl_group = None
+    epic_index = None
+    clients.clear()
+    sync_state.clear()
+
+# Migrate the releases of the current configuration
+def run():
+    global metrics
+    metrics = Metrics('aha2gitlab', METRICS_JSON_FILE, METRICS_PROM_FILE, METRICS_INTERVAL).start()
+    # The sessions report to the metrics they were made with
+    with clients_lock:
+        clients.clear()
+    sync_state.clear()
+    sync_state.update(load_sync_state())
+    # Metrics are written on the way out, also when the run fails
+    try:
+        with ThreadPoolExecutor(max_workers=AHA_CONCURRENCY) as fetcher:
+            for release in get_release_references():
+                print("Processing Release {}".format(release))
+                # aha_specific_epics is an epic associated with the release in Aha
+                for reference, aha_specific_epics, aha_features in extract_release(release, fetcher):
+                    if aha_specific_epics is None:
+                        epic_parent_id = sync_state[reference]['epic_id']
+                    else:
+                        print("Processing Epic {}".format(reference))
+                        epic_milestone = aha_specific_epics['release']['name']
+                        epic_parent_id = sync_epic(aha_specific_epics,GL_AHA_LABELS['epic'],False)
+
+                    for aha_epic_features in aha_features:
+                        print(aha_epic_features['name'])
+                        gl_feature_epic_id = sync_epic(aha_epic_features,GL_AHA_LABELS['feature'],epic_parent_id)
+                save_sync_state()
+    finally:
+        metrics.stop()
+
+def main(argv=None):
+    parser = argument_parser('Migrate the releases of an Aha! product to Gitlab epics.')
+    args = parser.parse_args(argv)
+    configure(read_settings(args))
+    run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+import time
+
+import requests
+
+# Regression checks of the RateLimiter of migration_http, run as a script:
+#
+#   python benchmarks/check_rate_limiter.py
+#
+# Every check prints its result; the exit code is 1 if one failed.
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migration_http import RateLimiter  # noqa: E402
+
+
+def response(status=200, **headers):
+    reply = requests.Response()
+    reply.status_code = status
+    reply.headers.update(dict((name.replace('_', '-'), str(value)) for name, value in headers.items()))
+    return reply
+
+
+# The waits of threads acquiring a token at the same time
+def concurrent_waits(limiter, threads):
+    waits = []
+    lock = threading.Lock()
+
+    def acquire():
+        started = time.monotonic()
+        limiter.acquire()
+        with lock:
+            waits.append(time.monotonic() - started)
+
+    workers = [threading.Thread(target=acquire) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sorted(waits)
+
+
+# At the end of a window the server reports no request left: the requests
+# wait for the reset and then go out at the rate of before, instead of the
+# rate collapsing to min_rate (10s between requests)
+def check_window_used_up():
+    limiter = RateLimiter(50)
+    limiter.update(response(RateLimit_Remaining=0, RateLimit_Reset=time.time() + 1))
+    waits = concurrent_waits(limiter, 4)
+    return limiter.rate >= 50 and waits[-1] < 2.0, 'rate %.1f, waits %s' % (
+        limiter.rate, ', '.join('%.2fs' % wait for wait in waits))
+
+
+# The same with requests left for fewer processes than share the window
+def check_window_used_up_shared():
+    limiter = RateLimiter(50)
+    limiter.shares = 4
+    limiter.update(response(RateLimit_Remaining=3, RateLimit_Reset=time.time() + 1))
+    waits = concurrent_waits(limiter, 4)
+    return limiter.rate >= 50 and waits[-1] < 2.0, 'rate %.1f, waits %s' % (
+        limiter.rate, ', '.join('%.2fs' % wait for wait in waits))
+
+
+# Requests left in the window are spread over the rest of it
+def check_spread_over_window():
+    limiter = RateLimiter(50)
+    limiter.update(response(RateLimit_Remaining=100, RateLimit_Reset=time.time() + 10))
+    return 9 <= limiter.rate <= 11, 'rate %.1f' % limiter.rate
+
+
+# A 429 pauses for Retry-After and lowers the rate
+def check_throttled():
+    limiter = RateLimiter(50, jitter=0)
+    limiter.update(response(429, Retry_After=1))
+    waits = concurrent_waits(limiter, 2)
+    return limiter.rate == 25 and 0.9 <= waits[0] < 1.5, 'rate %.1f, waits %s' % (
+        limiter.rate, ', '.join('%.2fs' % wait for wait in waits))
+
+
+def main():
+    failed = 0
+    for check in (check_window_used_up, check_window_used_up_shared, check_spread_over_window, check_throttled):
+        ok, details = check()
+        failed += not ok
+        print('%-4s %s: %s' % ('ok' if ok else 'FAIL', check.__name__, details))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
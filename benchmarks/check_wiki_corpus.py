@@ -0,0 +1,61 @@
+import argparse
+import gzip
+import json
+import os
+import sys
+
+# Golden corpus of the Jira wiki markup conversion, run as a script:
+#
+#   python benchmarks/check_wiki_corpus.py
+#
+# wiki_corpus.jsonl.gz holds Jira markup and the Gitlab markdown the original
+# converter made of it (multiple_replace as one re.sub per rule, before the
+# stage pipeline). The markup is hand written cases for every rule, random
+# mixes of markup tokens, JiraDataset descriptions and comments, and short
+# versions of the lines that made the old patterns backtrack. Every entry is
+# converted again and compared; the exit code is 1 on a mismatch.
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import jira2gitlab  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wiki_corpus.jsonl.gz')
+
+# The settings the expected output was made with (issue links)
+SETTINGS = {
+    'JIRA_PROJECT': 'BENCH',
+    'JIRA_URL': 'https://jira.example.com/',
+    'METRICS_JSON_FILE': None,
+    'METRICS_PROM_FILE': None
+}
+
+
+def read_corpus(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as corpus:
+        for line in corpus:
+            yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the wiki markup conversion with the golden corpus.')
+    parser.add_argument('--corpus', default=CORPUS)
+    parser.add_argument('--show', type=int, default=5, help='mismatches to print')
+    args = parser.parse_args()
+
+    jira2gitlab.configure(SETTINGS)
+    checked = 0
+    mismatches = 0
+    for entry in read_corpus(args.corpus):
+        checked += 1
+        markdown = jira2gitlab.multiple_replace(entry['markup'], [])
+        if markdown != entry['markdown']:
+            mismatches += 1
+            if mismatches <= args.show:
+                print('MISMATCH for %r\n  expected %r\n  got      %r' % (entry['markup'], entry['markdown'], markdown))
+    print('%d entries, %d mismatches' % (checked, mismatches))
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
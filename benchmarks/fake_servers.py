@@ -0,0 +1,683 @@
+import json
+import random
+import re
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Local stand-ins for the Jira, Gitlab and Aha! APIs, so the migration scripts
+# can be run and timed end to end without live servers. Only the endpoints and
+# fields the scripts use are implemented.
+#
+# The Jira and Aha! data is generated from the record number when it is
+# requested: a dataset of any size costs no memory, and the same seed always
+# serves the same data. What the scripts create in Gitlab is kept in memory so
+# it can be read back.
+
+
+# Latency, errors and rate limits injected in front of every request
+class Faults(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_methods=('GET',), rate_limit=0, seed=0):
+        self.latency = latency  # seconds added to every response
+        self.jitter = jitter  # up to this many more seconds, at random
+        self.error_rate = error_rate  # share of requests answered with a 503
+        # Only these methods get errors. The scripts don't retry a POST that
+        # reached the server, so an error there ends the run.
+        self.error_methods = error_methods
+        self.rate_limit = rate_limit  # requests per second before 429s, 0 for no limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = 0
+        self.window_requests = 0
+
+    # Wait out the latency. Returns the status of an injected failure (or None)
+    # and the rate limit headers to send.
+    def apply(self, method):
+        with self.lock:
+            delay = self.latency + self.random.random() * self.jitter
+            error = method in self.error_methods and self.random.random() < self.error_rate
+            now = int(time.time())
+            if now != self.window:
+                self.window = now
+                self.window_requests = 0
+            self.window_requests += 1
+            remaining = self.rate_limit - self.window_requests
+        if delay:
+            time.sleep(delay)
+
+        headers = {}
+        if self.rate_limit:
+            headers['RateLimit-Limit'] = str(self.rate_limit)
+            headers['RateLimit-Remaining'] = str(max(remaining, 0))
+            headers['RateLimit-Reset'] = str(now + 1)
+            if remaining < 0:
+                headers['Retry-After'] = '1'
+                return 429, headers
+        if error:
+            return 503, headers
+        return None, headers
+
+
+def parse_body(headers, raw):
+    content_type = headers.get('Content-Type', '')
+    if content_type.startswith('application/json') and raw:
+        return json.loads(raw.decode('utf-8'))
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return dict((k, v[-1]) for k, v in parse_qs(raw.decode('utf-8')).items())
+    return {}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real servers
+
+    # Headers and body go out in separate writes; without this Nagle's
+    # algorithm holds the body back until the client's delayed ACK
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def serve(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        url = urlsplit(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query, keep_blank_values=True).items())
+
+        status, headers = fake.faults.apply(self.command)
+        if status:
+            name, payload = 'fault', {'message': self.responses[status][0]}
+        else:
+            name, result = fake.handle(self.command, url.path, query, parse_body(self.headers, raw))
+            status, payload = result[0], result[1]
+            if len(result) > 2:
+                headers.update(result[2])
+
+        if isinstance(payload, bytes):
+            body = payload
+            headers.setdefault('Content-Type', 'application/octet-stream')
+        else:
+            body = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        fake.record(name, status, len(raw), len(body))
+
+    do_GET = do_POST = do_PUT = do_DELETE = serve
+
+
+# A fake API served from a background thread. Subclasses list their routes as
+# (method, path regex, handler name); handlers get the path match, the query
+# parameters and the decoded body and return (status, payload[, headers]).
+class FakeServer(object):
+    routes = []
+
+    def __init__(self, faults=None, port=0):
+        self.faults = faults or Faults()
+        self.compiled = [(method, re.compile(pattern + '$'), name) for method, pattern, name in self.routes]
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), FakeHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, method, path, query, body):
+        for route_method, pattern, name in self.compiled:
+            if route_method != method:
+                continue
+            match = pattern.match(path)
+            if match:
+                return '%s %s' % (method, name), getattr(self, name)(match, query, body)
+        return 'unknown', (404, {'message': '404 Not Found'})
+
+    def record(self, name, status, bytes_in, bytes_out):
+        with self.lock:
+            self.requests[name] += 1
+            self.statuses[status] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def summary(self):
+        with self.lock:
+            return {
+                'requests': sum(self.requests.values()),
+                'endpoints': dict(self.requests),
+                'statuses': dict((str(status), count) for status, count in self.statuses.items()),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out
+            }
+
+
+class JiraServer(FakeServer):
+    routes = [
+        ('GET', r'/rest/api/2/search(/jql)?', 'search'),
+        ('GET', r'/rest/api/2/issue/([^/]+)/comment', 'get_comments'),
+        ('GET', r'/rest/api/2/issue/([^/]+)/?', 'get_issue'),
+        ('GET', r'/secure/attachment/(\d+)/[^/]+', 'get_attachment'),
+    ]
+    KEY_LIST = re.compile(r'\bkey\s+in\s*\(([^)]*)\)', re.IGNORECASE)
+    # The key ranges of sharded runs, e.g. "key>=BENCH-101 AND key<BENCH-201"
+    KEY_RANGE = re.compile(r'\bkey\s*(>=|<)\s*([\w]+-\d+)', re.IGNORECASE)
+    DESCENDING = re.compile(r'\border\s+by\s+\w+\s+desc\b', re.IGNORECASE)
+
+    def __init__(self, dataset, faults=None, port=0):
+        self.dataset = dataset
+        super(JiraServer, self).__init__(faults, port)
+
+    def lookup(self, key):
+        if key.startswith('EPIC-'):
+            return self.dataset.epic(key)
+        number = self.dataset.number(key)
+        if number is None:
+            return None
+        return self.dataset.issue(number, self.url)
+
+    # The issue numbers in a range of keys, in key order
+    def numbers(self, jql):
+        start, end = 0, self.dataset.size
+        for operator, key in self.KEY_RANGE.findall(jql):
+            number = int(key.rsplit('-', 1)[1]) - 1
+            if operator == '>=':
+                start = max(start, number)
+            else:
+                end = min(end, number)
+        numbers = range(start, max(start, end))
+        return numbers[::-1] if self.DESCENDING.search(jql) else numbers
+
+    # Either a "key in (...)" lookup or the dataset (or a key range of it),
+    # paged with startAt or, on the /jql endpoint, with nextPageToken
+    def search(self, match, query, body):
+        max_results = min(int(query.get('maxResults', 50)), 100)
+        jql = query.get('jql', '')
+        keys = self.KEY_LIST.search(jql)
+        if keys:
+            issues = [self.lookup(key.strip()) for key in keys.group(1).split(',')]
+            if None in issues:
+                return 400, {'errorMessages': ['An issue with key does not exist']}
+            return 200, {'startAt': 0, 'maxResults': max_results, 'total': len(issues), 'issues': issues}
+
+        numbers = self.numbers(jql)
+        token_paging = bool(match.group(1))
+        start_at = int(query.get('nextPageToken' if token_paging else 'startAt') or 0)
+        end = min(start_at + max_results, len(numbers))
+        page = {'issues': [self.dataset.issue(number, self.url) for number in numbers[start_at:end]]}
+        if token_paging:
+            page['isLast'] = end >= len(numbers)
+            if not page['isLast']:
+                page['nextPageToken'] = str(end)
+        else:
+            page.update({'startAt': start_at, 'maxResults': max_results, 'total': len(numbers)})
+        return 200, page
+
+    def get_issue(self, match, query, body):
+        issue = self.lookup(match.group(1))
+        if issue is None:
+            return 404, {'errorMessages': ['Issue does not exist']}
+        return 200, issue
+
+    # Comments are looked up by issue id
+    def get_comments(self, match, query, body):
+        number = int(match.group(1)) - 10000 if match.group(1).isdigit() else self.dataset.number(match.group(1))
+        if number is None or not 0 <= number < self.dataset.size:
+            return 404, {'errorMessages': ['Issue does not exist']}
+        start_at = int(query.get('startAt', 0))
+        max_results = int(query.get('maxResults', 50))
+        comments = self.dataset.comments_page(number, start_at, max_results)
+        return 200, {
+            'startAt': start_at,
+            'maxResults': max_results,
+            'total': self.dataset.comment_count(number),
+            'comments': comments
+        }
+
+    def get_attachment(self, match, query, body):
+        seed = int(match.group(1)) % 251
+        block = bytes(bytearray((seed + i) % 256 for i in range(1024)))
+        size = self.dataset.attachment_size
+        return 200, (block * (size // 1024 + 1))[:size]
+
+
+# Gitlab groups, projects, issues, notes, epics and uploads. Every project and
+# group asked for exists; projects belong to group_id.
+class GitlabServer(FakeServer):
+    routes = [
+        ('GET', r'/api/v4/user', 'get_user'),
+        ('GET', r'/api/v4/groups/(\d+)/members(?:/all)?', 'list_members'),
+        ('GET', r'/api/v4/groups/(\d+)', 'get_group'),
+        ('GET', r'/api/v4/groups/(\d+)/epics', 'list_epics'),
+        ('POST', r'/api/v4/groups/(\d+)/epics', 'create_epic'),
+        ('GET', r'/api/v4/groups/(\d+)/epics/(\d+)', 'get_epic'),
+        ('PUT', r'/api/v4/groups/(\d+)/epics/(\d+)', 'update_epic'),
+        ('POST', r'/api/v4/groups/(\d+)/epics/(\d+)/issues/?(\d+)?', 'link_epic_issue'),
+        ('GET', r'/api/v4/projects/(\d+)', 'get_project'),
+        ('POST', r'/api/v4/projects/(\d+)/uploads', 'upload'),
+        ('POST', r'/api/v4/projects/(\d+)/issues', 'create_issue'),
+        ('GET', r'/api/v4/projects/(\d+)/issues/(\d+)', 'get_issue'),
+        ('PUT', r'/api/v4/projects/(\d+)/issues/(\d+)', 'update_issue'),
+        ('POST', r'/api/v4/projects/(\d+)/issues/(\d+)/notes', 'create_note'),
+        ('GET', r'/api/v4/projects/(\d+)/milestones', 'list_milestones'),
+        ('POST', r'/api/v4/projects/(\d+)/milestones', 'create_milestone'),
+        ('GET', r'/api/v4/projects/(\d+)/iterations', 'list_iterations'),
+        ('POST', r'/api/graphql', 'graphql'),
+    ]
+
+    # The mutations of a GraphQL document, as (alias, field, variable)
+    GRAPHQL_FIELD = re.compile(r'(\w+): (\w+)\(input: \$(\w+)\)')
+
+    def __init__(self, faults=None, port=0, users=50, group_id=1000, iterations=10):
+        self.users = users
+        self.group_id = group_id
+        self.data_lock = threading.Lock()
+        self.ids = Counter()
+        self.issues = {}
+        self.epics = {}
+        self.milestones = {}
+        # Iterations of the group, 'Sprint 1' and up; they can't be created
+        self.iterations = [{'id': 500 + number, 'title': 'Sprint %d' % number, 'group_id': group_id}
+                           for number in range(1, iterations + 1)]
+        self.notes = Counter()
+        super(GitlabServer, self).__init__(faults, port)
+
+    def next_id(self, kind):
+        self.ids[kind] += 1
+        return self.ids[kind]
+
+    # Standard Gitlab pagination headers, followed by python-gitlab's all=True
+    def paginate(self, records, query, path):
+        page = int(query.get('page', 1))
+        per_page = int(query.get('per_page', 20))
+        headers = {'X-Page': str(page), 'X-Per-Page': str(per_page), 'X-Total': str(len(records))}
+        if page * per_page < len(records):
+            headers['X-Next-Page'] = str(page + 1)
+            headers['Link'] = '<%s%s?page=%d&per_page=%d>; rel="next"' % (self.url, path, page + 1, per_page)
+        return 200, records[(page - 1) * per_page:page * per_page], headers
+
+    def get_user(self, match, query, body):
+        return 200, {'id': 1, 'username': 'root', 'name': 'Administrator'}
+
+    def list_members(self, match, query, body):
+        members = [
+            {'id': 100 + number, 'username': 'user%d' % number, 'name': 'User %d' % number, 'state': 'active'}
+            for number in range(self.users)
+        ]
+        return self.paginate(members, query, match.group(0))
+
+    def get_group(self, match, query, body):
+        return 200, {'id': int(match.group(1)), 'name': 'group %s' % match.group(1), 'full_path': 'group-%s' % match.group(1)}
+
+    def list_epics(self, match, query, body):
+        with self.data_lock:
+            epics = list(self.epics.get(int(match.group(1)), {}).values())
+        return self.paginate(epics, query, match.group(0))
+
+    def create_epic(self, match, query, body):
+        group_id = int(match.group(1))
+        with self.data_lock:
+            epics = self.epics.setdefault(group_id, {})
+            epic = {
+                'id': self.next_id('epic'),
+                'iid': len(epics) + 1,
+                'group_id': group_id,
+                'title': body.get('title'),
+                'description': body.get('description'),
+                'labels': body.get('labels') or [],
+                'parent_id': body.get('parent_id'),
+                'state': 'opened'
+            }
+            epics[epic['iid']] = epic
+        return 201, epic
+
+    def get_epic(self, match, query, body):
+        with self.data_lock:
+            epic = self.epics.get(int(match.group(1)), {}).get(int(match.group(2)))
+        if epic is None:
+            return 404, {'message': '404 Not found'}
+        return 200, epic
+
+    def update_epic(self, match, query, body):
+        with self.data_lock:
+            epic = self.epics.get(int(match.group(1)), {}).get(int(match.group(2)))
+            if epic is None:
+                return 404, {'message': '404 Not found'}
+            epic.update(dict((k, v) for k, v in body.items() if k in epic))
+        return 200, epic
+
+    def link_epic_issue(self, match, query, body):
+        return 201, {'id': self.next_id('epic_issue'), 'issue_id': match.group(3) or body.get('issue_id')}
+
+    def get_project(self, match, query, body):
+        project_id = int(match.group(1))
+        return 200, {
+            'id': project_id,
+            'name': 'project %d' % project_id,
+            'path_with_namespace': 'group-%d/project-%d' % (self.group_id, project_id),
+            'namespace': {'id': self.group_id + project_id, 'kind': 'group', 'parent_id': self.group_id}
+        }
+
+    def upload(self, match, query, body):
+        with self.data_lock:
+            upload_id = self.next_id('upload')
+        url = '/uploads/%032x/file' % upload_id
+        return 201, {'alt': 'file', 'url': url, 'markdown': '![file](%s)' % url}
+
+    def create_issue(self, match, query, body):
+        project_id = int(match.group(1))
+        labels = body.get('labels') or []
+        if not isinstance(labels, list):
+            labels = [label.strip() for label in labels.split(',') if label.strip()]
+        with self.data_lock:
+            issue = {
+                'id': self.next_id('issue'),
+                'iid': self.next_id(('iid', project_id)),
+                'project_id': project_id,
+                'title': body.get('title'),
+                'description': body.get('description'),
+                'labels': labels,
+                'weight': body.get('weight'),
+                'milestone': self.milestone(project_id, body.get('milestone_id')),
+                'iteration': None,
+                'state': 'opened'
+            }
+            self.issues[(project_id, issue['iid'])] = issue
+        return 201, issue
+
+    def get_issue(self, match, query, body):
+        with self.data_lock:
+            issue = self.issues.get((int(match.group(1)), int(match.group(2))))
+        if issue is None:
+            return 404, {'message': '404 Not found'}
+        return 200, issue
+
+    def update_issue(self, match, query, body):
+        with self.data_lock:
+            issue = self.issues.get((int(match.group(1)), int(match.group(2))))
+            if issue is None:
+                return 404, {'message': '404 Not found'}
+            for field in ('title', 'description', 'weight'):
+                if field in body:
+                    issue[field] = body[field]
+            for label in (body.get('add_labels') or '').split(','):
+                if label.strip() and label.strip() not in issue['labels']:
+                    issue['labels'].append(label.strip())
+            for label in (body.get('remove_labels') or '').split(','):
+                if label.strip() in issue['labels']:
+                    issue['labels'].remove(label.strip())
+            if body.get('state_event') == 'close':
+                issue['state'] = 'closed'
+            elif body.get('state_event') == 'reopen':
+                issue['state'] = 'opened'
+        return 200, issue
+
+    def create_note(self, match, query, body):
+        with self.data_lock:
+            self.notes[(int(match.group(1)), int(match.group(2)))] += 1
+            note_id = self.next_id('note')
+        return 201, {'id': note_id, 'body': body.get('body'), 'noteable_iid': int(match.group(2))}
+
+    def milestone(self, project_id, milestone_id):
+        for milestone in self.milestones.get(project_id, {}).values():
+            if milestone['id'] == milestone_id:
+                return milestone
+        return None
+
+    def list_milestones(self, match, query, body):
+        with self.data_lock:
+            milestones = list(self.milestones.get(int(match.group(1)), {}).values())
+        return self.paginate(milestones, query, match.group(0))
+
+    # Titles are unique per project
+    def create_milestone(self, match, query, body):
+        project_id = int(match.group(1))
+        with self.data_lock:
+            milestones = self.milestones.setdefault(project_id, {})
+            if body.get('title') in milestones:
+                return 400, {'message': 'Milestone title already being used'}
+            milestone = {
+                'id': self.next_id('milestone'),
+                'iid': len(milestones) + 1,
+                'project_id': project_id,
+                'title': body.get('title'),
+                'state': 'active'
+            }
+            milestones[milestone['title']] = milestone
+        return 201, milestone
+
+    def list_iterations(self, match, query, body):
+        return self.paginate(self.iterations, query, match.group(0))
+
+    # The mutations the scripts batch: createNote, epicAddIssue,
+    # issueSetIteration and updateIssue (state events only), run in
+    # document order
+    def graphql(self, match, query, body):
+        fields = self.GRAPHQL_FIELD.findall(body.get('query', ''))
+        # Like Gitlab, validate the whole document before running any of it
+        for alias, field, variable in fields:
+            if getattr(self, 'graphql_%s' % field, None) is None:
+                return 200, {'errors': [{'message': "Field '%s' doesn't exist on type 'Mutation'" % field}]}
+        data = {}
+        for alias, field, variable in fields:
+            data[alias] = getattr(self, 'graphql_%s' % field)(body.get('variables', {}).get(variable) or {})
+        return 200, {'data': data}
+
+    def graphql_issue(self, project_path, iid):
+        project_id = int(project_path.rsplit('-', 1)[1])
+        return self.issues.get((project_id, int(iid)))
+
+    def graphql_createNote(self, values):
+        issue_id = int(values['noteableId'].rsplit('/', 1)[1])
+        with self.data_lock:
+            issue = next((issue for issue in self.issues.values() if issue['id'] == issue_id), None)
+            if issue is None:
+                return {'note': None, 'errors': ['Noteable not found']}
+            self.notes[(issue['project_id'], issue['iid'])] += 1
+            note_id = self.next_id('note')
+        return {'note': {'id': 'gid://gitlab/Note/%d' % note_id}, 'errors': []}
+
+    def graphql_epicAddIssue(self, values):
+        with self.data_lock:
+            issue = self.graphql_issue(values['projectPath'], values['issueIid'])
+            epic_issue_id = self.next_id('epic_issue')
+        if issue is None:
+            return {'epicIssue': None, 'errors': ['Issue not found']}
+        return {'epicIssue': {'id': 'gid://gitlab/EpicIssue/%d' % epic_issue_id}, 'errors': []}
+
+    def graphql_issueSetIteration(self, values):
+        iteration_id = int(values['iterationId'].rsplit('/', 1)[1])
+        iteration = next((iteration for iteration in self.iterations if iteration['id'] == iteration_id), None)
+        with self.data_lock:
+            issue = self.graphql_issue(values['projectPath'], values['iid'])
+            if issue is None or iteration is None:
+                return {'issue': None, 'errors': ['Issue or iteration not found']}
+            issue['iteration'] = iteration
+        return {'issue': {'id': 'gid://gitlab/Issue/%d' % issue['id']}, 'errors': []}
+
+    def graphql_updateIssue(self, values):
+        with self.data_lock:
+            issue = self.graphql_issue(values['projectPath'], values['iid'])
+            if issue is None:
+                return {'issue': None, 'errors': ['Issue not found']}
+            if values.get('stateEvent') == 'CLOSE':
+                issue['state'] = 'closed'
+            elif values.get('stateEvent') == 'REOPEN':
+                issue['state'] = 'opened'
+        return {'issue': {'id': 'gid://gitlab/Issue/%d' % issue['id']}, 'errors': []}
+
+    def summary(self):
+        result = super(GitlabServer, self).summary()
+        with self.data_lock:
+            result['created'] = {
+                'issues': len(self.issues),
+                'notes': sum(self.notes.values()),
+                'epics': sum(len(epics) for epics in self.epics.values()),
+                'uploads': self.ids['upload']
+            }
+        return result
+
+
+# Aha! features numbered 0 to size - 1, features_per_epic to an epic and
+# epics_per_release to a release
+class AhaDataset(object):
+    def __init__(self, size, product='BENCH', seed=0, features_per_epic=10, epics_per_release=20,
+                 updated_at='2020-01-01T00:00:00Z'):
+        self.size = size
+        self.product = product
+        self.seed = seed
+        self.features_per_epic = features_per_epic
+        self.epics_per_release = epics_per_release
+        self.updated_at = updated_at
+
+    @property
+    def epic_count(self):
+        return (self.size + self.features_per_epic - 1) // self.features_per_epic
+
+    @property
+    def release_count(self):
+        return (self.epic_count + self.epics_per_release - 1) // self.epics_per_release
+
+    def release_ref(self, number):
+        return '%s-R-%d' % (self.product, number + 1)
+
+    def epic_ref(self, number):
+        return '%s-E-%d' % (self.product, number + 1)
+
+    def feature_ref(self, number):
+        return '%s-%d' % (self.product, number + 1)
+
+    def parse(self, reference, kind):
+        prefix = {'release': '%s-R-', 'epic': '%s-E-', 'feature': '%s-'}[kind] % self.product
+        rest = reference[len(prefix):]
+        if reference.startswith(prefix) and rest.isdigit():
+            return int(rest) - 1
+        return None
+
+    def release_epics(self, release):
+        first = release * self.epics_per_release
+        return range(first, min(first + self.epics_per_release, self.epic_count))
+
+    def epic_features(self, epic):
+        first = epic * self.features_per_epic
+        return range(first, min(first + self.features_per_epic, self.size))
+
+    def body(self, kind, number):
+        rng = random.Random(self.seed * 1000003 + number * 2 + (kind == 'epic'))
+        return (
+            '<p>The %s <b>%d</b> lets users %s.</p><ul><li>fast</li><li>safe</li></ul>'
+            '<p>See <a href="https://example.com/%d">the spec</a>.</p>'
+            % (kind, number + 1, rng.choice(['export reports', 'share boards', 'log in faster']), number + 1)
+        )
+
+    def summary(self, reference, resource):
+        return {'reference_num': reference, 'resource': resource, 'updated_at': self.updated_at}
+
+    def feature(self, number, base_url):
+        reference = self.feature_ref(number)
+        return {
+            'reference_num': reference,
+            'name': 'Feature %d' % (number + 1),
+            'description': {'body': self.body('feature', number)},
+            'resource': '%s/api/v1/features/%s' % (base_url, reference),
+            'updated_at': self.updated_at
+        }
+
+    def epic(self, number, base_url):
+        reference = self.epic_ref(number)
+        release = number // self.epics_per_release
+        return {
+            'reference_num': reference,
+            'name': 'Epic %d' % (number + 1),
+            'description': {'body': self.body('epic', number)},
+            'resource': '%s/api/v1/epics/%s' % (base_url, reference),
+            'updated_at': self.updated_at,
+            'release': {'reference_num': self.release_ref(release), 'name': 'Release %d' % (release + 1)},
+            'features': [
+                self.summary(self.feature_ref(feature), '%s/api/v1/features/%s' % (base_url, self.feature_ref(feature)))
+                for feature in self.epic_features(number)
+            ]
+        }
+
+
+class AhaServer(FakeServer):
+    routes = [
+        ('GET', r'/api/v1/products/([^/]+)/releases', 'list_releases'),
+        ('GET', r'/api/v1/releases/([^/]+)/epics', 'list_release_epics'),
+        ('GET', r'/api/v1/epics/([^/]+)/features', 'list_epic_features'),
+        ('GET', r'/api/v1/epics/([^/]+)', 'get_epic'),
+        ('GET', r'/api/v1/features/([^/]+)', 'get_feature'),
+    ]
+
+    def __init__(self, dataset, faults=None, port=0):
+        self.dataset = dataset
+        super(AhaServer, self).__init__(faults, port)
+
+    def paginate(self, key, records, query):
+        page = int(query.get('page', 1))
+        per_page = int(query.get('per_page', 30))
+        total_pages = max((len(records) + per_page - 1) // per_page, 1)
+        return 200, {
+            key: records[(page - 1) * per_page:page * per_page],
+            'pagination': {'total_records': len(records), 'total_pages': total_pages, 'current_page': page}
+        }
+
+    def list_releases(self, match, query, body):
+        releases = [
+            {'reference_num': self.dataset.release_ref(number), 'name': 'Release %d' % (number + 1)}
+            for number in range(self.dataset.release_count)
+        ]
+        return self.paginate('releases', releases, query)
+
+    def list_release_epics(self, match, query, body):
+        release = self.dataset.parse(match.group(1), 'release')
+        if release is None or release >= self.dataset.release_count:
+            return 404, {'error': 'Record not found'}
+        epics = [
+            self.dataset.summary(self.dataset.epic_ref(epic), '%s/api/v1/epics/%s' % (self.url, self.dataset.epic_ref(epic)))
+            for epic in self.dataset.release_epics(release)
+        ]
+        return self.paginate('epics', epics, query)
+
+    def list_epic_features(self, match, query, body):
+        epic = self.dataset.parse(match.group(1), 'epic')
+        if epic is None or epic >= self.dataset.epic_count:
+            return 404, {'error': 'Record not found'}
+        return self.paginate('features', self.dataset.epic(epic, self.url)['features'], query)
+
+    def get_epic(self, match, query, body):
+        epic = self.dataset.parse(match.group(1), 'epic')
+        if epic is None or epic >= self.dataset.epic_count:
+            return 404, {'error': 'Record not found'}
+        return 200, {'epic': self.dataset.epic(epic, self.url)}
+
+    def get_feature(self, match, query, body):
+        feature = self.dataset.parse(match.group(1), 'feature')
+        if feature is None or feature >= self.dataset.size:
+            return 404, {'error': 'Record not found'}
+        return 200, {'feature': self.dataset.feature(feature, self.url)}
@@ -0,0 +1,182 @@
+import random
+
+# Synthetic Jira issues, as the search API returns them, for the fake Jira
+# server and the transform benchmarks. An issue is generated from its number
+# and the seed when it is asked for: a dataset of any size costs no memory,
+# and the same settings always give the same issues.
+#
+# The defaults give short issues with a fixed description. The other settings
+# make them look more like a real project: longer descriptions and comments
+# with a given share of wiki markup, several attachments, components that no
+# project is mapped to.
+
+
+# Jira issues numbered 0 to size - 1, with keys <project>-1 and up.
+# comments is the average number of comments per issue, attachments the share
+# of issues with attachments (1 to max_attachments of them).
+class JiraDataset(object):
+    ISSUE_TYPES = ['Bug', 'Story', 'Task', 'Improvement']
+    COMPONENTS = ['UI', 'core']
+    STATUSES = [('To Do', 'new', 'To Do'), ('In Progress', 'indeterminate', 'In Progress'), ('Done', 'done', 'Done')]
+    STORY_POINTS = [None, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0]
+    WORDS = ['the', 'page', 'save', 'error', 'user', 'settings', 'request', 'timeout', 'build', 'release',
+             'cache', 'query', 'when', 'after', 'login', 'report', 'button', 'export', 'import', 'value']
+    # Inline wiki markup, around a word
+    INLINE_MARKUP = ['*%s*', '_%s_', '{{%s}}', '-%s-', '+%s+', '[%s|https://example.com/%s]',
+                     '{color:red}%s{color}', 'https://example.com/%s']
+    # Line level wiki markup
+    LINE_MARKUP = ['h3. %s', '* %s', '# %s', 'bq. %s', '** %s', '%s :)', '%s (/)']
+
+    def __init__(self, size, project='BENCH', seed=0, comments=3, attachments=0.2, attachment_size=64 * 1024,
+                 epics=50, users=50, embedded_comments=20, epic_field='customfield_10006',
+                 sprint_field='customfield_10005', points_field='customfield_10002',
+                 description_words=0, comment_words=0, markup=0.2, max_attachments=1,
+                 components=None, unmapped_components=0.0):
+        self.size = size
+        self.project = project
+        self.seed = seed
+        self.comments = comments
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.epics = epics
+        self.users = users
+        self.embedded_comments = embedded_comments
+        self.epic_field = epic_field
+        self.sprint_field = sprint_field
+        self.points_field = points_field
+        self.description_words = description_words  # generated words added to each description
+        self.comment_words = comment_words  # generated words added to each comment
+        self.markup = markup  # share of generated words and lines with wiki markup
+        self.max_attachments = max_attachments
+        self.components = components or self.COMPONENTS
+        self.unmapped_components = unmapped_components  # share of issues with a component not in COMPONENT_MAP
+
+    def random(self, number):
+        return random.Random(self.seed * 1000003 + number)
+
+    # A separate generator for the optional content, so the defaults keep
+    # giving the same issues
+    def extra_random(self, number, salt=0):
+        return random.Random((self.seed * 1000003 + number) * 7919 + salt + 1)
+
+    # Words of text, in lines of about 12 words, with markup on a share of
+    # the words and lines
+    def text(self, rng, words):
+        lines = []
+        while words > 0:
+            count = min(words, rng.randint(6, 18))
+            words -= count
+            line = []
+            for _ in range(count):
+                word = rng.choice(self.WORDS)
+                if rng.random() < self.markup:
+                    markup = rng.choice(self.INLINE_MARKUP)
+                    word = markup % ((word,) * markup.count('%s'))
+                line.append(word)
+            line = ' '.join(line)
+            if rng.random() < self.markup:
+                line = rng.choice(self.LINE_MARKUP) % line
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def user(self, number):
+        return {'displayName': 'User %d' % (number % self.users)}
+
+    def key(self, number):
+        return '%s-%d' % (self.project, number + 1)
+
+    def number(self, key):
+        prefix = self.project + '-'
+        if key.startswith(prefix) and key[len(prefix):].isdigit():
+            number = int(key[len(prefix):]) - 1
+            if 0 <= number < self.size:
+                return number
+        return None
+
+    def epic_key(self, number):
+        return 'EPIC-%d' % (number + 1)
+
+    def epic(self, key):
+        return {'key': key, 'fields': {'summary': 'Epic %s' % key[len('EPIC-'):]}}
+
+    def comment_count(self, number):
+        return self.random(number).randint(0, self.comments * 2)
+
+    def comment(self, number, index):
+        body = ('Comment %d on *%s*, see [the docs|https://example.com/docs] and %s.\n'
+                '{code}print("hello"){code}' % (index, self.key(number), self.key((number + index) % self.size)))
+        if self.comment_words:
+            body += '\n' + self.text(self.extra_random(number, index + 1), self.comment_words)
+        return {
+            'id': str(number * 1000 + index),
+            'author': self.user(number + index),
+            'body': body
+        }
+
+    def comments_page(self, number, start_at=0, max_results=None):
+        total = self.comment_count(number)
+        end = total if max_results is None else min(total, start_at + max_results)
+        return [self.comment(number, index) for index in range(start_at, end)]
+
+    # The first attachment of an issue has the id of the issue number
+    def attachment(self, number, base_url, index=0):
+        attachment_id = number + index * self.size
+        filename = 'screenshot-%d.png' % (attachment_id + 1)
+        return {
+            'id': str(attachment_id),
+            'filename': filename,
+            'content': '%s/secure/attachment/%d/%s' % (base_url, attachment_id, filename),
+            'size': self.attachment_size,
+            'author': self.user(number + index)
+        }
+
+    def issue(self, number, base_url):
+        rng = self.random(number)
+        extra = self.extra_random(number)
+        components = rng.sample(self.components, rng.randint(1, len(self.components)))
+        if self.unmapped_components and extra.random() < self.unmapped_components:
+            components.append('Legacy')
+        status = rng.choice(self.STATUSES)
+        attachments = []
+        if rng.random() < self.attachments:
+            count = extra.randint(1, self.max_attachments) if self.max_attachments > 1 else 1
+            attachments = [self.attachment(number, base_url, index) for index in range(count)]
+        description = (
+            'h2. Issue %(n)d\n\nSteps to reproduce:\n# open the *settings* page\n# click {{save}}\n'
+            '# see the [error|https://example.com/errors/%(n)d]\n\n{quote}It used to work :){quote}\n'
+            % {'n': number + 1}
+        )
+        if self.description_words:
+            description += '\n' + self.text(extra, self.description_words) + '\n'
+        for attachment in attachments:
+            description += '\n!%s|thumbnail!\n' % attachment['filename']
+        total = self.comment_count(number)
+        return {
+            'id': str(10000 + number),
+            'key': self.key(number),
+            'fields': {
+                'summary': 'Issue %d %s' % (number + 1, rng.choice(['crashes', 'is slow', 'needs docs'])),
+                'description': description,
+                'issuetype': {'name': rng.choice(self.ISSUE_TYPES)},
+                'components': [{'name': name} for name in components],
+                'assignee': self.user(number + 1) if rng.random() < 0.8 else None,
+                'reporter': self.user(number),
+                'status': {'name': status[0], 'statusCategory': {'key': status[1], 'name': status[2]}},
+                'created': '2020-01-01T00:00:00.000+0000',
+                'updated': '2020-01-02T00:00:00.000+0000',
+                self.epic_field: self.epic_key(rng.randrange(self.epics)) if self.epics and rng.random() < 0.5 else None,
+                self.sprint_field: [{'name': 'Sprint %d' % rng.randint(1, 20)}] if rng.random() < 0.5 else None,
+                self.points_field: rng.choice(self.STORY_POINTS),
+                'comment': {
+                    'comments': self.comments_page(number, 0, self.embedded_comments),
+                    'total': total,
+                    'maxResults': self.embedded_comments,
+                    'startAt': 0
+                },
+                'attachment': attachments
+            }
+        }
+
+    def issues(self, base_url='https://jira.example.com'):
+        for number in range(self.size):
+            yield self.issue(number, base_url)
@@ -0,0 +1,195 @@
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_servers import AhaDataset, AhaServer, Faults, GitlabServer, JiraServer
+from jira_dataset import JiraDataset
+
+# End to end throughput of the migration scripts against the fake servers.
+# Every run writes a config file pointing the script at the fake servers, runs
+# the script with it in a fresh process and working directory, and reports
+# issues per second, requests per issue and the peak RSS of the script's
+# process.
+#
+#   python benchmarks/throughput.py --script jira --sizes 1000,10000 --latency 0.02
+#   python benchmarks/throughput.py --script aha --sizes 1000 --rate-limit 20
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {
+    'jira': os.path.join(REPO, 'jira2gitlab.py'),
+    'aha': os.path.join(REPO, 'aha2gitlab.py')
+}
+
+
+# Run a script to completion. Returns its exit code, the wall time and its
+# peak RSS in MB, which wait4 reports for that one child.
+def run_script(path, config, workdir, log):
+    started = time.time()
+    process = subprocess.Popen([sys.executable, path, '--config', config], cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - started
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # kilobytes on Linux, bytes on macOS
+    peak_rss = usage.ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+    return process.returncode, elapsed, peak_rss
+
+
+def faults(args, seed):
+    return Faults(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        seed=seed
+    )
+
+
+# The fake servers of one run, the number of issues it migrates and the
+# settings pointing the script at the servers
+def jira_setup(args, size):
+    jira = JiraServer(
+        JiraDataset(size, seed=args.seed, comments=args.comments, attachments=args.attachments,
+                    attachment_size=args.attachment_size),
+        faults(args, args.seed)
+    )
+    gitlab = GitlabServer(faults(args, args.seed + 1))
+    overrides = {
+        'JIRA_URL': jira.url + '/',
+        'JIRA_ACCOUNT': ('bench', 'bench'),
+        'JIRA_PROJECT': 'BENCH',
+        'GITLAB_URL': gitlab.url + '/',
+        'GITLAB_TOKEN': 'bench',
+        'GITLAB_GROUP_USERS': 1,
+        'PROJECT_MAP': {'frontend': 1, 'backend': 2},
+        'MIGRATION_WORKERS': args.workers,
+        'HTTP_RATE': args.http_rate
+    }
+    return [jira, gitlab], size, overrides
+
+
+def aha_setup(args, size):
+    dataset = AhaDataset(size, seed=args.seed)
+    aha = AhaServer(dataset, faults(args, args.seed))
+    gitlab = GitlabServer(faults(args, args.seed + 1))
+    overrides = {
+        'AHA_URL': aha.url + '/api/v1/',
+        'AHA_TOKEN': 'bench',
+        'AHA_PROJECT': dataset.product,
+        'AHA_RELEASES': [],
+        'GITLAB_URL': gitlab.url + '/',
+        'GITLAB_TOKEN': 'bench',
+        'PROJECT_MAP': {'project': gitlab.group_id},
+        'AHA_CONCURRENCY': args.workers,
+        'AHA_RATE': args.http_rate,
+        'HTTP_RATE': args.http_rate
+    }
+    return [aha, gitlab], size + dataset.epic_count, overrides
+
+
+SETUPS = {'jira': jira_setup, 'aha': aha_setup}
+
+
+def benchmark(args, size):
+    servers, issues, overrides = SETUPS[args.script](args, size)
+    overrides.update(args.set)
+    workdir = tempfile.mkdtemp(prefix='bench-%s-%d-' % (args.script, size))
+    path = SCRIPTS[args.script]
+    config = os.path.join(workdir, 'config.json')
+    with open(config, 'w') as config_file:
+        json.dump(overrides, config_file, indent=2)
+
+    for server in servers:
+        server.start()
+    try:
+        with open(os.path.join(workdir, 'output.log'), 'w') as log:
+            code, elapsed, peak_rss = run_script(path, config, workdir, log)
+    finally:
+        for server in servers:
+            server.stop()
+
+    remotes = dict(zip([args.script, 'gitlab'], [server.summary() for server in servers]))
+    requests = sum(remote['requests'] for remote in remotes.values())
+    # The script's own metrics, for where the time went
+    try:
+        with open(os.path.join(workdir, '%s_metrics.json' % os.path.splitext(os.path.basename(path))[0])) as metrics:
+            phases = json.load(metrics)['phases']
+    except (IOError, ValueError, KeyError):
+        phases = {}
+    return {
+        'script': args.script,
+        'size': size,
+        'issues': issues,
+        'exit_code': code,
+        'seconds': round(elapsed, 3),
+        'issues_per_second': round(issues / elapsed, 2),
+        'requests': requests,
+        'requests_per_issue': round(requests / float(issues), 2),
+        'peak_rss_mb': round(peak_rss, 1),
+        'remotes': remotes,
+        'phases': phases,
+        'workdir': workdir
+    }
+
+
+def print_result(result):
+    if result['exit_code']:
+        print('%(script)s %(size)d: failed with exit code %(exit_code)d, see %(workdir)s/output.log' % result)
+        return
+    print(
+        '%(script)-4s %(size)7d issues: %(seconds)8.2fs %(issues_per_second)9.2f issues/s '
+        '%(requests_per_issue)6.2f requests/issue %(peak_rss_mb)7.1f MB peak RSS' % result
+    )
+    for name, remote in sorted(result['remotes'].items()):
+        statuses = ', '.join('%s: %d' % item for item in sorted(remote['statuses'].items()))
+        print('    %-6s %7d requests (%s)' % (name, remote['requests'], statuses))
+    for name, phase in sorted(result['phases'].items(), key=lambda item: -item[1]['seconds']):
+        print('    %-20s %9.2fs %7d calls' % (name, phase['seconds'], phase['calls']))
+
+
+def parse_setting(setting):
+    name, _, value = setting.partition('=')
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end throughput of the migration scripts against local fake servers.')
+    parser.add_argument('--script', choices=sorted(SCRIPTS), default='jira')
+    parser.add_argument('--sizes', default='1000', help='comma separated dataset sizes (Jira issues or Aha! features)')
+    parser.add_argument('--workers', type=int, default=4, help='MIGRATION_WORKERS / AHA_CONCURRENCY')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds, at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of GET requests answered with a 503')
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per second per server before 429s')
+    parser.add_argument('--http-rate', type=float, default=None,
+                        help="starting rate of the scripts' rate limiters, none by default")
+    parser.add_argument('--comments', type=int, default=3, help='average comments per Jira issue')
+    parser.add_argument('--attachments', type=float, default=0.2, help='share of Jira issues with an attachment')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024, help='bytes per attachment')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[], type=parse_setting, metavar='NAME=VALUE',
+                        help='override another setting of the script, e.g. --set HTTP_RETRIES=5')
+    parser.add_argument('--json', help='append the results to this file, one JSON object per line')
+    args = parser.parse_args()
+    args.set = dict(args.set)
+
+    failed = False
+    for size in [int(size) for size in args.sizes.split(',')]:
+        result = benchmark(args, size)
+        print_result(result)
+        failed = failed or bool(result['exit_code'])
+        if args.json:
+            with open(args.json, 'a') as results:
+                results.write(json.dumps(result) + '\n')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from jira_dataset import JiraDataset
+
+# Microbenchmarks of the pure Python part of jira2gitlab: the wiki markup
+# conversion (also of large and adversarial texts), user and label mapping and
+# the issue transform, over issues from JiraDataset. Nothing is sent anywhere; the Gitlab users and the Jira epic
+# names are filled in as if they had been loaded.
+#
+# Every case reports operations per second and the memory allocated by an
+# operation (the mean of its peak traced memory). With --history, results are
+# appended to a file, keyed by git commit, and compared with the last results
+# of another commit on the same dataset: a case slower or allocating more than
+# --threshold is flagged, and the exit code is 1.
+#
+#   python benchmarks/transform.py --issues 500 --description-words 300
+#   python benchmarks/transform.py --history transform_history.jsonl
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import jira2gitlab  # noqa: E402
+
+JIRA_URL = 'https://jira.example.com/'
+
+
+# Point jira2gitlab at the dataset, with its users and epics already known
+def setup(dataset):
+    jira2gitlab.configure({
+        'JIRA_URL': JIRA_URL,
+        'JIRA_PROJECT': dataset.project,
+        'PROJECT_MAP': {'frontend': 1, 'backend': 2},
+        'GITLAB_USER_NAMES': dict(('User %d' % number, 'user%d' % number) for number in range(0, dataset.users, 5)),
+        'METRICS_JSON_FILE': None,
+        'METRICS_PROM_FILE': None
+    })
+    users = [{'id': 100 + number, 'username': 'user%d' % number, 'name': 'User %d' % number}
+             for number in range(dataset.users)]
+    jira2gitlab.users.update({
+        'username': dict((user['username'], user) for user in users),
+        'name': dict((user['name'], user) for user in users),
+        'id': dict((user['id'], user) for user in users)
+    })
+    for number in range(dataset.epics):
+        epic = dataset.epic(dataset.epic_key(number))
+        jira2gitlab.epic_summaries[epic['key']] = epic['fields']['summary']
+
+
+# The replacements move_attachements makes for the attachments of an issue
+def attachment_replacements(issue):
+    return [
+        (re.compile("!%s[^!]*!" % re.escape(attachment['filename'])),
+         "![%s](/uploads/%032x/%s)" % (attachment['filename'], int(attachment['id']), attachment['filename']))
+        for attachment in issue['fields']['attachment']
+    ]
+
+
+# Texts the old per-rule patterns backtracked on: a large description with
+# mixed markup, and long lines of unclosed text effects and links
+def large_texts(dataset):
+    return [
+        ('large description', dataset.text(random.Random(dataset.seed), 30000)),
+        ('*w line', '*w ' * 7000),
+        ('[a|b line', '[a|b ' * 4000),
+        ('{color} line', '{color:red}x ' * 2000),
+    ]
+
+
+# (name, function, items): the function is called on every item in turn
+def cases(dataset):
+    issues = list(dataset.issues(JIRA_URL.rstrip('/')))
+    mapped = [issue for issue in issues if issue['fields']['issuetype']['name'] in jira2gitlab.ISSUE_TYPES_MAP]
+    comments = [(comment, attachment_replacements(issue))
+                for issue in issues for comment in issue['fields']['comment']['comments']]
+    transformed = [(issue, jira2gitlab.transform_issue(issue, [])) for issue in mapped]
+    logins = [issue['fields']['reporter']['displayName'] for issue in issues] + ['Former Employee']
+    project_ids = list(jira2gitlab.PROJECT_MAP.values())
+
+    def issue_data(item):
+        issue, result = item
+        for project_id in result['project_ids']:
+            jira2gitlab.issue_data(issue, result, project_id, attachment_replacements(issue))
+
+    return [
+        ('multiple_replace description',
+         lambda issue: jira2gitlab.multiple_replace(issue['fields']['description'], attachment_replacements(issue)),
+         issues),
+        ('multiple_replace comment', lambda item: jira2gitlab.multiple_replace(item[0]['body'], item[1]), comments),
+    ] + [
+        ('multiple_replace %s' % name, lambda text: jira2gitlab.multiple_replace(text, []), [text])
+        for name, text in large_texts(dataset)
+    ] + [
+        ('comment_body', lambda item: jira2gitlab.comment_body(item[0], item[1]), comments),
+        ('resolve_login', jira2gitlab.resolve_login, logins),
+        ('get_project_labels', jira2gitlab.get_project_labels, project_ids),
+        ('issue_project_ids', lambda issue: jira2gitlab.issue_project_ids(issue, []), mapped),
+        ('issue_labels', jira2gitlab.issue_labels, mapped),
+        ('transform_issue', lambda issue: jira2gitlab.transform_issue(issue, []), issues),
+        ('issue_data', issue_data, transformed),
+    ]
+
+
+# Operations per second, the best of repeat rounds of at least seconds /
+# repeat each (the slower rounds are the ones something else got in the way
+# of), then the allocations of one pass over the items
+def measure(function, items, seconds, repeat=5):
+    operations = 0
+    best = 0.0
+    for _ in range(repeat):
+        round_operations = 0
+        started = time.perf_counter()
+        while True:
+            for item in items:
+                function(item)
+            round_operations += len(items)
+            elapsed = time.perf_counter() - started
+            if elapsed >= seconds / repeat:
+                break
+        operations += round_operations
+        best = max(best, round_operations / elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        peaks = 0
+        for item in items:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            function(item)
+            peaks += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return {
+        'operations': operations,
+        'ops_per_second': round(best, 1),
+        'bytes_per_op': round(peaks / float(len(items)), 1)
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def load_history(path):
+    try:
+        with open(path, 'r') as history:
+            return [json.loads(line) for line in history if line.strip()]
+    except IOError:
+        return []
+
+
+# The last result of the case on the same dataset and Python from another
+# commit, or from the baseline commit
+def find_baseline(history, result, baseline=None):
+    for entry in reversed(history):
+        if entry['case'] != result['case'] or entry['dataset'] != result['dataset'] or entry['python'] != result['python']:
+            continue
+        if baseline and entry['commit'] == baseline:
+            return entry
+        if not baseline and entry['commit'] != result['commit']:
+            return entry
+    return None
+
+
+def compare(result, base, threshold):
+    speed = result['ops_per_second'] / base['ops_per_second'] - 1 if base['ops_per_second'] else 0.0
+    memory = result['bytes_per_op'] / base['bytes_per_op'] - 1 if base['bytes_per_op'] else 0.0
+    flags = []
+    if speed < -threshold:
+        flags.append('SLOWER')
+    if memory > threshold:
+        flags.append('MORE MEMORY')
+    return speed, memory, flags
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the jira2gitlab transform layer.')
+    parser.add_argument('--issues', type=int, default=500, help='issues in the dataset')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--comments', type=int, default=3, help='average comments per issue')
+    parser.add_argument('--description-words', type=int, default=200, help='generated words per description')
+    parser.add_argument('--comment-words', type=int, default=40, help='generated words per comment')
+    parser.add_argument('--markup', type=float, default=0.2, help='share of words and lines with wiki markup')
+    parser.add_argument('--attachments', type=float, default=0.3, help='share of issues with attachments')
+    parser.add_argument('--max-attachments', type=int, default=3, help='attachments per issue, at most')
+    parser.add_argument('--unmapped-components', type=float, default=0.1,
+                        help='share of issues with a component no project is mapped to')
+    parser.add_argument('--seconds', type=float, default=1.0, help='minimum time per case')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds per case, the best one counts')
+    parser.add_argument('--cases', help='only the cases whose name contains this')
+    parser.add_argument('--history', help='append the results to this file and compare them with another commit')
+    parser.add_argument('--baseline', help='commit to compare with, by default the last other one in --history')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative change flagged as a regression')
+    args = parser.parse_args()
+
+    settings = {
+        'issues': args.issues,
+        'seed': args.seed,
+        'comments': args.comments,
+        'description_words': args.description_words,
+        'comment_words': args.comment_words,
+        'markup': args.markup,
+        'attachments': args.attachments,
+        'max_attachments': args.max_attachments,
+        'unmapped_components': args.unmapped_components
+    }
+    dataset = JiraDataset(
+        args.issues, seed=args.seed, comments=args.comments, embedded_comments=args.comments * 2,
+        description_words=args.description_words, comment_words=args.comment_words, markup=args.markup,
+        attachments=args.attachments, max_attachments=args.max_attachments,
+        unmapped_components=args.unmapped_components
+    )
+    setup(dataset)
+
+    commit = git_commit()
+    history = load_history(args.history) if args.history else []
+    regressions = 0
+    print('%-36s %14s %14s   %s' % ('case', 'ops/s', 'bytes/op', 'commit %s' % commit))
+    for name, function, items in cases(dataset):
+        if args.cases and args.cases not in name:
+            continue
+        result = {
+            'case': name,
+            'commit': commit,
+            'time': time.time(),
+            'python': platform.python_version(),
+            'dataset': settings
+        }
+        result.update(measure(function, items, args.seconds, args.repeat))
+
+        line = '%-36s %14.1f %14.1f' % (name, result['ops_per_second'], result['bytes_per_op'])
+        base = find_baseline(history, result, args.baseline)
+        if base:
+            speed, memory, flags = compare(result, base, args.threshold)
+            line += '   %+6.1f%% speed %+6.1f%% memory vs %s %s' % (speed * 100, memory * 100, base['commit'], ' '.join(flags))
+            regressions += bool(flags)
+        print(line)
+
+        if args.history:
+            with open(args.history, 'a') as output:
+                output.write(json.dumps(result) + '\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
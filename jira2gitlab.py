@@ -1,11 +1,30 @@
-import requests
 from requests.auth import HTTPBasicAuth
+from requests.exceptions import HTTPError
 import re
 from io import StringIO
-from io import BytesIO
+import os
+import time
+import tempfile
+import hashlib
 import uuid
 import json
+import sys
+import socket
+import sqlite3
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+import threading
+from functools import partial
 import gitlab
+from migration_http import make_session
+from migration_state import MigrationState
+from migration_ledger import ShardLedger
+from migration_metrics import Metrics
+from migration_export import ProjectExport
+from migration_snapshot import SnapshotWriter, read_header, read_snapshot
+from migration_graphql import GraphQLClient, Mutation, global_id, object_id
+from migration_config import apply_settings, argument_parser, read_settings, script_defaults
 
 # Inspired from https://gist.github.com/toudi/67d775066334dc024c24
 # Tested on Jira Cloud and Gitlab 13.8 (Hosted) with Python 3.8.5
@@ -13,9 +32,21 @@ JIRA_URL = 'https://XXX.atlassian.net/'
 JIRA_ACCOUNT = ('jira_account', 'jira_password')
 # the JIRA project ID (short)
 JIRA_PROJECT = 'xxx'
-# Jira Query
+# Jira Query. None for the unresolved issues and open sprints of JIRA_PROJECT,
+# oldest first.
 #JQL = 'key=PRO-1182'
-JQL = 'project=%s+AND+(resolution=Unresolved+OR+Sprint+in+openSprints())+ORDER+BY+createdDate+ASC&maxResults=10000' % JIRA_PROJECT
+JQL = None
+
+# Jira search endpoint. Jira Cloud users can switch to 'rest/api/2/search/jql',
+# which pages with nextPageToken instead of startAt.
+JIRA_SEARCH_API = 'rest/api/2/search'
+
+# Number of issues requested per search page. Jira Cloud caps this at 100.
+JIRA_PAGE_SIZE = 100
+
+# Fields requested by the search. Comments and attachments are included so
+# that migrating an issue doesn't need another request to Jira.
+JIRA_SEARCH_FIELDS = '*navigable,comment,attachment'
 
 GITLAB_URL = 'https://gitlab.com/'
 
@@ -27,10 +58,8 @@ GITLAB_ACCOUNT = ('gitlab_account', 'gitlab_password')
 # this identity will be used instead.
 GITLAB_TOKEN = 'gitlab personal token'
 
-# Gitlab headers to pass when making API call
-GITLAB_HEADERS = {
-    'PRIVATE-TOKEN': GITLAB_TOKEN
-}
+# Gitlab headers to pass when making API call, besides the GITLAB_TOKEN one
+GITLAB_HEADERS = {}
 
 # If you are runninig Gitlab on-premise set to True.  Hosted Gitlab has not sudo option
 GITLAB_SUDO = False
@@ -43,19 +72,39 @@ GITLAB_SUDO = False
 #If you use either milestones or iterations set that here.
 # Options here are either milestones or iterations
 # Note this is used in the API call so make sure it is lower case and plural
-# Note: The API doesn't support creating iterations yet
-# Note: Not fully implemented..
+# The last Jira sprint of an issue is matched by title. Missing milestones are
+# created; the API doesn't support creating iterations, so they have to exist
+# (in the project or a parent group). Iterations are set through GraphQL.
+# None to leave the sprint out.
 GITLAB_SPRINT_TYPE = 'iterations'
 
 # ID of the group that contains your users.  In our case we have an everyone group
 GITLAB_GROUP_USERS = 12345678
 
+# The members of GITLAB_GROUP_USERS are cached in this file so that re-runs
+# don't have to list them again. Set USER_CACHE_TTL to 0 to always reload.
+USER_CACHE_FILE = "gitlab_users.json"
+USER_CACHE_TTL = 24 * 60 * 60  # seconds
+
+# The notes, epic link and close of an issue are sent as GraphQL mutations,
+# up to GRAPHQL_BATCH_SIZE in one request, instead of one REST call each. A
+# mutation Gitlab refuses is made through REST instead. GraphQL can't act as
+# another user, so with GITLAB_SUDO the REST API is used.
+GITLAB_GRAPHQL = True
+GRAPHQL_BATCH_SIZE = 20
+
 # Add a comment with the JIRA Sprint name to the new GL issue
 ADD_SPRINT_COMMENT = True
 
 # set this to false if JIRA / Gitlab is using self-signed certificate.
 VERIFY_SSL_CERTIFICATE = True
 
+# Attachments are streamed from Jira to Gitlab in chunks of this size (bytes).
+# Each one is downloaded once into a temporary file that stays in memory up to
+# ATTACHMENT_SPOOL_SIZE bytes and is moved to disk above that.
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_SPOOL_SIZE = 8 * 1024 * 1024
+
 # Add a comment with the link to the Jira issue
 ADD_A_LINK = True
 
@@ -69,10 +118,114 @@ JIRA_SPRINT_FIELD = 'customfield_10005'
 JIRA_STORY_POINTS_FIELD = 'customfield_10002'
 
 # Used for progress tracking, so we don't reprocess the same issues in the event
-# of a script failure or re-run
+# of a script failure or re-run. Every step of an issue (created, each comment,
+# epic link, close) is checkpointed, so a half migrated issue is resumed where
+# it stopped instead of being created again.
 ISSUE_TRACKING = True  # set to False to disable
+TRACKING_DB = "migration_state.db"
+# Issues listed in this file by older versions of the script are treated as migrated
 TRACKING_FILE = "migrated_issues.txt"
 
+# Attachments already uploaded to a project are remembered here, by Jira
+# attachment id and by content hash, so re-runs and duplicate files skip the
+# download and/or the upload.
+ATTACHMENT_CACHE = True  # set to False to disable
+ATTACHMENT_CACHE_FILE = "uploaded_attachments.txt"
+
+# Delta sync: instead of migrating JQL, search the issues updated in Jira since
+# the last run and bring the Gitlab issues they were migrated to up to date.
+# Only what changed is sent: new comments, labels, weight, open/closed, title
+# and description. Issues that weren't migrated yet are migrated. Needs
+# ISSUE_TRACKING, the watermark is kept in TRACKING_DB. Every run sets it, so
+# the first delta sync starts where the migration ended. Issues only listed in
+# TRACKING_FILE have no checkpoints to update them through and are left alone.
+DELTA_SYNC = False
+# Issues to keep in sync, without ORDER BY. None for all of JIRA_PROJECT.
+DELTA_JQL = None
+# Minutes searched before the watermark, to cover clock skew with Jira
+DELTA_SYNC_MARGIN = 5
+
+# Where the issues go:
+#  'api'    - created one by one through the Gitlab API
+#  'export' - written to a Gitlab project export archive per target project,
+#             EXPORT_DIR/<PROJECT_MAP name>.tar.gz, with notes, labels,
+#             milestones (the Jira sprint) and attachments. Each archive is
+#             imported once as a new project (Import project > Gitlab export),
+#             so no API call is made per issue. Epics aren't part of project
+#             exports, the issues keep the epic name as a label.
+OUTPUT_BACKEND = 'api'
+EXPORT_DIR = "gitlab_export"
+
+# The migration can run in two stages, so Jira is read once and the loading
+# can be repeated (or tuned) without calling Jira again:
+#  'all'     - read Jira and load Gitlab in one run
+#  'extract' - only read Jira: the issues of the JQL with all their comments
+#              and the summaries of their epics go to SNAPSHOT_FILE (gzipped
+#              ndjson), the attachments to SNAPSHOT_ATTACHMENT_DIR. Gitlab
+#              isn't contacted.
+#  'load'    - only load Gitlab, from the snapshot. Attachments are uploaded
+#              from the snapshot files (downloaded from Jira if they weren't
+#              saved).
+PIPELINE_STAGE = 'all'
+SNAPSHOT_FILE = "jira_snapshot.ndjson.gz"
+# Save the attachments with the snapshot, under their sha256
+SNAPSHOT_ATTACHMENTS = True
+SNAPSHOT_ATTACHMENT_DIR = "jira_snapshot_attachments"
+
+# Sharded runs spread the migration over several processes, on one or more
+# machines. The JQL is split once into disjoint shards, which the workers
+# claim from SHARD_LEDGER, an SQLite file on a volume they all mount:
+#
+#   python jira2gitlab.py --config migration.yaml --shards plan    # once
+#   python jira2gitlab.py --config migration.yaml --shards work    # on every machine
+#   python jira2gitlab.py --config migration.yaml --shards status  # progress of all workers
+#
+# The shards of a worker that sent no heartbeat for SHARD_LEASE seconds go to
+# the other workers. Put TRACKING_DB, USER_CACHE_FILE and ATTACHMENT_CACHE_FILE
+# on the shared volume too, so such a shard picks up at the checkpoints of the
+# dead worker. The workers split the request budget Jira and Gitlab announce
+# in their RateLimit headers; HTTP_RATE and HTTP_MAX_RATE are per worker.
+# Sharded runs need OUTPUT_BACKEND = 'api' and PIPELINE_STAGE = 'all'.
+SHARD_ROLE = None  # 'plan', 'work' or 'status'; None for a run in one process
+SHARD_LEDGER = "migration_ledger.db"
+# How the JQL is split:
+#  'key'       - SHARD_COUNT ranges of issue keys (of a single Jira project)
+#  'created'   - SHARD_COUNT ranges of creation dates
+#  'component' - one shard per COMPONENT_MAP component, and one for the rest
+SHARD_BY = 'key'
+SHARD_COUNT = 16
+SHARD_LEASE = 300  # seconds
+SHARD_HEARTBEAT = 30  # seconds
+SHARD_ATTEMPTS = 3  # a shard that failed this many times is left failed
+# Name of this worker in the ledger. None for <host name>-<process id>.
+WORKER_NAME = None
+
+# Number of issues migrated in parallel. Set to 1 to migrate one at a time.
+MIGRATION_WORKERS = 4
+
+# HTTP settings shared by all Jira and Gitlab calls. Connections are kept alive
+# and pooled per server; the pool should be at least as large as the number of
+# workers (plus one for the search prefetch). None for MIGRATION_WORKERS + 2.
+HTTP_POOL_SIZE = None
+HTTP_RETRIES = 3  # transport level retries on connection errors and 5xx
+HTTP_TIMEOUT = 60  # seconds
+
+# Requests per second sent to each server to start with. The rate then adapts:
+# it follows the RateLimit headers of the server, slows down on 429 and 503
+# responses (requests rejected with a 429 are sent again after Retry-After)
+# and speeds up again while the server keeps up, to at most HTTP_MAX_RATE
+# (None for no limit). Set HTTP_RATE to None to disable the limiter.
+HTTP_RATE = 30  # Gitlab.com allows 2000 API requests per minute
+HTTP_MAX_RATE = None
+
+# Run metrics: time per phase, requests and latency per endpoint, bytes
+# transferred and rate limit waits. Written every METRICS_INTERVAL seconds and
+# at the end of the run; set a file to None to skip it. The .prom file is in
+# the format of the node_exporter textfile collector.
+METRICS_JSON_FILE = "jira2gitlab_metrics.json"
+METRICS_PROM_FILE = "jira2gitlab_metrics.prom"
+METRICS_INTERVAL = 30  # seconds
+
 # jira user name as key, gitlab as value
 # if you want dates and times to be correct, make sure every user is (temporarily) admin
 GITLAB_USER_NAMES = {
@@ -122,144 +275,497 @@ STORY_POINTS_MAP = {
 
 # Project numbers gathered from the web UI
 PROJECT_MAP = {
-    'frontend': Gitlab project number,
-    'backend': Gitlab project number
+    'frontend': 12345678,  # Gitlab project number
+    'backend': 87654321  # Gitlab project number
 }
 
 # IMPORTANT !!!
 # make sure that user (in gitlab) has access to the project you are trying to
 # import into. Otherwise the API request will fail.
-#use the gitlab python module
+
+# The settings above are the defaults. A run can change any of them, from
+# config files (see migration_config.py) or the command line:
+#   python jira2gitlab.py --config jira.yaml --set MIGRATION_WORKERS=8
+DEFAULTS = script_defaults(globals())
+
+# Run metrics. Without configured files they are only kept in memory; run()
+# starts the ones of the run.
+metrics = Metrics('jira2gitlab')
+
+# The clients are created on first use, so importing the script or using its
+# conversions makes no network call. One pooled session per remote;
+# python-gitlab and the raw upload calls share the Gitlab one.
+clients = {}
+clients_lock = threading.Lock()
+
+def get_jira_session():
+    with clients_lock:
+        if 'jira' not in clients:
+            clients['jira'] = metrics.instrument(make_session(
+                auth=HTTPBasicAuth(*JIRA_ACCOUNT),
+                headers={'Content-Type': 'application/json'},
+                verify=VERIFY_SSL_CERTIFICATE,
+                pool_size=HTTP_POOL_SIZE or MIGRATION_WORKERS + 2,
+                retries=HTTP_RETRIES,
+                timeout=HTTP_TIMEOUT,
+                rate=HTTP_RATE,
+                max_rate=HTTP_MAX_RATE
+            ), 'jira')
+        return clients['jira']
+
+def get_gitlab_session():
+    with clients_lock:
+        if 'gitlab' not in clients:
+            headers = {'PRIVATE-TOKEN': GITLAB_TOKEN}
+            headers.update(GITLAB_HEADERS)
+            clients['gitlab'] = metrics.instrument(make_session(
+                headers=headers,
+                verify=VERIFY_SSL_CERTIFICATE,
+                pool_size=HTTP_POOL_SIZE or MIGRATION_WORKERS + 2,
+                retries=HTTP_RETRIES,
+                timeout=HTTP_TIMEOUT,
+                rate=HTTP_RATE,
+                max_rate=HTTP_MAX_RATE
+            ), 'gitlab')
+        return clients['gitlab']
+
 # connect to Gitlab
-gl = gitlab.Gitlab(GITLAB_URL,private_token=GITLAB_TOKEN)
-gl.auth()
+def get_gl():
+    session = get_gitlab_session()
+    with clients_lock:
+        if 'gl' not in clients:
+            gl = gitlab.Gitlab(GITLAB_URL,private_token=GITLAB_TOKEN,ssl_verify=VERIFY_SSL_CERTIFICATE,session=session)
+            gl.auth()
+            clients['gl'] = gl
+        return clients['gl']
 
 # Gitlab markdown : https://docs.gitlab.com/ee/user/markdown.html
 # Jira text formatting notation : https://jira.atlassian.com/secure/WikiRendererHelpAction.jspa?section=all
 
 
-def multiple_replace(text, adict):
+# The conversion is a fixed pipeline of precompiled stages. Rules that work on
+# separate spans of text (lists, titles, emojis) share a single pass, and the
+# greedy link / color / text effect patterns, which backtrack quadratically on
+# long lines, are replaced by scanners that pick the same matches in linear time.
+
+def is_word(char):
+    return char.isalnum() or char == '_'
+
+# Same as re.sub(r'\n\s*bq\. (.*)\n', r'\n\> \1\n', text)
+def convert_block_quotes(text):
+    out = []
+    pos = 0
+    start = text.find('bq. ')
+    while start != -1:
+        # leftmost newline in the whitespace run right before "bq. "
+        newline = -1
+        i = start - 1
+        while i >= pos and text[i].isspace():
+            if text[i] == '\n':
+                newline = i
+            i -= 1
+        if newline != -1:
+            end = text.find('\n', start + 4)
+            if end == -1:
+                break
+            out.append(text[pos:newline])
+            out.append('\n\\> ' + text[start + 4:end] + '\n')
+            pos = end + 1
+            start = text.find('bq. ', pos)
+        else:
+            start = text.find('bq. ', start + 1)
+    out.append(text[pos:])
+    return ''.join(out)
+
+# Same as re.sub(r'\{color:[\#\w]+\}(.*)\{color\}', r'> **\1**', text)
+COLOR_OPEN = re.compile(r'\{color:[\#\w]+\}')
+
+def convert_colors(text):
+    out = []
+    pos = 0
+    match = COLOR_OPEN.search(text)
+    while match:
+        line_end = text.find('\n', match.end())
+        if line_end == -1:
+            line_end = len(text)
+        # the greedy (.*) always closes on the last {color} of the line
+        close = text.rfind('{color}', match.end(), line_end)
+        if close == -1:
+            match = COLOR_OPEN.search(text, line_end)
+            continue
+        out.append(text[pos:match.start()])
+        out.append('> **' + text[match.end():close] + '**')
+        pos = close + 7
+        match = COLOR_OPEN.search(text, pos)
+    out.append(text[pos:])
+    return ''.join(out)
+
+# Same as re.sub(r'\[([^|\]]*)\]', r'\1', text)
+LINK_STOP = re.compile(r'[|\]]')
+
+def convert_plain_links(text):
+    out = []
+    pos = 0
+    stop = -1
+    start = text.find('[')
+    while start != -1:
+        if stop <= start:
+            match = LINK_STOP.search(text, start + 1)
+            stop = match.start() if match else len(text)
+        if stop < len(text) and text[stop] == ']':
+            out.append(text[pos:start])
+            out.append(text[start + 1:stop])
+            pos = stop + 1
+            start = text.find('[', pos)
+        else:
+            start = text.find('[', start + 1)
+    out.append(text[pos:])
+    return ''.join(out)
+
+# Same as re.sub(r'\[(?:(.+)\|)([a-z]+://.+)\]', r'[\1](\2)', text)
+# Both groups are greedy, so a line has at most one match: from its first "["
+# to its last "]", split on the last "|" that is followed by a scheme.
+def convert_alt_links(text):
+    out = []
+    pos = 0
+    start = text.find('[')
+    while start != -1:
+        line_end = text.find('\n', start)
+        if line_end == -1:
+            line_end = len(text)
+        close = text.rfind(']', start, line_end)
+        pipe = text.rfind('|', start + 2, close) if close != -1 else -1
+        while pipe != -1:
+            scheme_end = pipe + 1
+            while scheme_end < close and 'a' <= text[scheme_end] <= 'z':
+                scheme_end += 1
+            if scheme_end > pipe + 1 and text.startswith('://', scheme_end) and close > scheme_end + 3:
+                out.append(text[pos:start])
+                out.append('[' + text[start + 1:pipe] + '](' + text[pipe + 1:close] + ')')
+                pos = close + 1
+                break
+            pipe = text.rfind('|', start + 2, pipe)
+        start = text.find('[', line_end + 1)
+    out.append(text[pos:])
+    return ''.join(out)
+
+# Same as re.sub(r'(^|[\W])O(.*)C([\W]|$)', r'\1L\2R\3', text) for the opener O
+# and closer C. With strict=True the content is (\S.*\S) instead of (.*).
+def convert_text_effect(text, opener, closer, left, right, strict):
+    out = []
+    pos = 0
+    line_end = -1
+    last_close = -1
+    start = text.find(opener)
+    while start != -1:
+        content = start + len(opener)
+        if (start == 0 or (start - 1 >= pos and not is_word(text[start - 1]))) and \
+                (not strict or (content < len(text) and not text[content].isspace())):
+            if start >= line_end:
+                # the greedy (.*) always closes on the last valid closer of the line
+                line_end = text.find('\n', start)
+                if line_end == -1:
+                    line_end = len(text)
+                line_start = text.rfind('\n', 0, start) + 1
+                last_close = -1
+                hi = line_end
+                close = text.rfind(closer, line_start, hi)
+                while close != -1:
+                    tail = close + len(closer)
+                    if (tail == len(text) or not is_word(text[tail])) and \
+                            (not strict or (close > 0 and not text[close - 1].isspace())):
+                        last_close = close
+                        break
+                    hi = tail - 1
+                    close = text.rfind(closer, line_start, hi)
+            if last_close >= content + (2 if strict else 0):
+                tail = last_close + len(closer)
+                end = min(tail + 1, len(text))
+                out.append(text[pos:start])
+                out.append(left + text[content:last_close] + right + text[tail:end])
+                pos = end
+                start = text.find(opener, pos)
+                continue
+        start = text.find(opener, start + 1)
+    out.append(text[pos:])
+    return ''.join(out)
+
+LIST_RULES = [
+    (r'\n *\# ', '\n 1. '),  # Ordered list
+    (r'\n *[\*\-\#]\# ', '\n   1. '),  # Ordered sub-list
+    (r'\n *[\*\-\#]{2}\# ', '\n     1. '),  # Ordered sub-sub-list
+    (r'\n *\* ', '\n - '),  # Unordered list
+    (r'\n *[\*\-\#][\*\-] ', '\n   - '),  # Unordered sub-list
+    (r'\n *[\*\-\#]{2}[\*\-] ', '\n     - '),  # Unordered sub-sub-list
+]
+
+# Emojis : https://emoji.codes
+EMOJI_RULES = [
+    (r':\)', ':smiley:'),
+    (r':\(', ':disappointed:'),
+    (r':P', ':yum:'),
+    (r':D', ':grin:'),
+    (r';\)', ':wink:'),
+    (r'\(y\)', ':thumbsup:'),
+    (r'\(n\)', ':thumbsdown:'),
+    (r'\(i\)', ':information_source:'),
+    (r'\(/\)', ':white_check_mark:'),
+    (r'\(x\)', ':x:'),
+    (r'\(!\)', ':warning:'),
+    (r'\(\+\)', ':heavy_plus_sign:'),
+    (r'\(-\)', ':heavy_minus_sign:'),
+    (r'\(\?\)', ':grey_question:'),
+    (r'\(on\)', ':bulb:'),
+    # (r'\(off\)', '::'), # Not found
+    (r'\(\*[rgby]?\)', ':star:'),
+]
+
+# Each alternative gets its own group, the replacement is picked by group index.
+# The lookahead on the possible first characters lets the engine skip quickly
+# over positions where none of the alternatives can start.
+def compile_rules(rules, first_chars):
+    return re.compile('(?=[%s])(?:%s)' % (first_chars, '|'.join('(%s)' % rule for rule, _ in rules)))
+
+LIST_PATTERN = compile_rules(LIST_RULES, r'\n')
+LIST_VALUES = [value for _, value in LIST_RULES]
+
+def convert_lists(text):
+    return LIST_PATTERN.sub(lambda m: LIST_VALUES[m.lastindex - 1], text)
+
+EMOJI_PATTERN = compile_rules(EMOJI_RULES, r':;(')
+EMOJI_VALUES = [value for _, value in EMOJI_RULES]
+# Every emoji ends with ":", which makes ":(", ":P" or ":D" with the next
+# character. When applied one by one, the later rules convert those as well.
+EMOJI_CHAINS = {'(': 1, 'P': 2, 'D': 3}
+
+def convert_emojis(text):
+    out = []
+    pos = 0
+    match = EMOJI_PATTERN.search(text)
+    while match:
+        rule = match.lastindex - 1
+        value = EMOJI_VALUES[rule]
+        out.append(text[pos:match.start()])
+        pos = match.end()
+        while pos < len(text) and EMOJI_CHAINS.get(text[pos], -1) > rule:
+            rule = EMOJI_CHAINS[text[pos]]
+            value = value[:-1] + EMOJI_VALUES[rule]
+            pos += 1
+        out.append(value)
+        match = EMOJI_PATTERN.search(text, pos)
+    out.append(text[pos:])
+    return ''.join(out)
+
+TITLE_PATTERN = re.compile(r'(?=[\nh])\n?\bh([1-6])\. ')
+
+# The stages link issue keys to JIRA_URL, so they are built again for every
+# configuration
+def wiki_stages():
+    return [
+        lambda t: t.replace('\r\n', '  \r\n'),  # line breaks
+        partial(re.compile(r'\{code:([a-z]+)\}\s*').sub, r'\n```\1\n'),  # Block code
+        partial(re.compile(r'\{code\}\s*').sub, r'\n```\n'),  # Block code
+        convert_block_quotes,  # Block quote
+        partial(re.compile(r'\{quote\}').sub, r'\n\>\>\>\n'),  # Block quote #2
+        convert_colors,  # Colors
+        partial(re.compile(r'\n-{4,}\n').sub, r'---'),  # Ruler
+        partial(re.compile(r'\[~([a-z]+)\]').sub, r'@\1'),  # Links to users
+        convert_plain_links,  # Links without alt
+        convert_alt_links,  # Links with alt
+        partial(re.compile(r'(\b%s-\d+\b)' % JIRA_PROJECT).sub,
+                r'[\1](%sbrowse/\1)' % JIRA_URL),  # Links to other issues
+        convert_lists,
+        # Text effects
+        lambda t: convert_text_effect(t, '*', '*', '**', '**', True),  # Bold
+        lambda t: convert_text_effect(t, '_', '_', '*', '*', True),  # Emphasis
+        lambda t: convert_text_effect(t, '-', '-', '~~', '~~', True),  # Deleted / Strikethrough
+        lambda t: convert_text_effect(t, '+', '+', '__', '__', True),  # Underline
+        lambda t: convert_text_effect(t, '{{', '}}', '`', '`', False),  # Inline code
+        lambda t: TITLE_PATTERN.sub(lambda m: '\n' + '#' * int(m.group(1)) + ' ', t),  # Titles
+        convert_emojis,
+    ]
+
+WIKI_STAGES = wiki_stages()
+
+# replacements is the list of precompiled (pattern, value) pairs built by
+# move_attachements for a project, applied after the wiki conversion
+def multiple_replace(text, replacements):
     if text is None:
         return ''
     t = text
-    t = re.sub(r'(\r\n){1}', r'  \1', t)  # line breaks
-    t = re.sub(r'\{code:([a-z]+)\}\s*', r'\n```\1\n', t)  # Block code
-    t = re.sub(r'\{code\}\s*', r'\n```\n', t)  # Block code
-    t = re.sub(r'\n\s*bq\. (.*)\n', r'\n\> \1\n', t)  # Block quote
-    t = re.sub(r'\{quote\}', r'\n\>\>\>\n', t)  # Block quote #2
-    t = re.sub(r'\{color:[\#\w]+\}(.*)\{color\}', r'> **\1**', t)  # Colors
-    t = re.sub(r'\n-{4,}\n', r'---', t)  # Ruler
-    t = re.sub(r'\[~([a-z]+)\]', r'@\1', t)  # Links to users
-    t = re.sub(r'\[([^|\]]*)\]', r'\1', t)  # Links without alt
-    t = re.sub(r'\[(?:(.+)\|)([a-z]+://.+)\]',
-               r'[\1](\2)', t)  # Links with alt
-    t = re.sub(r'(\b%s-\d+\b)' % JIRA_PROJECT,
-               r'[\1](%sbrowse/\1)' % JIRA_URL, t)  # Links to other issues
-    # Lists
-    t = re.sub(r'\n *\# ', r'\n 1. ', t)  # Ordered list
-    t = re.sub(r'\n *[\*\-\#]\# ', r'\n   1. ', t)  # Ordered sub-list
-    t = re.sub(r'\n *[\*\-\#]{2}\# ', r'\n     1. ', t)  # Ordered sub-sub-list
-    t = re.sub(r'\n *\* ', r'\n - ', t)  # Unordered list
-    t = re.sub(r'\n *[\*\-\#][\*\-] ', r'\n   - ', t)  # Unordered sub-list
-    # Unordered sub-sub-list
-    t = re.sub(r'\n *[\*\-\#]{2}[\*\-] ', r'\n     - ', t)
-    # Text effects
-    t = re.sub(r'(^|[\W])\*(\S.*\S)\*([\W]|$)', r'\1**\2**\3', t)  # Bold
-    t = re.sub(r'(^|[\W])_(\S.*\S)_([\W]|$)', r'\1*\2*\3', t)  # Emphasis
-    # Deleted / Strikethrough
-    t = re.sub(r'(^|[\W])-(\S.*\S)-([\W]|$)', r'\1~~\2~~\3', t)
-    t = re.sub(r'(^|[\W])\+(\S.*\S)\+([\W]|$)', r'\1__\2__\3', t)  # Underline
-    t = re.sub(r'(^|[\W])\{\{(.*)\}\}([\W]|$)', r'\1`\2`\3', t)  # Inline code
-    # Titles
-    t = re.sub(r'\n?\bh1\. ', r'\n# ', t)
-    t = re.sub(r'\n?\bh2\. ', r'\n## ', t)
-    t = re.sub(r'\n?\bh3\. ', r'\n### ', t)
-    t = re.sub(r'\n?\bh4\. ', r'\n#### ', t)
-    t = re.sub(r'\n?\bh5\. ', r'\n##### ', t)
-    t = re.sub(r'\n?\bh6\. ', r'\n###### ', t)
-    # Emojis : https://emoji.codes
-    t = re.sub(r':\)', r':smiley:', t)
-    t = re.sub(r':\(', r':disappointed:', t)
-    t = re.sub(r':P', r':yum:', t)
-    t = re.sub(r':D', r':grin:', t)
-    t = re.sub(r';\)', r':wink:', t)
-    t = re.sub(r'\(y\)', r':thumbsup:', t)
-    t = re.sub(r'\(n\)', r':thumbsdown:', t)
-    t = re.sub(r'\(i\)', r':information_source:', t)
-    t = re.sub(r'\(/\)', r':white_check_mark:', t)
-    t = re.sub(r'\(x\)', r':x:', t)
-    t = re.sub(r'\(!\)', r':warning:', t)
-    t = re.sub(r'\(\+\)', r':heavy_plus_sign:', t)
-    t = re.sub(r'\(-\)', r':heavy_minus_sign:', t)
-    t = re.sub(r'\(\?\)', r':grey_question:', t)
-    t = re.sub(r'\(on\)', r':bulb:', t)
-    # t = re.sub(r'\(off\)', r'::', t) # Not found
-    t = re.sub(r'\(\*[rgby]?\)', r':star:', t)
-    for k, v in adict.items():
-        t = re.sub(k, v, t)
+    for stage in WIKI_STAGES:
+        t = stage(t)
+    for pattern, value in replacements:
+        t = pattern.sub(lambda m: value, t)
     return t
 
-# We use UUID in place of the filename to prevent 500 errors on unicode chars
-
-
-def move_attachements(attachments,GL_PROJECT_ID):
-    replacements = {}
-    if len(attachments):
-        for attachment in attachments:
-            author = attachment['author']['displayName']
-
-            _file = requests.get(
-                attachment['content'],
-                auth=HTTPBasicAuth(*JIRA_ACCOUNT),
-                verify=VERIFY_SSL_CERTIFICATE,
-            )
-
-            _content = BytesIO(_file.content)
-
-            if GITLAB_SUDO:
-                GITLAB_HEADERS['SUDO'] = resolve_login(author)
+# Download an attachment from Jira in chunks. Small files stay in memory,
+# larger ones are spooled to disk. Returns the file and its sha256.
+def download_attachment(attachment):
+    # Saved by the extract stage
+    if attachment.get('snapshot_file') and os.path.exists(attachment['snapshot_file']):
+        return open(attachment['snapshot_file'], 'rb'), attachment['sha256']
+    content = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+    digest = hashlib.sha256()
+    with get_jira_session().get(
+        attachment['content'],
+        stream=True
+    ) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE):
+            content.write(chunk)
+            digest.update(chunk)
+    return content, digest.hexdigest()
+
+# Record an upload in memory and append it to the cache file
+upload_cache_lock = threading.Lock()
+
+def remember_upload(attachment_id, sha256, GL_PROJECT_ID, url):
+    with upload_cache_lock:
+        uploaded_attachments[('id', attachment_id, GL_PROJECT_ID)] = url
+        uploaded_attachments[('sha256', sha256, GL_PROJECT_ID)] = url
+        if ATTACHMENT_CACHE and OUTPUT_BACKEND == 'api':
+            with open(ATTACHMENT_CACHE_FILE, 'a') as cache_file:
+                cache_file.write(json.dumps({
+                    'id': attachment_id,
+                    'sha256': sha256,
+                    'project': GL_PROJECT_ID,
+                    'url': url
+                }) + '\n')
+
+# multipart/form-data body with a single file field, read from the file in
+# chunks while it is sent. Its length is known up front, so requests sends a
+# Content-Length header instead of falling back to chunked encoding.
+class MultipartFile(object):
+    def __init__(self, field, filename, fileobj):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        self.head = (
+            '--%s\r\n'
+            'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n' % (boundary, field, filename)
+        ).encode('utf-8')
+        self.tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self.fileobj = fileobj
+        fileobj.seek(0, 2)
+        self.size = fileobj.tell()
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        self.fileobj.seek(0)
+        chunk = self.fileobj.read(ATTACHMENT_CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = self.fileobj.read(ATTACHMENT_CHUNK_SIZE)
+        yield self.tail
 
-            file_info = requests.post(
-                GITLAB_URL + 'api/v4/projects/%s/uploads' % GL_PROJECT_ID,
-                headers=GITLAB_HEADERS,
-                files={
-                    'file': (
-                        str(uuid.uuid4()),
-                        _content
-                    )
-                },
-                verify=VERIFY_SSL_CERTIFICATE
-            ).json()
-
-            del _content
-
-            # now we got the upload URL. Let's post the comment with an
-            # attachment
-            if 'url' in file_info:
-                key = "!%s[^!]*!" % attachment['filename']
-                value = "![%s](%s)" % (
-                    attachment['filename'], file_info['url'])
-                replacements[key] = value
+# We use UUID in place of the filename to prevent 500 errors on unicode chars
+def upload_attachment(content, GL_PROJECT_ID, author):
+    body = MultipartFile('file', str(uuid.uuid4()), content)
+    headers = {'Content-Type': body.content_type}
+    if GITLAB_SUDO:
+        headers['SUDO'] = resolve_login(author)
+
+    return get_gitlab_session().post(
+        GITLAB_URL + 'api/v4/projects/%s/uploads' % GL_PROJECT_ID,
+        headers=headers,
+        data=body
+    ).json()
+
+# Each attachment is downloaded once and uploaded to every target project,
+# unless the upload cache already has it for that project.
+# Returns the attachment replacements for multiple_replace per project.
+# upload(content, project_id, author) returns a dict with the url of the file.
+def move_attachements(attachments,project_ids,upload=upload_attachment):
+    replacements = dict((project_id, []) for project_id in project_ids)
+    for attachment in attachments:
+        author = attachment['author']['displayName']
+        attachment_id = str(attachment['id'])
+
+        urls = {}
+        for GL_PROJECT_ID in project_ids:
+            if ('id', attachment_id, GL_PROJECT_ID) in uploaded_attachments:
+                urls[GL_PROJECT_ID] = uploaded_attachments[('id', attachment_id, GL_PROJECT_ID)]
+        missing = [project_id for project_id in project_ids if project_id not in urls]
+
+        metrics.count('attachments_cached', len(urls))
+
+        if missing:
+            with metrics.phase('attachment_download'):
+                content, sha256 = download_attachment(attachment)
+            metrics.count('attachments_downloaded')
+            with content:
+                for GL_PROJECT_ID in missing:
+                    url = uploaded_attachments.get(('sha256', sha256, GL_PROJECT_ID))
+                    if url is None:
+                        with metrics.phase('attachment_upload'):
+                            url = upload(content, GL_PROJECT_ID, author).get('url')
+                        metrics.count('attachments_uploaded')
+                    else:
+                        metrics.count('attachments_cached')
+                    if url:
+                        remember_upload(attachment_id, sha256, GL_PROJECT_ID, url)
+                        urls[GL_PROJECT_ID] = url
+
+        # now we got the upload URL. Let's post the comment with an
+        # attachment
+        key = re.compile("!%s[^!]*!" % re.escape(attachment['filename']))
+        for GL_PROJECT_ID, url in urls.items():
+            value = "![%s](%s)" % (attachment['filename'], url)
+            replacements[GL_PROJECT_ID].append((key, value))
     return replacements
 
-# if you use milestones to track sprints
-# def get_milestone_id(string):
-#     for milestone in gl_milestones:
-#         if milestone['title'] == string:
-#             return milestone['id']
-#
-#     # Milestone doesn't yet exist, so we create it
-#     milestone = requests.post(
-#         GITLAB_URL + 'api/v4/projects/{}/{}'.format(GITLAB_PROJECT_ID,GITLAB_SPRINT_TYPE),
-#         headers=GITLAB_HEADERS,
-#         verify=VERIFY_SSL_CERTIFICATE,
-#         data={
-#             'title': string
-#         }
-#     ).json()
-#     gl_milestones.append(milestone)
-#
-#     return milestone['id']
+# Sprints: the milestones or iterations of every project in PROJECT_MAP, by
+# title. They are all loaded (every page) the first time a sprint is looked up,
+# so resolving the sprint of an issue costs no API call. A missing milestone
+# is created once, under the lock; a missing iteration stays missing.
+sprints = {}
+sprints_lock = threading.Lock()
+
+# The sprints of a project by title. Messages go to progress, this runs on the
+# worker thread of the issue that needed them.
+def load_sprints(project_id, progress):
+    project = get_gl().projects.get(project_id, lazy=True)
+    if GITLAB_SPRINT_TYPE == 'milestones':
+        gl_sprints = project.milestones.list(all=True)
+    else:
+        # Iterations belong to groups, and not every Gitlab tier has them
+        try:
+            gl_sprints = project.iterations.list(all=True, include_ancestors=True)
+        except gitlab.exceptions.GitlabListError as e:
+            progress.append("No iterations in project {} ({}), sprints are only kept in the description".format(
+                project_id, e))
+            return {}
+    index = {}
+    for sprint in gl_sprints:
+        if sprint.title:
+            index.setdefault(sprint.title, sprint.id)
+    return index
+
+# The id of the milestone or iteration of a project with this title, or None
+def get_sprint_id(project_id, title, progress):
+    with sprints_lock:
+        if not sprints:
+            with metrics.phase('gitlab_sprints'):
+                for pid in set(PROJECT_MAP.values()):
+                    sprints[pid] = load_sprints(pid, progress)
+        index = sprints.setdefault(project_id, {})
+        if title not in index and GITLAB_SPRINT_TYPE == 'milestones':
+            try:
+                with metrics.phase('milestone_create'):
+                    milestone = get_gl().projects.get(project_id, lazy=True).milestones.create({'title': title})
+            except gitlab.exceptions.GitlabCreateError:
+                # Titles are unique, another process created it meanwhile
+                index.update(load_sprints(project_id, progress))
+                if title not in index:
+                    raise
+            else:
+                metrics.count('milestones_created')
+                index[title] = milestone.id
+        return index.get(title)
 
 # Get the user name from the GITLAB_USER_NAMES dict
 # Or if logins match between Jira and Gitlab, use it
@@ -268,9 +774,8 @@ def move_attachements(attachments,GL_PROJECT_ID):
 def resolve_login(jira_user):
     if jira_user in GITLAB_USER_NAMES:
         return GITLAB_USER_NAMES[jira_user]
-    for user in gl_users:
-        if user['username'] == jira_user:
-            return user['username']
+    if jira_user in get_users()['username']:
+        return jira_user
     return GITLAB_ACCOUNT[0]
 
 #get labels for a specific projects.  Also add the default labels in as well
@@ -297,195 +802,1044 @@ def get_project_labels(pid):
 # if not GITLAB_PROJECT_ID:
 #     raise Exception("Unable to find %s in gitlab!" % GITLAB_PROJECT)
 
-# Get all the milestones for multiple projects
-# def get_all_milestones(p_id):
-#     gl_milestones = requests.get(
-#         GITLAB_URL + "api/v4/projects/{}/{}".format(p_id,GITLAB_SPRINT_TYPE),
-#         headers=GITLAB_HEADERS,
-#         verify=VERIFY_SSL_CERTIFICATE
-#     ).json()
-#     return gl_milestones
-
-# Get epic or create one if it doesn't exist
-def get_epic_id(project_id,epic_title):
-    project = gl.projects.get(project_id) #get project info
-    group = gl.groups.get(project.namespace['parent_id']) #get group info for project parent
-    epics = group.epics.list() #get all the epics
-
-    for epic in epics:
-        if epic.title == epic_title:
-            return epic
-    # Epic doesn't exist, so let's create it
-    new_epic = group.epics.create({"title":epic_title})
-    new_epic.labels = get_project_labels(GITLAB_PROJECT_ID)
-    new_epic.save()
-    return new_epic
-
-# Get all of the GL users so that we can map issues correctly
-# using the gitlab module
-gl_users = []
-group = gl.groups.get(GITLAB_GROUP_USERS)  #query the everyone group
-members = group.members.list()
-for member in members:
-    user = gl.users.get(member.id)
-    gl_users.append(user.attributes)
-
-# Get all of the milestones for the project(s)
-# gl_milestones = []
-# for pid in PROJECT_MAP.values():
-#     gl_milestones.append(get_all_milestones(pid))
-
-# Read all of the existing issues we have migrated from file
-if ISSUE_TRACKING:
-    try:
-        with open(TRACKING_FILE, 'r') as tracking_file:
-            processed_jiras = tracking_file.read().splitlines()
-    except IOError:
-        processed_jiras = []
-
-# Jira API documentation : https://developer.atlassian.com/static/rest/jira/6.1.html
-jira_issues = requests.get(
-    JIRA_URL + 'rest/api/2/search?jql=' + JQL,
-    auth=HTTPBasicAuth(*JIRA_ACCOUNT),
-    verify=VERIFY_SSL_CERTIFICATE,
-    headers={'Content-Type': 'application/json'}
-).json()['issues']
-
-for issue in jira_issues:
-    if ISSUE_TRACKING and (issue['key'] in processed_jiras):
-        print("{} is already imported".format(issue['key']))
-        continue
+# Fetch a single page of search results. Pages are requested either by offset
+# (startAt) or, on the newer search endpoint, by the token of the previous page.
+def fetch_search_page(jql, start_at=0, page_token=None, fields=None):
+    params = {'maxResults': JIRA_PAGE_SIZE}
+    if fields:
+        params['fields'] = fields
+    if page_token:
+        params['nextPageToken'] = page_token
     else:
-        print("migrating issue: {}".format(issue['fields']['summary']))
-        if issue['fields']['issuetype']['name'] not in ISSUE_TYPES_MAP:
+        params['startAt'] = start_at
+    response = get_jira_session().get(
+        JIRA_URL + JIRA_SEARCH_API + '?jql=' + jql,
+        params=params
+    )
+    # A silently truncated search is worse than a failed one
+    response.raise_for_status()
+    return response.json()
+
+# Work out the arguments for the page after this one, or None on the last page
+def next_search_page(page, start_at):
+    if page.get('nextPageToken'):
+        return (0, page['nextPageToken'])
+    if page.get('isLast') or not page.get('issues'):
+        return None
+    start_at += len(page['issues'])
+    if 'total' in page and start_at >= page['total']:
+        return None
+    return (start_at, None)
+
+# Epic summaries by epic key, memoized for the whole run
+epic_summaries = {}
+
+# Look up the summaries of all the epics referenced by a page of issues with
+# a single "key in (...)" search
+def cache_epic_summaries(issues):
+    keys = sorted(set(
+        issue['fields'][JIRA_EPIC_FIELD] for issue in issues
+        if issue['fields'].get(JIRA_EPIC_FIELD) and issue['fields'][JIRA_EPIC_FIELD] not in epic_summaries
+    ))
+    for i in range(0, len(keys), JIRA_PAGE_SIZE):
+        try:
+            page = fetch_search_page('key+in+(%s)' % ','.join(keys[i:i + JIRA_PAGE_SIZE]), fields='summary')
+        except HTTPError:
+            # A key that no longer exists fails the whole query. Those epics
+            # are looked up one by one by get_epic_summary instead.
             continue
+        for epic in page.get('issues', []):
+            epic_summaries[epic['key']] = epic['fields']['summary']
 
-        # filter for only appropriate components per project
-        project_queue = {}
-        for comp in issue['fields']['components']:
-            if comp['name'] not in COMPONENT_MAP:
-                print("Uknown component! {}".format(comp['name']))
-                continue
+def get_epic_summary(epic_key):
+    if epic_key not in epic_summaries:
+        epic_info = get_jira_session().get(
+            JIRA_URL + 'rest/api/2/issue/%s/?fields=summary' % epic_key
+        ).json()
+        epic_summaries[epic_key] = epic_info['fields']['summary']
+    return epic_summaries[epic_key]
+
+# The search embeds the first comments of every issue. Only issues with more
+# comments than that need the rest to be fetched, page by page.
+def get_comments(issue):
+    comment = issue['fields']['comment']
+    comments = list(comment['comments'])
+    while len(comments) < comment.get('total', 0):
+        page = get_jira_session().get(
+            JIRA_URL + 'rest/api/2/issue/%s/comment' % issue['id'],
+            params={'startAt': len(comments), 'maxResults': JIRA_PAGE_SIZE}
+        ).json()
+        if not page.get('comments'):
+            break
+        comments.extend(page['comments'])
+    return comments
+
+# Fetch a page of issues and the summaries of their epics
+def load_search_page(jql, start_at=0, page_token=None):
+    with metrics.phase('jira_search'):
+        page = fetch_search_page(jql, start_at, page_token, fields=JIRA_SEARCH_FIELDS)
+    with metrics.phase('jira_epic_summaries'):
+        cache_epic_summaries(page.get('issues', []))
+    return page
+
+# Stream the issues matching the JQL one at a time. The next page (and its
+# epics) is fetched in the background while the issues of the current one are
+# being migrated, so at most two pages are held in memory.
+def search_issues(jql):
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        start_at = 0
+        pending = prefetcher.submit(load_search_page, jql)
+        while pending is not None:
+            page = pending.result()
+            following = next_search_page(page, start_at)
+            if following is None:
+                pending = None
             else:
-                project_queue[PROJECT_MAP[COMPONENT_MAP[comp['name']]]] = PROJECT_MAP[COMPONENT_MAP[comp['name']]]
+                start_at = following[0]
+                pending = prefetcher.submit(load_search_page, jql, *following)
+            for issue in page.get('issues', []):
+                yield issue
+
+def get_graphql():
+    session = get_gitlab_session()
+    with clients_lock:
+        if 'graphql' not in clients:
+            clients['graphql'] = GraphQLClient(session, GITLAB_URL + 'api/graphql', GRAPHQL_BATCH_SIZE, metrics)
+        return clients['graphql']
+
+# Epics are loaded once per group (every page) and indexed by title and by the
+# Jira key recorded when the script created them, so lookups cost no API calls.
+# New epics are added to the index as they are created. The lock makes sure
+# concurrent workers don't create the same epic twice, and in a sharded run the
+# ledger does the same for the other processes.
+EPIC_KEY_PATTERN = re.compile(r'^Imported from Jira epic \[([^\]]+)\]')
+project_groups = {}
+project_paths = {}
+group_epics = {}
+epic_lock = threading.Lock()
+
+def get_project_group(project_id):
+    if project_id not in project_groups:
+        project = get_gl().projects.get(project_id) #get project info
+        project_paths[project_id] = project.path_with_namespace
+        project_groups[project_id] = get_gl().groups.get(project.namespace['parent_id']) #get group info for project parent
+    return project_groups[project_id]
+
+# The full path of a project, for GraphQL
+def get_project_path(project_id):
+    if project_id not in project_paths:
+        get_project_group(project_id)
+    return project_paths[project_id]
+
+def index_epic(index, epic):
+    index['title'].setdefault(epic.title, epic)
+    match = EPIC_KEY_PATTERN.match(epic.description or '')
+    if match:
+        index['key'].setdefault(match.group(1), epic)
+
+def get_epic_index(group):
+    if group.id not in group_epics:
+        index = {'title': {}, 'key': {}}
+        for epic in group.epics.list(all=True):
+            index_epic(index, epic)
+        group_epics[group.id] = index
+    return group_epics[group.id]
 
-        #map jira user to GL user
-        gl_assignee = ''
-        if issue['fields']['assignee']:
+# Get epic or create one if it doesn't exist
+def get_epic_id(project_id,epic_title,epic_key=None):
+    with epic_lock:
+        group = get_project_group(project_id)
+        index = get_epic_index(group)
+        if epic_key in index['key']:
+            return index['key'][epic_key]
+        if epic_title in index['title']:
+            return index['title'][epic_title]
+        # Epic doesn't exist, so let's create it
+        new_epic = {
+            "title":epic_title,
+            "labels":get_project_labels(project_id)
+        }
+        if epic_key:
+            new_epic['description'] = "Imported from Jira epic [%(k)s](%(u)sbrowse/%(k)s)" % {'k': epic_key, 'u': JIRA_URL}
+        if ledger is not None:
+            epic_iid = ledger.claim_epic(group.id, epic_key or epic_title, worker_name)
+            if epic_iid is not None:
+                # Created by another worker since the index was loaded
+                epic = group.epics.get(epic_iid)
+                index_epic(index, epic)
+                return epic
+        try:
+            new_epic = group.epics.create(new_epic)
+        except Exception:
+            if ledger is not None:
+                ledger.release_epic(group.id, epic_key or epic_title, worker_name)
+            raise
+        if ledger is not None:
+            ledger.epic_created(group.id, epic_key or epic_title, new_epic.iid)
+        index_epic(index, new_epic)
+        return new_epic
+
+# Get all of the GL users so that we can map issues correctly.
+# The member listing already has the id, username and name of every user, so
+# one paginated call replaces a users.get per member.
+def load_gl_users():
+    if USER_CACHE_TTL:
+        try:
+            if time.time() - os.path.getmtime(USER_CACHE_FILE) < USER_CACHE_TTL:
+                with open(USER_CACHE_FILE, 'r') as cache_file:
+                    cache = json.load(cache_file)
+                if cache['group'] == GITLAB_GROUP_USERS:
+                    return cache['users']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    group = get_gl().groups.get(GITLAB_GROUP_USERS, lazy=True)  #query the everyone group
+    users = []
+    for member in group.members.list(all=True):
+        users.append({'id': member.id, 'username': member.username, 'name': member.name})
+
+    if USER_CACHE_TTL:
+        with open(USER_CACHE_FILE, 'w') as cache_file:
+            json.dump({'group': GITLAB_GROUP_USERS, 'users': users}, cache_file)
+    return users
+
+# The users indexed by username, display name and id, loaded on first use.
+# Display names aren't unique, the first user listed wins.
+users = {}
+users_lock = threading.Lock()
+
+def get_users():
+    with users_lock:
+        if not users:
+            with metrics.phase('gitlab_users'):
+                gl_users = load_gl_users()
+            users.update({'username': {}, 'name': {}, 'id': {}})
             for user in gl_users:
-                if user['name'] == issue['fields']['assignee']['displayName']:
-                    gl_assignee = user['id']
-                    break
-
-        # Handle labels
-        labels = [ISSUE_TYPES_MAP[issue['fields']['issuetype']['name']]]
-
-        if issue['fields']['status']['statusCategory']['name'] == "In Progress":
-            labels.append(issue['fields']['status']['name'])
-
-        # Add Epic name to labels
-        if issue['fields'][JIRA_EPIC_FIELD]:
-            epic_info = requests.get(
-                JIRA_URL + 'rest/api/2/issue/%s/?fields=summary' % issue['fields'][JIRA_EPIC_FIELD],
-                auth=HTTPBasicAuth(*JIRA_ACCOUNT),
-                verify=VERIFY_SSL_CERTIFICATE,
-                headers={'Content-Type': 'application/json'}
-            ).json()
-            labels.append(epic_info['fields']['summary'])
-
-        # Use the name of the last sprint as milestone
-        # milestone_id = None
-        if issue['fields'][JIRA_SPRINT_FIELD]:
-            for sprint in issue['fields'][JIRA_SPRINT_FIELD]:
-                if sprint['name']:
-                    name = sprint['name']
-                    milestone_name = sprint['name']
-        #     if name:
-        #         # milestone_id = get_milestone_id(m.group(1))
-        #         milestone_id = get_milestone_id(name)
-
+                users['username'].setdefault(user['username'], user)
+                users['name'].setdefault(user['name'], user)
+                users['id'].setdefault(user['id'], user)
+        return users
+
+# Open the migration state. Without tracking it only lives for this run.
+def open_state():
+    state = MigrationState(TRACKING_DB if ISSUE_TRACKING else ':memory:', shared=bool(SHARD_ROLE))
+    if ISSUE_TRACKING:
+        try:
+            with open(TRACKING_FILE, 'r') as tracking_file:
+                state.import_migrated(tracking_file.read().splitlines())
+        except IOError:
+            pass
+    return state
+
+state = None
+
+# Read the attachments we have already uploaded from file. Exports start from
+# scratch, their files only exist once the archive is imported.
+uploaded_attachments = {}
+
+def load_uploaded_attachments():
+    if ATTACHMENT_CACHE and OUTPUT_BACKEND == 'api':
+        try:
+            with open(ATTACHMENT_CACHE_FILE, 'r') as cache_file:
+                for line in cache_file:
+                    upload = json.loads(line)
+                    uploaded_attachments[('id', upload['id'], upload['project'])] = upload['url']
+                    uploaded_attachments[('sha256', upload['sha256'], upload['project'])] = upload['url']
+        except IOError:
+            pass
+
+# Bring a migrated Gitlab issue in line with its Jira issue. Labels are diffed
+# against the ones set by the previous run, labels added in Gitlab are kept.
+# Returns the names of the fields that changed. Fields Gitlab didn't return,
+# like the weight on tiers without weights, are left alone.
+def update_issue(gl_issue, checkpoint, data, labels, closed):
+    changes = []
+    for field in ('title', 'description', 'weight'):
+        if field in gl_issue.attributes and gl_issue.attributes[field] != data.get(field):
+            setattr(gl_issue, field, data.get(field))
+            changes.append(field)
+
+    current = set(gl_issue.labels)
+    add_labels = [label for label in labels if label not in current]
+    remove_labels = [label for label in checkpoint['labels'] if label not in labels and label in current]
+    if add_labels:
+        gl_issue.add_labels = ','.join(add_labels)
+    if remove_labels:
+        gl_issue.remove_labels = ','.join(remove_labels)
+    if add_labels or remove_labels:
+        changes.append('labels')
+
+    if closed != (gl_issue.state == 'closed'):
+        gl_issue.state_event = 'close' if closed else 'reopen'
+        changes.append('state')
+
+    if changes:
+        gl_issue.save()
+    return changes
+
+# The parts of a Jira issue that are the same in every target project, or
+# None if its type isn't migrated
+def transform_issue(issue, progress):
+    if issue['fields']['issuetype']['name'] not in ISSUE_TYPES_MAP:
+        return None
+
+    project_ids = issue_project_ids(issue, progress)
+
+    #map jira user to GL user
+    gl_assignee = ''
+    users_by_name = get_users()['name']
+    if issue['fields']['assignee'] and issue['fields']['assignee']['displayName'] in users_by_name:
+        gl_assignee = users_by_name[issue['fields']['assignee']['displayName']]['id']
+
+    labels, epic_summary = issue_labels(issue)
+
+    # Use the name of the last sprint as milestone
+    milestone_name = None
+    if issue['fields'][JIRA_SPRINT_FIELD]:
+        for sprint in issue['fields'][JIRA_SPRINT_FIELD]:
+            if sprint['name']:
+                milestone_name = sprint['name']
+
+    # comments and attachments come with the search results
+    with metrics.phase('jira_comments'):
+        comments = get_comments(issue)
+
+    return {
+        'project_ids': project_ids,
+        'assignee': gl_assignee,
+        'labels': labels,
+        'epic_summary': epic_summary,
+        'milestone_name': milestone_name,
         # # Gitlab expect the timezone in +00:00 format without milliseconds while Jira gives +0000 with milliseconds
-        reporter = issue['fields']['reporter']['displayName']
-
-        # get comments and attachments from Jira
-        issue_info = requests.get(
-            JIRA_URL + 'rest/api/2/issue/%s/?fields=attachment,comment' % issue['id'],
-            auth=HTTPBasicAuth(*JIRA_ACCOUNT),
-            verify=VERIFY_SSL_CERTIFICATE,
-            headers={'Content-Type': 'application/json'}
-        ).json()
+        'reporter': issue['fields']['reporter']['displayName'],
+        'comments': comments,
+        'closed': issue['fields']['status']['statusCategory']['key'] == "done"
+    }
+
+# filter for only appropriate components per project
+def issue_project_ids(issue, progress):
+    project_queue = {}
+    for comp in issue['fields']['components']:
+        if comp['name'] not in COMPONENT_MAP:
+            progress.append("Uknown component! {}".format(comp['name']))
+            continue
+        else:
+            project_queue[PROJECT_MAP[COMPONENT_MAP[comp['name']]]] = PROJECT_MAP[COMPONENT_MAP[comp['name']]]
+    return list(project_queue)
+
+# The labels of an issue in every project: its type, its status while in
+# progress and the name of its epic. Returns them and the epic name.
+def issue_labels(issue):
+    labels = [ISSUE_TYPES_MAP[issue['fields']['issuetype']['name']]]
+
+    if issue['fields']['status']['statusCategory']['name'] == "In Progress":
+        labels.append(issue['fields']['status']['name'])
+
+    # Add Epic name to labels
+    epic_summary = None
+    if issue['fields'][JIRA_EPIC_FIELD]:
+        epic_summary = get_epic_summary(issue['fields'][JIRA_EPIC_FIELD])
+        labels.append(epic_summary)
+    return labels, epic_summary
+
+# The Gitlab issue for one target project, as sent to the issues API, and its labels
+def issue_data(issue, transformed, GITLAB_PROJECT_ID, replacements):
+    #build out the description
+    description = ""
+
+    #Add a link to the Jira issue in the description
+    if ADD_A_LINK:
+        description = description + "Imported from Jira issue [%(k)s](%(u)sbrowse/%(k)s)\n\n" % {'k': issue['key'], 'u': JIRA_URL}
+
+    # Add the reporter to the description
+    description = description + "Originally reported by {}\n\n".format(transformed['reporter'])
+
+    # Add the Jira sprint information to Gitlab issue description
+    if ADD_SPRINT_COMMENT and transformed['milestone_name']:
+        description = description + "Original Jira sprint name {}\n\n".format(transformed['milestone_name'])
+
+    with metrics.phase('convert'):
+        description = description + multiple_replace(issue['fields']['description'] or '', replacements)
+
+    # Add labels we have added from Jira plus project specific ones
+    newlabels = transformed['labels'] + get_project_labels(GITLAB_PROJECT_ID)
+
+    data = {
+        'assignee_ids': [transformed['assignee']],
+        'title': issue['fields']['summary'],
+        'description': description,
+        'labels': ", ".join(newlabels),
+        'created_at': issue['fields']['created']
+    }
+
+    # Issue weight
+    if JIRA_STORY_POINTS_FIELD in issue['fields'] and issue['fields'][JIRA_STORY_POINTS_FIELD]:
+        data['weight'] = STORY_POINTS_MAP[issue['fields'][JIRA_STORY_POINTS_FIELD]]
+    return data, newlabels
+
+# The note for a Jira comment. Unless the note is created as its author, the
+# author is named in it.
+def comment_body(comment, replacements, as_author=False):
+    commentbody = ""
+    if not as_author:
+        commentbody = 'Original comment by {}\n\n'.format(comment['author']['displayName'])
+    with metrics.phase('convert'):
+        return commentbody + multiple_replace(comment['body'] or '', replacements)
+
+# Create (or resume, or in delta sync mode update) the issue in a project
+# through the API, checkpointing every step
+def load_issue(issue, transformed, GITLAB_PROJECT_ID, replacements, progress):
+    data, newlabels = issue_data(issue, transformed, GITLAB_PROJECT_ID, replacements)
+    closed = transformed['closed']
+
+    # The Jira sprint, as a milestone or iteration of the project
+    iteration_id = None
+    if GITLAB_SPRINT_TYPE and transformed['milestone_name']:
+        sprint_id = get_sprint_id(GITLAB_PROJECT_ID, transformed['milestone_name'], progress)
+        if sprint_id is None:
+            progress.append("No iteration {} in project {}".format(transformed['milestone_name'], GITLAB_PROJECT_ID))
+        elif GITLAB_SPRINT_TYPE == 'milestones':
+            data['milestone_id'] = sprint_id
+        else:
+            iteration_id = sprint_id
+
+    # Act as the reporter if appropriate. sudo is passed per request
+    # rather than through a shared header, since workers run concurrently.
+    sudo = {}
+    if GITLAB_SUDO:
+        sudo['sudo'] = resolve_login(transformed['reporter'])
+
+    # Resume from the last checkpoint if the issue was already created
+    iteration_mutation = None
+    project = get_gl().projects.get(GITLAB_PROJECT_ID, lazy=True)
+    checkpoint = state.get_issue(issue['key'], GITLAB_PROJECT_ID)
+    if checkpoint and DELTA_SYNC:
+        with metrics.phase('issue_update'):
+            gl_issue = project.issues.get(checkpoint['gl_issue_iid'])
+            gl_issue_id = checkpoint['gl_issue_id']
+            gl_issue_iid = checkpoint['gl_issue_iid']
+            changes = update_issue(gl_issue, checkpoint, data, newlabels, closed)
+        if changes:
+            metrics.count('issues_updated')
+            progress.append("updated {} of {} in project {}".format(', '.join(changes), issue['key'], GITLAB_PROJECT_ID))
+        state.issue_synced(issue['key'], GITLAB_PROJECT_ID, newlabels, closed)
+        checkpoint['closed'] = closed
+    elif checkpoint:
+        gl_issue = project.issues.get(checkpoint['gl_issue_iid'], lazy=True)
+        gl_issue_id = checkpoint['gl_issue_id']
+        gl_issue_iid = checkpoint['gl_issue_iid']
+        progress.append("resuming {} in project {}".format(issue['key'], GITLAB_PROJECT_ID))
+    else:
+        with metrics.phase('issue_create'):
+            gl_issue = project.issues.create(data, **sudo)
+        metrics.count('issues_created')
+        gl_issue_id = gl_issue.id
+        gl_issue_iid = gl_issue.iid
+        state.issue_created(issue['key'], GITLAB_PROJECT_ID, gl_issue.id, gl_issue.iid, len(transformed['comments']), newlabels)
+        checkpoint = {'epic_linked': False, 'closed': False}
+        # The issues API has no iteration, it is set with the follow-up writes
+        if iteration_id is not None:
+            iteration_mutation = Mutation(
+                'issueSetIteration', 'IssueSetIterationInput',
+                {
+                    'projectPath': get_project_path(GITLAB_PROJECT_ID),
+                    'iid': str(gl_issue_iid),
+                    'iterationId': global_id('Iteration', iteration_id)
+                },
+                'issue { id }',
+                fallback=lambda: progress.append("Could not set iteration {} of {} in project {}".format(
+                    transformed['milestone_name'], issue['key'], GITLAB_PROJECT_ID))
+            )
 
-        # Here we loop through each project for the inserts since we map certain Jira
-        # components to certain projects in GL
-        for GITLAB_PROJECT_ID in project_queue:
-            # print("Project ID {}".format(GITLAB_PROJECT_ID))
-            replacements = move_attachements(issue_info['fields']['attachment'],GITLAB_PROJECT_ID)
-
-            #build out the description
-            description = ""
-
-            #Add a link to the Jira issue in the description
-            if ADD_A_LINK:
-                description = description + "\n\nImported from Jira issue [%(k)s](%(u)sbrowse/%(k)s)" % {'k': issue['key'], 'u': JIRA_URL}
-
-            # Add the reporter to the description
-            description = description + "Originally reported by {}\n\n".format(reporter)
-            
-            # Add the Jira sprint information to Gitlab issue description
-            if ADD_SPRINT_COMMENT:
-                description = description + "\n\nOriginal Jira sprint name {}".format(milestone_name)
-
-            description = multiple_replace(issue['fields']['description'], replacements)
-
-            # Add labels we have added from Jira plus project specific ones
-            newlabels = labels.copy() + get_project_labels(GITLAB_PROJECT_ID)
-
-            data = {
-                'assignee_ids': [gl_assignee],
-                'title': issue['fields']['summary'],
-                'description': description,
-                'milestone_id': milestone_id,
-                'labels': ", ".join(newlabels),
-                'created_at': issue['fields']['created']
-            }
-
-            # Issue weight
-            if JIRA_STORY_POINTS_FIELD in issue['fields'] and issue['fields'][JIRA_STORY_POINTS_FIELD]:
-                data['weight'] = STORY_POINTS_MAP[issue['fields'][JIRA_STORY_POINTS_FIELD]]
-
-            # Add issue to Gitlab
-
-            # Add sudo header if appropriate
-            if GITLAB_SUDO:
-                GITLAB_HEADERS['SUDO'] = resolve_login(reporter)
-
-            project = gl.projects.get(GITLAB_PROJECT_ID)
-            gl_issue = project.issues.create(data)
-
-            # Recreate each Jira comment in Gitlab
-            for comment in issue_info['fields']['comment']['comments']:
-                author = comment['author']['displayName']
-                commentbody = ""
-                # Add sudo header if appropriate
-                if GITLAB_SUDO:
-                    GITLAB_HEADERS['SUDO'] = resolve_login(author)
-                else:
-                    commentbody = 'Original comment by {}\n\n'.format(author)
-                commentbody = commentbody + multiple_replace(comment['body'], replacements)
-                body = {'body':commentbody}
-                comment_note = gl_issue.notes.create(body)
-
-            # If Jira has an epic associted with it, move that epic and relationship over
-            if issue['fields'][JIRA_EPIC_FIELD]:
-                # print(epic_info['fields']['summary'])
-                epic = get_epic_id(GITLAB_PROJECT_ID,epic_info['fields']['summary'])
-                ei = epic.issues.create({'issue_id':gl_issue.id})
-
-            # If the Jira issue was closed, mark the Gitlab one closed as well
-            if issue['fields']['status']['statusCategory']['key'] == "done":
-                gl_issue.state_event = 'close'
-                gl_issue.save()
-            if ISSUE_TRACKING:
-                with open(TRACKING_FILE, 'a') as tracking_file:
-                    tracking_file.write(issue['key']+'\n')
-                processed_jiras.append(issue['key'])
+    # Recreate each Jira comment in Gitlab, then the epic link and the close.
+    # Each is checkpointed once made.
+    mutations = []
+    if iteration_mutation is not None:
+        mutations.append(iteration_mutation)
+    migrated_comments = state.migrated_comments(issue['key'], GITLAB_PROJECT_ID)
+    for comment in transformed['comments']:
+        if str(comment['id']) in migrated_comments:
+            continue
+        body = {'body': comment_body(comment, replacements, as_author=GITLAB_SUDO)}
+        mutations.append(Mutation(
+            'createNote', 'CreateNoteInput',
+            {'noteableId': global_id('Issue', gl_issue_id), 'body': body['body']},
+            'note { id }',
+            done=lambda payload, comment=comment: note_created(issue['key'], GITLAB_PROJECT_ID, comment['id'],
+                                                               object_id(payload['note']['id'])),
+            fallback=partial(create_note, gl_issue, issue['key'], GITLAB_PROJECT_ID, comment, body)
+        ))
+
+    # If Jira has an epic associted with it, move that epic and relationship over
+    if issue['fields'][JIRA_EPIC_FIELD] and not checkpoint['epic_linked']:
+        with metrics.phase('epic_lookup'):
+            epic = get_epic_id(GITLAB_PROJECT_ID,transformed['epic_summary'],issue['fields'][JIRA_EPIC_FIELD])
+        mutations.append(Mutation(
+            'epicAddIssue', 'EpicAddIssueInput',
+            {
+                'groupPath': get_project_group(GITLAB_PROJECT_ID).full_path,
+                'iid': str(epic.iid),
+                'projectPath': get_project_path(GITLAB_PROJECT_ID),
+                'issueIid': str(gl_issue_iid)
+            },
+            'epicIssue { id }',
+            done=lambda payload: state.epic_linked(issue['key'], GITLAB_PROJECT_ID),
+            fallback=partial(link_epic, epic, gl_issue_id, issue['key'], GITLAB_PROJECT_ID)
+        ))
+
+    # If the Jira issue was closed, mark the Gitlab one closed as well
+    if closed and not checkpoint['closed']:
+        mutations.append(Mutation(
+            'updateIssue', 'UpdateIssueInput',
+            {'projectPath': get_project_path(GITLAB_PROJECT_ID), 'iid': str(gl_issue_iid), 'stateEvent': 'CLOSE'},
+            'issue { id }',
+            done=lambda payload: state.issue_closed(issue['key'], GITLAB_PROJECT_ID),
+            fallback=partial(close_issue, gl_issue, issue['key'], GITLAB_PROJECT_ID)
+        ))
+
+    if GITLAB_GRAPHQL and not GITLAB_SUDO:
+        with metrics.phase('graphql_write'):
+            get_graphql().mutate(mutations)
+    else:
+        for mutation in mutations:
+            mutation.fallback()
+
+# The REST calls of the follow-up writes of load_issue
+def create_note(gl_issue, key, GITLAB_PROJECT_ID, comment, body):
+    # Act as the author if appropriate
+    sudo = {}
+    if GITLAB_SUDO:
+        sudo['sudo'] = resolve_login(comment['author']['displayName'])
+    with metrics.phase('note_create'):
+        comment_note = gl_issue.notes.create(body, **sudo)
+    note_created(key, GITLAB_PROJECT_ID, comment['id'], comment_note.id)
+
+def note_created(key, GITLAB_PROJECT_ID, comment_id, note_id):
+    metrics.count('notes_created')
+    state.note_created(key, GITLAB_PROJECT_ID, comment_id, note_id)
+
+def link_epic(epic, gl_issue_id, key, GITLAB_PROJECT_ID):
+    with metrics.phase('epic_link'):
+        epic.issues.create({'issue_id':gl_issue_id})
+    state.epic_linked(key, GITLAB_PROJECT_ID)
+
+def close_issue(gl_issue, key, GITLAB_PROJECT_ID):
+    gl_issue.state_event = 'close'
+    with metrics.phase('issue_close'):
+        gl_issue.save()
+    state.issue_closed(key, GITLAB_PROJECT_ID)
+
+# Write the issue, with all of its notes, to the export archive of a project
+def export_issue(issue, transformed, GITLAB_PROJECT_ID, replacements):
+    data, newlabels = issue_data(issue, transformed, GITLAB_PROJECT_ID, replacements)
+    users_by_name = get_users()['name']
+    notes = []
+    for comment in transformed['comments']:
+        author = users_by_name.get(comment['author']['displayName'])
+        notes.append({
+            'note': comment_body(comment, replacements),
+            'created_at': comment.get('created'),
+            'author_id': author['id'] if author else None
+        })
+    reporter = users_by_name.get(transformed['reporter'])
+    with metrics.phase('export_write'):
+        exports[GITLAB_PROJECT_ID].add_issue(
+            data['title'],
+            data['description'],
+            labels=newlabels,
+            closed=transformed['closed'],
+            created_at=data['created_at'],
+            notes=notes,
+            milestone=transformed['milestone_name'],
+            weight=data.get('weight'),
+            assignee_ids=data['assignee_ids'],
+            author_id=reporter['id'] if reporter else None
+        )
+    metrics.count('issues_exported')
+    metrics.count('notes_exported', len(notes))
+
+# Attachments go in the export archive of the project instead of the uploads API
+def export_attachment(content, GL_PROJECT_ID, author):
+    return {'url': exports[GL_PROJECT_ID].add_upload(content)}
+
+# Migrate a single Jira issue to every Gitlab project its components map to.
+# Runs on a worker thread, so it returns its progress messages instead of
+# printing them.
+def migrate_issue(issue):
+    progress = ["migrating issue: {}".format(issue['fields']['summary'])]
+    transformed = transform_issue(issue, progress)
+    if transformed is None:
+        return progress
+    # Nothing to load. The issue isn't marked as migrated, so it is picked up
+    # once COMPONENT_MAP maps one of its components.
+    if not transformed['project_ids']:
+        progress.append("{} has no component mapped to a project".format(issue['key']))
+        metrics.count('issues_unmapped')
+        return progress
+    project_ids = transformed['project_ids']
+    # Delta sync only updates: a migrated issue without a checkpoint in a
+    # project (listed in TRACKING_FILE by an older version) would be created
+    # there again
+    if DELTA_SYNC and state.is_migrated(issue['key']):
+        project_ids = [project_id for project_id in project_ids if state.get_issue(issue['key'], project_id)]
+        if len(project_ids) < len(transformed['project_ids']):
+            progress.append("{} was migrated without checkpoints, it isn't synced to project {}".format(
+                issue['key'], ', '.join(str(project_id) for project_id in transformed['project_ids']
+                                        if project_id not in project_ids)))
+        if not project_ids:
+            metrics.count('issues_skipped')
+            return progress
+
+    # Attachments are downloaded once and uploaded to every target project
+    project_replacements = move_attachements(
+        issue['fields']['attachment'] or [],
+        project_ids,
+        export_attachment if OUTPUT_BACKEND == 'export' else upload_attachment
+    )
+
+    # Here we loop through each project for the inserts since we map certain Jira
+    # components to certain projects in GL
+    for GITLAB_PROJECT_ID in project_ids:
+        replacements = project_replacements[GITLAB_PROJECT_ID]
+        if OUTPUT_BACKEND == 'export':
+            export_issue(issue, transformed, GITLAB_PROJECT_ID, replacements)
+        else:
+            load_issue(issue, transformed, GITLAB_PROJECT_ID, replacements, progress)
+
+    if OUTPUT_BACKEND == 'api':
+        state.mark_migrated(issue['key'])
+    metrics.count('issues_migrated')
+    return progress
+
+# Extract stage: an issue with all of its comments, its attachments saved to
+# SNAPSHOT_ATTACHMENT_DIR. Runs on a worker thread.
+def extract_issue(issue):
+    with metrics.phase('jira_comments'):
+        comments = get_comments(issue)
+    issue['fields']['comment'] = {
+        'comments': comments,
+        'startAt': 0,
+        'maxResults': len(comments),
+        'total': len(comments)
+    }
+    if SNAPSHOT_ATTACHMENTS:
+        for attachment in issue['fields']['attachment'] or []:
+            with metrics.phase('attachment_download'):
+                save_attachment(attachment)
+            metrics.count('attachments_downloaded')
+    metrics.count('issues_extracted')
+    return issue
+
+# Files are named by content, so duplicates are stored once. They are written
+# to a temporary name and renamed, a file that exists is complete.
+def save_attachment(attachment):
+    content, sha256 = download_attachment(attachment)
+    path = os.path.join(SNAPSHOT_ATTACHMENT_DIR, sha256)
+    with content:
+        if not os.path.exists(path):
+            content.seek(0)
+            with open(path + '.tmp', 'wb') as snapshot_file:
+                while True:
+                    chunk = content.read(ATTACHMENT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    snapshot_file.write(chunk)
+            os.replace(path + '.tmp', path)
+    attachment['sha256'] = sha256
+    attachment['snapshot_file'] = path
+
+# Write an extracted issue to the snapshot, after the summary of its epic
+snapshot_epics = set()
+
+def write_snapshot_issue(snapshot, issue):
+    epic_key = issue['fields'].get(JIRA_EPIC_FIELD)
+    if epic_key and epic_key not in snapshot_epics:
+        snapshot.write('epic', {'key': epic_key, 'summary': get_epic_summary(epic_key)})
+        snapshot_epics.add(epic_key)
+    snapshot.write('issue', issue)
+
+# Load stage: the issues of the snapshot, in search order. The epic records
+# ahead of them fill the epic summaries, so no Jira lookup is needed.
+def snapshot_issues(path):
+    for kind, record in read_snapshot(path):
+        if kind == 'epic':
+            epic_summaries[record['key']] = record['summary']
+        elif kind == 'issue':
+            yield record
+
+# Hand the results of finished work to handle, in submission order. With
+# wait=True, block on the oldest item still in flight.
+def drain(in_flight, handle, wait=False):
+    while in_flight and (wait or in_flight[0].done()):
+        handle(in_flight.popleft().result())
+        wait = False
+
+def print_progress(progress):
+    for line in progress:
+        print(line)
+
+# The delta search: DELTA_JQL limited to the issues updated since the
+# watermark. JQL dates are read in the timezone of the Jira user, a relative
+# "-Nm" doesn't depend on it. The pages are ordered by key, which edits don't
+# change: ordered by updated, an issue edited during the run moves to the last
+# page and the issues after it shift back a place, so one of them is missed.
+def delta_jql(watermark):
+    jql = '(%s)' % (DELTA_JQL or 'project=%s' % JIRA_PROJECT)
+    if watermark is not None:
+        minutes = int((time.time() - watermark) / 60) + 1 + DELTA_SYNC_MARGIN
+        jql = jql + '+AND+updated>=-%dm' % minutes
+    return jql + '+ORDER+BY+key+ASC'
+
+# One export archive per target project
+exports = {}
+
+def open_exports():
+    if DELTA_SYNC:
+        raise SystemExit("DELTA_SYNC updates issues through the API, it needs OUTPUT_BACKEND = 'api'")
+    if not os.path.isdir(EXPORT_DIR):
+        os.makedirs(EXPORT_DIR)
+    for name, project_id in PROJECT_MAP.items():
+        exports[project_id] = ProjectExport(
+            os.path.join(EXPORT_DIR, '%s.tar.gz' % name),
+            name,
+            'Imported from Jira project %s' % JIRA_PROJECT
+        )
+
+# Jira API documentation : https://developer.atlassian.com/static/rest/jira/6.1.html
+# Issues are handed to a pool of MIGRATION_WORKERS workers. At most twice that
+# many are in flight, so memory stays bounded however large the search is.
+def extract(jql, started):
+    if SNAPSHOT_ATTACHMENTS and not os.path.isdir(SNAPSHOT_ATTACHMENT_DIR):
+        os.makedirs(SNAPSHOT_ATTACHMENT_DIR)
+    snapshot = SnapshotWriter(SNAPSHOT_FILE, {
+        'jira_url': JIRA_URL,
+        'jql': jql,
+        'fields': JIRA_SEARCH_FIELDS,
+        'started': started
+    })
+    write_issue = partial(write_snapshot_issue, snapshot)
+    with ThreadPoolExecutor(max_workers=MIGRATION_WORKERS) as workers:
+        in_flight = deque()
+        for issue in search_issues(jql):
+            in_flight.append(workers.submit(extract_issue, issue))
+            drain(in_flight, write_issue, wait=len(in_flight) > MIGRATION_WORKERS * 2)
+        while in_flight:
+            drain(in_flight, write_issue, wait=True)
+    with metrics.phase('snapshot_write'):
+        snapshot.close({'finished': time.time()})
+    print("Wrote {} issues to {}".format(snapshot.counts['issue'], SNAPSHOT_FILE))
+
+def load(issues, started):
+    migrate_issues(issues, print_progress)
+
+    # Only reached when every issue went through
+    if OUTPUT_BACKEND == 'export':
+        for project_id, export in exports.items():
+            with metrics.phase('export_pack'):
+                export.close()
+            print("Wrote {} issues to {}".format(export.issues, export.path))
+    else:
+        state.set_meta('watermark', repr(started))
+
+# Migrate the issues, handing the progress of each one to handle
+def migrate_issues(issues, handle):
+    with ThreadPoolExecutor(max_workers=MIGRATION_WORKERS) as workers:
+        in_flight = deque()
+        for issue in issues:
+            if OUTPUT_BACKEND == 'api' and not DELTA_SYNC and state.is_migrated(issue['key']):
+                skipped = Future()
+                skipped.set_result(["{} is already imported".format(issue['key'])])
+                in_flight.append(skipped)
+                metrics.count('issues_skipped')
+            else:
+                in_flight.append(workers.submit(migrate_issue, issue))
+            drain(in_flight, handle, wait=len(in_flight) > MIGRATION_WORKERS * 2)
+        while in_flight:
+            drain(in_flight, handle, wait=True)
+
+# Sharded runs. The JQL is cut into ranges that don't overlap and together
+# cover everything it matches: the first and last ranges are open ended, so
+# issues created after the plan are in a shard too.
+ORDER_BY = re.compile(r'[+\s]+ORDER[+\s]+BY[+\s]+', re.IGNORECASE)
+
+# The first and last issue of the JQL by field, or None if it matches nothing
+def jql_bounds(jql, field):
+    bounds = []
+    for direction in ('ASC', 'DESC'):
+        page = fetch_search_page('%s+ORDER+BY+%s+%s' % (jql, field, direction), fields='created')
+        if not page.get('issues'):
+            return None
+        bounds.append(page['issues'][0])
+    return bounds
+
+# At most SHARD_COUNT points that cut first..last (numbers) in equal ranges
+def cut_points(first, last):
+    step = (last - first + 1) / float(SHARD_COUNT)
+    cuts = set(first + int(round(step * i)) for i in range(1, SHARD_COUNT))
+    return sorted(cut for cut in cuts if first < cut <= last)
+
+# (label, JQL condition) of every range between the cut points
+def range_shards(field, cuts, label):
+    if not cuts:
+        return [('all', None)]
+    shards = [('%s < %s' % (field, label(cuts[0])), '%s<%s' % (field, label(cuts[0])))]
+    for start, end in zip(cuts, cuts[1:]):
+        shards.append(('%s..%s' % (label(start), label(end)),
+                       '%s>=%s+AND+%s<%s' % (field, label(start), field, label(end))))
+    shards.append(('%s >= %s' % (field, label(cuts[-1])), '%s>=%s' % (field, label(cuts[-1]))))
+    return shards
+
+def key_shards(first, last):
+    project, first_number = first['key'].rsplit('-', 1)
+    last_project, last_number = last['key'].rsplit('-', 1)
+    if project != last_project:
+        raise SystemExit("SHARD_BY = 'key' needs the JQL of a single Jira project, use 'created' or 'component'")
+    cuts = cut_points(int(first_number), int(last_number))
+    return range_shards('key', cuts, lambda number: '%s-%d' % (project, number))
+
+# Days, in the format JQL reads without quotes
+def created_shards(first, last):
+    first_day = datetime.strptime(first['fields']['created'][:10], '%Y-%m-%d').toordinal()
+    last_day = datetime.strptime(last['fields']['created'][:10], '%Y-%m-%d').toordinal()
+    cuts = cut_points(first_day, last_day)
+    return range_shards('created', cuts, lambda day: datetime.fromordinal(day).strftime('%Y-%m-%d'))
+
+# An issue with several components goes to the shard of the first one
+def component_shards():
+    components = sorted(COMPONENT_MAP)
+    names = ['"%s"' % component.replace(' ', '+') for component in components]
+    shards = []
+    for i, name in enumerate(names):
+        condition = 'component=%s' % name
+        if i:
+            condition += '+AND+component+not+in+(%s)' % ','.join(names[:i])
+        shards.append((components[i], condition))
+    shards.append(('other components', '(component+is+EMPTY+OR+component+not+in+(%s))' % ','.join(names)))
+    return shards
+
+def plan_shards(jql):
+    parts = ORDER_BY.split(jql, 1)
+    where = '(%s)' % parts[0]
+    order = '+ORDER+BY+' + parts[1] if len(parts) > 1 else ''
+    if SHARD_BY == 'component':
+        conditions = component_shards()
+    else:
+        bounds = jql_bounds(where, SHARD_BY)
+        if bounds is None:
+            return []
+        conditions = key_shards(*bounds) if SHARD_BY == 'key' else created_shards(*bounds)
+    return [
+        (label, where + order if condition is None else '%s+AND+%s%s' % (where, condition, order))
+        for label, condition in conditions
+    ]
+
+# The ledger of a sharded run, and the name this process has in it
+ledger = None
+worker_name = None
+# The shard this worker is on: its ledger row, the issues done and an event
+# set when the shard was given to another worker
+current_shard = None
+
+# Tell the ledger this worker is alive and how far it got. The rate limiters
+# take their part of the server budget, shared by the live workers.
+def send_heartbeat():
+    shard = current_shard
+    with metrics.lock:
+        items = dict(metrics.items)
+    if shard is None:
+        ledger.heartbeat(worker_name, items=items)
+    elif not ledger.heartbeat(worker_name, shard['id'], shard['issues'], items):
+        shard['lost'].set()
+    shares = ledger.live_workers()
+    for limiter in metrics.limiters.values():
+        limiter.shares = shares
+
+def send_heartbeats(stopped):
+    while not stopped.wait(SHARD_HEARTBEAT):
+        try:
+            send_heartbeat()
+        except sqlite3.Error as e:
+            # The next one may get through before the lease runs out
+            print("Heartbeat failed: {}".format(e))
+
+# A worker that took too long to send its heartbeat stops at the next issue,
+# the new owner of the shard migrates the rest
+def shard_issues(shard):
+    for issue in search_issues(shard['jql']):
+        if shard['lost'].is_set():
+            return
+        yield issue
+
+def shard_progress(shard, progress):
+    print_progress(progress)
+    shard['issues'] += 1
+
+# Migrate one shard after another until none is left to claim. A shard that
+# fails is given back, to be tried again by any worker.
+def work_shards():
+    global current_shard
+    send_heartbeat()
+    stopped = threading.Event()
+    heartbeats = threading.Thread(target=send_heartbeats, args=(stopped,), daemon=True)
+    heartbeats.start()
+    failed = 0
+    try:
+        while True:
+            shard = ledger.claim(worker_name)
+            if shard is None:
+                break
+            shard.update(issues=0, lost=threading.Event())
+            current_shard = shard
+            print("Shard {} ({}), attempt {}".format(shard['id'], shard['label'], shard['attempts']))
+            try:
+                migrate_issues(shard_issues(shard), partial(shard_progress, shard))
+            except Exception as e:
+                failed += 1
+                ledger.fail(shard['id'], worker_name, repr(e))
+                print("Shard {} failed: {!r}".format(shard['id'], e))
+                continue
+            except BaseException:
+                ledger.fail(shard['id'], worker_name, 'interrupted')
+                raise
+            if shard['lost'].is_set():
+                print("Shard {} was given to another worker".format(shard['id']))
+                continue
+            metrics.count('shards_done')
+            if ledger.finish(shard['id'], worker_name, shard['issues']) == 0:
+                # The last shard: the next delta sync starts at the plan
+                state.set_meta('watermark', repr(ledger.get_meta('started')))
+    finally:
+        current_shard = None
+        stopped.set()
+        heartbeats.join()
+        send_heartbeat()
+    print("No shard left for {}, {} failed".format(worker_name, failed))
+
+def print_shard_status():
+    status = ledger.status()
+    print("Shards: {}, {} issues done".format(
+        ', '.join('{} {}'.format(count, name) for name, count in sorted(status['statuses'].items())) or 'none',
+        status['issues']
+    ))
+    for shard in status['shards']:
+        print("{id:>5} {status:<8} {issues:>7} issues  attempt {attempts}  {label}  {worker}".format(
+            **dict(shard, worker=shard['worker'] or '')))
+        if shard['error'] and shard['status'] != 'done':
+            print("      {}".format(shard['error']))
+    for worker in status['workers']:
+        print("Worker {} {}, last heartbeat {:.0f}s ago".format(
+            worker['name'], 'alive' if worker['alive'] else 'gone', time.time() - worker['heartbeat']))
+    for item, count in sorted(status['items'].items()):
+        print("{:>10} {}".format(count, item))
+
+def run_shards(jql, started):
+    if SHARD_ROLE == 'plan':
+        shards = plan_shards(jql)
+        if not ledger.plan(shards, {'jql': jql, 'started': started, 'shard_by': SHARD_BY}):
+            raise SystemExit('%s already has the shards of a run, use another SHARD_LEDGER' % SHARD_LEDGER)
+        for label, shard_jql in shards:
+            print("{}: {}".format(label, shard_jql))
+        print("Planned {} shards in {}".format(len(shards), SHARD_LEDGER))
+    else:
+        work_shards()
+
+# Apply a configuration: the defaults updated with settings, by name. The
+# clients and caches of the previous one are dropped, so one process can run
+# several configurations one after the other.
+def configure(settings=None):
+    global WIKI_STAGES, ledger
+    settings = dict(settings or {})
+    # Config files only have string keys
+    if 'STORY_POINTS_MAP' in settings:
+        settings['STORY_POINTS_MAP'] = dict(
+            (float(points), weight) for points, weight in settings['STORY_POINTS_MAP'].items()
+        )
+    apply_settings(globals(), DEFAULTS, settings)
+    if PIPELINE_STAGE not in ('all', 'extract', 'load'):
+        raise SystemExit("PIPELINE_STAGE must be 'all', 'extract' or 'load'")
+    if SHARD_ROLE not in (None, 'plan', 'work', 'status'):
+        raise SystemExit("SHARD_ROLE must be None, 'plan', 'work' or 'status'")
+    if SHARD_BY not in ('key', 'created', 'component'):
+        raise SystemExit("SHARD_BY must be 'key', 'created' or 'component'")
+    if SHARD_ROLE and (OUTPUT_BACKEND != 'api' or PIPELINE_STAGE != 'all'):
+        raise SystemExit("Sharded runs need OUTPUT_BACKEND = 'api' and PIPELINE_STAGE = 'all'")
+    if GITLAB_SPRINT_TYPE not in (None, 'milestones', 'iterations'):
+        raise SystemExit("GITLAB_SPRINT_TYPE must be None, 'milestones' or 'iterations'")
+    if DELTA_SYNC and not ISSUE_TRACKING:
+        raise SystemExit("DELTA_SYNC needs ISSUE_TRACKING, it updates the issues TRACKING_DB has checkpoints of")
+    WIKI_STAGES = wiki_stages()
+    ledger = None
+    for cache in (clients, users, epic_summaries, project_groups, project_paths, group_epics, sprints,
+                  uploaded_attachments, snapshot_epics, exports):
+        cache.clear()
+
+# Run the migration (or the stage of it) of the current configuration
+def run():
+    global metrics, state, ledger, worker_name
+    if SHARD_ROLE:
+        ledger = ShardLedger(SHARD_LEDGER, SHARD_LEASE, SHARD_ATTEMPTS)
+        worker_name = WORKER_NAME or '%s-%d' % (socket.gethostname(), os.getpid())
+        if SHARD_ROLE == 'status':
+            print_shard_status()
+            return
+    metrics = Metrics('jira2gitlab', METRICS_JSON_FILE, METRICS_PROM_FILE, METRICS_INTERVAL).start()
+    # The sessions report to the metrics they were made with
+    with clients_lock:
+        clients.clear()
+    # Metrics are written on the way out, also when the run fails
+    try:
+        state = open_state()
+        load_uploaded_attachments()
+        if OUTPUT_BACKEND == 'export' and PIPELINE_STAGE != 'extract':
+            open_exports()
+
+        # Changes made in Jira while this run is going are picked up by the
+        # next one. A load uses the time its snapshot was started.
+        started = time.time()
+        if PIPELINE_STAGE == 'load':
+            snapshot_header = read_header(SNAPSHOT_FILE)
+            started = snapshot_header['started']
+            jql = snapshot_header['jql']
+        elif DELTA_SYNC:
+            watermark = state.get_meta('watermark')
+            jql = delta_jql(float(watermark) if watermark else None)
+        else:
+            jql = JQL or 'project=%s+AND+(resolution=Unresolved+OR+Sprint+in+openSprints())+ORDER+BY+createdDate+ASC' % JIRA_PROJECT
+
+        if SHARD_ROLE:
+            run_shards(jql, started)
+        elif PIPELINE_STAGE == 'extract':
+            extract(jql, started)
+        elif PIPELINE_STAGE == 'load':
+            load(snapshot_issues(SNAPSHOT_FILE), started)
+        else:
+            load(search_issues(jql), started)
+    finally:
+        metrics.stop()
+
+def main(argv=None):
+    parser = argument_parser('Migrate the issues of a Jira project to Gitlab.')
+    parser.add_argument('--stage', choices=('all', 'extract', 'load'), help='sets PIPELINE_STAGE')
+    parser.add_argument('--shards', choices=('plan', 'work', 'status'), help='sets SHARD_ROLE')
+    parser.add_argument('--convert', metavar='FILE',
+                        help="print the Gitlab markdown of a file of Jira markup ('-' for stdin) and exit")
+    args = parser.parse_args(argv)
+    settings = read_settings(args)
+    if args.stage:
+        settings['PIPELINE_STAGE'] = args.stage
+    if args.shards:
+        settings['SHARD_ROLE'] = args.shards
+    configure(settings)
+    if args.convert:
+        if args.convert == '-':
+            text = sys.stdin.read()
+        else:
+            with open(args.convert, 'r') as markup:
+                text = markup.read()
+        sys.stdout.write(multiple_replace(text, []))
+        return 0
+    run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import argparse
+import ast
+import copy
+import json
+import os
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Settings of the migration scripts from config files and the command line.
+# The settings keep their names and defaults in the scripts; a config file
+# sets any of them by name, e.g. in YAML:
+#
+#   JIRA_URL: https://example.atlassian.net/
+#   JIRA_ACCOUNT: [jira_account, jira_password]
+#   PROJECT_MAP: {frontend: 12345678, backend: 87654321}
+#
+# or the same in TOML or JSON. JSON always works, TOML needs Python 3.11 (or
+# the tomli package) and YAML needs PyYAML.
+
+
+def load_config(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        with open(path, 'r') as config_file:
+            settings = json.load(config_file)
+    elif extension == '.toml':
+        if tomllib is None:
+            raise SystemExit('%s: TOML config files need Python 3.11 or the tomli package' % path)
+        with open(path, 'rb') as config_file:
+            settings = tomllib.load(config_file)
+    elif extension in ('.yaml', '.yml'):
+        if yaml is None:
+            raise SystemExit('%s: YAML config files need the PyYAML package' % path)
+        with open(path, 'r') as config_file:
+            settings = yaml.safe_load(config_file) or {}
+    else:
+        raise SystemExit('%s: unknown config format, use .json, .toml or .yaml' % path)
+    if not isinstance(settings, dict):
+        raise SystemExit('%s: expected a mapping of settings' % path)
+    return settings
+
+
+# NAME=VALUE, the value read as a Python literal or else kept as a string
+def parse_setting(setting):
+    name, separator, value = setting.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError('expected NAME=VALUE, got %r' % setting)
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--config', action='append', default=[], metavar='FILE',
+                        help='settings file (.json, .toml or .yaml); later files win')
+    parser.add_argument('--set', action='append', default=[], type=parse_setting, metavar='NAME=VALUE',
+                        help='override one setting, e.g. --set MIGRATION_WORKERS=8')
+    return parser
+
+
+# The settings given on a command line: its config files, then its --set
+def read_settings(args):
+    settings = {}
+    for path in args.config:
+        settings.update(load_config(path))
+    settings.update(args.set)
+    return settings
+
+
+# The settings of a script, the upper case names set before any other code
+def script_defaults(namespace):
+    return copy.deepcopy(dict((name, value) for name, value in namespace.items() if name.isupper()))
+
+
+# Reset the settings of a script to its defaults, then apply the given ones.
+# Unknown names are refused, a typo would otherwise go unnoticed.
+def apply_settings(namespace, defaults, settings):
+    unknown = sorted(set(settings) - set(defaults))
+    if unknown:
+        raise SystemExit('Unknown settings: %s' % ', '.join(unknown))
+    for name, value in defaults.items():
+        namespace[name] = copy.deepcopy(value)
+    namespace.update(copy.deepcopy(settings))
@@ -0,0 +1,146 @@
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import uuid
+
+# Gitlab project export archives, for the file based project import
+# (New project > Import project > Gitlab export, or POST /projects/import).
+# Importing an archive creates all of its issues, notes, labels, milestones
+# and uploads at once, instead of one API call per object.
+#
+# The archive is the ndjson tree Gitlab exports since 13.x:
+#   VERSION
+#   tree/project.json
+#   tree/project/issues.ndjson      one issue per line, with its notes and labels
+#   tree/project/labels.ndjson
+#   tree/project/milestones.ndjson
+#   uploads/<secret>/<file>         referenced as /uploads/<secret>/<file>
+# Relations without a file (merge requests, members, ...) are imported empty.
+# Authors and assignees are only kept when the importing instance knows the
+# users; otherwise Gitlab credits the importer and names the original author.
+
+EXPORT_VERSION = '0.2.4'
+LABEL_COLOR = '#428BCA'
+
+# 2020-01-31T10:00:00.000+0100 (Jira) -> 2020-01-31T10:00:00.000+01:00
+JIRA_TIMEZONE = re.compile(r'([+-]\d\d)(\d\d)$')
+
+
+def gitlab_time(timestamp):
+    if not timestamp:
+        return None
+    return JIRA_TIMEZONE.sub(r'\1:\2', timestamp)
+
+
+# One archive, written to a work directory while issues are added and packed
+# when closed, so memory use doesn't grow with the number of issues.
+# Safe to use from several threads.
+class ProjectExport(object):
+    def __init__(self, path, name, description=''):
+        self.path = path
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.workdir = tempfile.mkdtemp(prefix='gitlab-export-')
+        self.tree = os.path.join(self.workdir, 'tree', 'project')
+        os.makedirs(self.tree)
+        self.issues_file = open(os.path.join(self.tree, 'issues.ndjson'), 'w', encoding='utf-8')
+        self.labels = {}
+        self.milestones = {}
+        self.issues = 0
+
+    # Copy a file into the archive. Returns the URL to use in markdown.
+    def add_upload(self, fileobj, filename=None):
+        secret = uuid.uuid4().hex
+        filename = re.sub(r'[^\w.-]', '_', filename or str(uuid.uuid4()))
+        directory = os.path.join(self.workdir, 'uploads', secret)
+        os.makedirs(directory)
+        fileobj.seek(0)
+        with open(os.path.join(directory, filename), 'wb') as upload:
+            shutil.copyfileobj(fileobj, upload)
+        return '/uploads/%s/%s' % (secret, filename)
+
+    def label_link(self, title):
+        if title not in self.labels:
+            self.labels[title] = {
+                'title': title,
+                'color': LABEL_COLOR,
+                'description': None,
+                'type': 'ProjectLabel'
+            }
+        return {'target_type': 'Issue', 'label': self.labels[title]}
+
+    def milestone(self, title):
+        if title not in self.milestones:
+            self.milestones[title] = {
+                'iid': len(self.milestones) + 1,
+                'title': title,
+                'state': 'active'
+            }
+        return self.milestones[title]
+
+    # notes are dicts with 'note', 'created_at' and optionally 'author_id'.
+    # Returns the iid of the issue in the project.
+    def add_issue(self, title, description, labels=(), closed=False, created_at=None, notes=(),
+                  milestone=None, weight=None, assignee_ids=(), author_id=None):
+        created_at = gitlab_time(created_at)
+        with self.lock:
+            self.issues += 1
+            issue = {
+                'iid': self.issues,
+                'title': title,
+                'description': description,
+                'state': 'closed' if closed else 'opened',
+                'created_at': created_at,
+                'updated_at': created_at,
+                'confidential': False,
+                'author_id': author_id,
+                'weight': weight,
+                'label_links': [self.label_link(label) for label in labels],
+                'issue_assignees': [{'user_id': user_id} for user_id in assignee_ids if user_id],
+                'notes': [
+                    {
+                        'note': note['note'],
+                        'noteable_type': 'Issue',
+                        'author_id': note.get('author_id'),
+                        'created_at': gitlab_time(note.get('created_at')) or created_at,
+                        'updated_at': gitlab_time(note.get('created_at')) or created_at,
+                        'system': False
+                    } for note in notes
+                ]
+            }
+            if milestone:
+                issue['milestone'] = self.milestone(milestone)
+            self.issues_file.write(json.dumps(issue) + '\n')
+            return issue['iid']
+
+    def write_ndjson(self, name, records):
+        with open(os.path.join(self.tree, name), 'w', encoding='utf-8') as output:
+            for record in records:
+                output.write(json.dumps(record) + '\n')
+
+    # Write the remaining files and pack the archive
+    def close(self):
+        with self.lock:
+            self.issues_file.close()
+            self.write_ndjson('labels.ndjson', self.labels.values())
+            self.write_ndjson('milestones.ndjson', self.milestones.values())
+            with open(os.path.join(self.workdir, 'tree', 'project.json'), 'w', encoding='utf-8') as project:
+                json.dump({
+                    'description': self.description,
+                    'visibility_level': 0,
+                    'archived': False,
+                    'issues_enabled': True
+                }, project)
+            with open(os.path.join(self.workdir, 'VERSION'), 'w') as version:
+                version.write(EXPORT_VERSION)
+
+            with tarfile.open(self.path + '.tmp', 'w:gz') as archive:
+                for entry in sorted(os.listdir(self.workdir)):
+                    archive.add(os.path.join(self.workdir, entry), arcname=entry)
+            os.replace(self.path + '.tmp', self.path)
+            shutil.rmtree(self.workdir)
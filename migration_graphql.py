@@ -0,0 +1,111 @@
+# Gitlab GraphQL mutations, sent in batches. The mutations of a batch go in one
+# request as aliased fields of a single mutation operation, which Gitlab runs
+# one after the other, in order:
+#
+#   mutation($m0: CreateNoteInput!, $m1: UpdateIssueInput!) {
+#     m0: createNote(input: $m0) { note { id } errors }
+#     m1: updateIssue(input: $m1) { issue { id } errors }
+#   }
+#
+# A mutation that fails (errors in its payload, or no payload) falls back to
+# its REST call, after the rest of its batch. If the server rejects the whole
+# document nothing in it ran and every mutation of the batch falls back. When
+# it was rejected for a mutation or type the schema doesn't have (an older
+# Gitlab) the next batches fall back too; other rejections, like an invalid
+# input, only cost their own batch. A throttled batch (429) didn't run either
+# and falls back on its own. A server error (5xx) can come after some of the
+# mutations ran, replaying them through REST could make them twice, so it is
+# raised like a failed REST call. Connection failures are retried by the
+# session, a POST only when nothing was sent.
+
+GID_PREFIX = 'gid://gitlab/'
+
+# Errors of a document using a mutation, type or argument the schema doesn't
+# have
+SCHEMA_ERRORS = ("doesn't exist on type", 'No such type', "doesn't accept argument")
+
+
+def global_id(kind, object_id):
+    return '%s%s/%s' % (GID_PREFIX, kind, object_id)
+
+
+# gid://gitlab/Note/123 -> 123
+def object_id(gid):
+    return int(gid.rsplit('/', 1)[1])
+
+
+def unknown_schema(errors):
+    return any(marker in (error.get('message') or '') for error in errors for marker in SCHEMA_ERRORS)
+
+
+# field(input: $alias) { selection errors }, with input_type the GraphQL type
+# of input. done gets the payload of the mutation, fallback makes the same
+# change through REST.
+class Mutation(object):
+    def __init__(self, field, input_type, input, selection, done=None, fallback=None):
+        self.field = field
+        self.input_type = input_type
+        self.input = input
+        self.selection = selection
+        self.done = done
+        self.fallback = fallback
+
+
+class GraphQLClient(object):
+    def __init__(self, session, url, batch_size=20, metrics=None):
+        self.session = session
+        self.url = url
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.available = True
+
+    # Run mutations in batches of batch_size, in order
+    def mutate(self, mutations):
+        for start in range(0, len(mutations), self.batch_size):
+            batch = mutations[start:start + self.batch_size]
+            if self.available:
+                failed = self.send(batch)
+            else:
+                failed = batch
+            for mutation in failed:
+                if self.metrics:
+                    self.metrics.count('graphql_fallbacks')
+                mutation.fallback()
+
+    # Send one batch. Returns the mutations that didn't go through.
+    def send(self, batch):
+        variables = {}
+        arguments = []
+        fields = []
+        for i, mutation in enumerate(batch):
+            alias = 'm%d' % i
+            variables[alias] = mutation.input
+            arguments.append('$%s: %s!' % (alias, mutation.input_type))
+            fields.append('%s: %s(input: $%s) { %s errors }' % (alias, mutation.field, alias, mutation.selection))
+        document = 'mutation(%s) {\n%s\n}' % (', '.join(arguments), '\n'.join(fields))
+
+        response = self.session.post(self.url, json={'query': document, 'variables': variables})
+        if self.metrics:
+            self.metrics.count('graphql_requests')
+        if response.status_code == 429:
+            # Throttled before anything ran; the REST calls wait on their own
+            return batch
+        response.raise_for_status()
+        reply = response.json()
+        if self.metrics:
+            self.metrics.count('graphql_mutations', len(batch))
+        data = reply.get('data')
+        if not data:
+            # Rejected before anything ran
+            if unknown_schema(reply.get('errors') or []):
+                self.available = False
+            return batch
+
+        failed = []
+        for i, mutation in enumerate(batch):
+            payload = data.get('m%d' % i)
+            if payload is None or payload.get('errors'):
+                failed.append(mutation)
+            elif mutation.done:
+                mutation.done(payload)
+        return failed
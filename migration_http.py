@@ -0,0 +1,226 @@
+import random
+import threading
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared HTTP plumbing for the migration scripts. Each remote (Jira, Aha!,
+# Gitlab) gets one session, so connections are kept alive and reused across
+# requests and threads instead of doing a TCP + TLS handshake for every call.
+
+# Server errors that are retried at the transport level. Non idempotent
+# requests (POST) are only retried when the connection itself failed.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Base delay (seconds) of the exponential backoff between retries
+RETRY_BACKOFF = 0.5
+
+
+# Statuses telling the client to slow down
+THROTTLE_STATUSES = (429, 503)
+
+# Longest pause (seconds) after a throttled response without Retry-After
+MAX_BACKOFF = 60
+
+
+# Seconds from now until a Retry-After / RateLimit-Reset value: a number of
+# seconds, an epoch timestamp (Gitlab), an HTTP date or an ISO 8601 time (Jira)
+def seconds_until(value, now=None):
+    if value is None:
+        return None
+    now = time.time() if now is None else now
+    try:
+        number = float(value)
+        return max(number - now, 0) if number > 1e9 else max(number, 0)
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        try:
+            moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if moment is None or moment.tzinfo is None:
+        return None
+    return max(moment.timestamp() - now, 0)
+
+
+def header(response, *names):
+    for name in names:
+        if name in response.headers:
+            return response.headers[name]
+    return None
+
+
+# Token bucket shared by every thread talking to one remote. Requests take a
+# token and wait when there is none. The rate adapts to the server:
+# - when it reports the requests left in its window (RateLimit-Remaining and
+#   RateLimit-Reset), the rate is set to spread them over the rest of the window
+# - on 429 / 503 everyone pauses for Retry-After (or an exponential backoff)
+#   plus jitter, and the rate is lowered
+# - otherwise it creeps back up by about `increase` requests per second every
+#   second, up to max_rate
+class RateLimiter(object):
+    def __init__(self, rate, max_rate=None, min_rate=0.1, increase=1.0, decrease=0.5, jitter=0.25):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate) if max_rate else float('inf')
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.failures = 0
+        # Processes sharing the limit of the server, e.g. the workers of a
+        # sharded migration. Each one takes its part of what the RateLimit
+        # headers allow.
+        self.shares = 1
+        # Called with (reason, seconds) for every wait, e.g. to record metrics
+        self.observer = None
+
+    # Add the tokens earned since the last update. Up to a second worth of
+    # requests can go out at once.
+    def refill(self, now):
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take a token, sleeping until one is available. Returns the time waited.
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            paused = now < self.paused_until
+        if delay > 0:
+            time.sleep(delay)
+            if self.observer:
+                self.observer('rate_limit' if paused else 'throttle', delay)
+        return delay
+
+    def update(self, response):
+        if response.status_code in THROTTLE_STATUSES:
+            self.throttled(seconds_until(header(response, 'Retry-After')))
+            return
+
+        remaining = header(response, 'RateLimit-Remaining', 'X-RateLimit-Remaining')
+        reset = seconds_until(header(response, 'RateLimit-Reset', 'X-RateLimit-Reset'))
+        try:
+            remaining = float(remaining) if remaining is not None else None
+        except ValueError:
+            remaining = None
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.failures = 0
+            rate = self.rate + self.increase / self.rate
+            if remaining is not None and reset is not None:
+                shares = max(self.shares, 1)
+                if remaining < shares:
+                    # The window is used up (or nearly, with other processes
+                    # sharing it): wait for the reset at the current rate
+                    # instead of crawling at a rate of nothing
+                    self.pause(now, now + reset)
+                    return
+                rate = remaining / max(reset, 0.1) / shares
+            self.rate = min(max(rate, self.min_rate), self.max_rate)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.failures += 1
+            if retry_after is None:
+                retry_after = min(2 ** (self.failures - 1), MAX_BACKOFF)
+            retry_after *= 1 + random.random() * self.jitter
+            now = time.monotonic()
+            self.refill(now)
+            # Requests in flight together are throttled together, that
+            # counts as one slow down
+            if now >= self.paused_until:
+                self.rate = max(self.rate * self.decrease, self.min_rate)
+            self.pause(now, now + retry_after)
+
+    # Hold every request until `until`. The pause is a debt of tokens: the next
+    # request waits it out and the ones after it still go out one by one.
+    # Called with the lock held.
+    def pause(self, now, until):
+        if until > self.paused_until:
+            self.tokens = min(self.tokens, 0.0) - (until - max(self.paused_until, now)) * self.rate
+            self.paused_until = until
+
+
+# requests has no session wide timeout, so the adapter fills it in for every
+# request that doesn't set its own. With a limiter, every request waits for
+# its turn, and requests rejected with a 429 are sent again (up to
+# rate_retries times) once the limiter lets them.
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, timeout=None, limiter=None, rate_retries=5, **kwargs):
+        self.timeout = timeout
+        self.limiter = limiter
+        self.rate_retries = rate_retries
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.limiter is None:
+            return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            response = super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+            self.limiter.update(response)
+            # A 429 was rejected before doing anything, so any method can be
+            # sent again. Streamed bodies can't be replayed.
+            if response.status_code != 429 or attempt >= self.rate_retries or not replayable(request.body):
+                return response
+            response.close()
+            attempt += 1
+
+
+def replayable(body):
+    return body is None or isinstance(body, (bytes, str)) or hasattr(body, '__len__')
+
+
+# Build a pooled keep-alive session for one remote.
+# pool_size should be at least the number of threads using the session.
+# retry_statuses replaces RETRY_STATUSES for the transport level retries.
+# rate (requests per second) adds a RateLimiter, available as session.limiter,
+# that adapts up to max_rate (None for no limit). Without a rate, requests
+# are sent as fast as they come.
+def make_session(auth=None, headers=None, verify=True, pool_size=10, retries=3, timeout=60, retry_statuses=RETRY_STATUSES,
+                 rate=None, max_rate=None, rate_retries=5):
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=retry_statuses,
+        raise_on_status=False
+    )
+    limiter = RateLimiter(rate, max_rate) if rate else None
+    adapter = TimeoutHTTPAdapter(
+        timeout=timeout,
+        limiter=limiter,
+        rate_retries=rate_retries,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.limiter = limiter
+    session.auth = auth
+    session.verify = verify
+    if headers:
+        session.headers.update(headers)
+    return session
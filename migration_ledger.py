@@ -0,0 +1,211 @@
+import json
+import sqlite3
+import threading
+import time
+
+# The work ledger of a sharded migration: the shards of the JQL, the worker
+# that has each of them and how far it got. Workers on several machines share
+# it through a volume they all mount, so it doesn't use WAL (which needs shared
+# memory between the processes) but a rollback journal, and every claim is a
+# BEGIN IMMEDIATE transaction: the file lock makes sure two workers never get
+# the same shard.
+#
+# shards  - JQL of each shard, pending, claimed, done or failed. A claimed
+#           shard whose worker stopped sending heartbeats is pending again.
+# workers - last heartbeat of every worker and the counters of its run
+# epics   - epics being created, by group and Jira key (or title), so that
+#           only one worker creates each
+# meta    - run wide values, like the JQL the shards were made from
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    jql TEXT NOT NULL,
+    label TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    heartbeat REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    issues INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL,
+    items TEXT
+);
+CREATE TABLE IF NOT EXISTS epics (
+    group_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    claimed REAL NOT NULL,
+    epic_iid INTEGER,
+    PRIMARY KEY (group_id, name)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+# lease is the time (seconds) without a heartbeat after which a worker is
+# taken for dead. A shard is tried at most attempts times.
+class ShardLedger(object):
+    def __init__(self, path, lease=300, attempts=3):
+        self.lease = lease
+        self.attempts = attempts
+        self.lock = threading.Lock()
+        # Transactions are begun explicitly, waiting up to a minute for the
+        # other workers to release the file
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=DELETE')
+        self.db.executescript(SCHEMA)
+
+    # Run function(db) in a write transaction, committed if it returns
+    def transaction(self, function):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(self.db)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, params).fetchall()]
+
+    # Add the shards of a run, (label, jql) pairs. A ledger holds one run.
+    def plan(self, shards, meta):
+        def add(db):
+            if db.execute('SELECT 1 FROM shards LIMIT 1').fetchone():
+                return False
+            db.executemany('INSERT INTO shards (label, jql) VALUES (?, ?)', shards)
+            db.executemany('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+                           [(name, json.dumps(value)) for name, value in meta.items()])
+            return True
+        return self.transaction(add)
+
+    def get_meta(self, name, default=None):
+        rows = self.query('SELECT value FROM meta WHERE name = ?', (name,))
+        return json.loads(rows[0]['value']) if rows else default
+
+    # Hand the next shard to worker, or None when no shard is left to claim.
+    # Shards of dead workers are released first.
+    def claim(self, worker):
+        def claim_next(db):
+            now = time.time()
+            db.execute(
+                "UPDATE shards SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                "error = 'worker ' || worker || ' stopped sending heartbeats' "
+                "WHERE status = 'claimed' AND heartbeat < ?",
+                (self.attempts, now - self.lease)
+            )
+            row = db.execute(
+                "SELECT * FROM shards WHERE status = 'pending' ORDER BY attempts, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE shards SET status = 'claimed', worker = ?, heartbeat = ?, started = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (worker, now, now, row['id'])
+            )
+            return dict(row, worker=worker, attempts=row['attempts'] + 1)
+        return self.transaction(claim_next)
+
+    # Record that worker is alive, its counters and the issues done in its
+    # shard. Returns False if the shard was given to another worker meanwhile.
+    def heartbeat(self, worker, shard_id=None, issues=0, items=None):
+        def beat(db):
+            now = time.time()
+            db.execute('INSERT OR REPLACE INTO workers (name, heartbeat, items) VALUES (?, ?, ?)',
+                       (worker, now, json.dumps(items or {})))
+            if shard_id is None:
+                return True
+            return db.execute(
+                "UPDATE shards SET heartbeat = ?, issues = ? WHERE id = ? AND worker = ? AND status = 'claimed'",
+                (now, issues, shard_id, worker)
+            ).rowcount == 1
+        return self.transaction(beat)
+
+    # Returns the number of shards not done yet
+    def finish(self, shard_id, worker, issues):
+        def done(db):
+            db.execute(
+                "UPDATE shards SET status = 'done', issues = ?, finished = ?, error = NULL "
+                "WHERE id = ? AND worker = ? AND status = 'claimed'",
+                (issues, time.time(), shard_id, worker)
+            )
+            return db.execute("SELECT COUNT(*) FROM shards WHERE status != 'done'").fetchone()[0]
+        return self.transaction(done)
+
+    # A failed shard is tried again, by any worker, until it runs out of attempts
+    def fail(self, shard_id, worker, error):
+        self.transaction(lambda db: db.execute(
+            "UPDATE shards SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, error = ? "
+            "WHERE id = ? AND worker = ? AND status = 'claimed'",
+            (self.attempts, error, shard_id, worker)
+        ))
+
+    def live_workers(self):
+        return self.query('SELECT COUNT(*) AS count FROM workers WHERE heartbeat >= ?',
+                          (time.time() - self.lease,))[0]['count']
+
+    # Make sure one worker creates an epic. Returns the iid of the epic once a
+    # worker created it, or None if the caller is to create it and call
+    # epic_created. Waits while another live worker is creating it.
+    def claim_epic(self, group_id, name, worker):
+        def claim(db):
+            now = time.time()
+            row = db.execute('SELECT * FROM epics WHERE group_id = ? AND name = ?', (group_id, name)).fetchone()
+            if row is not None and (row['epic_iid'] is not None or row['claimed'] >= now - self.lease):
+                return row['epic_iid'], row['worker']
+            db.execute('INSERT OR REPLACE INTO epics (group_id, name, worker, claimed) VALUES (?, ?, ?, ?)',
+                       (group_id, name, worker, now))
+            return None, worker
+        while True:
+            epic_iid, owner = self.transaction(claim)
+            if epic_iid is not None or owner == worker:
+                return epic_iid
+            time.sleep(1)
+
+    def epic_created(self, group_id, name, epic_iid):
+        self.transaction(lambda db: db.execute(
+            'UPDATE epics SET epic_iid = ? WHERE group_id = ? AND name = ?', (epic_iid, group_id, name)
+        ))
+
+    # The creation failed, let the next worker try
+    def release_epic(self, group_id, name, worker):
+        self.transaction(lambda db: db.execute(
+            'DELETE FROM epics WHERE group_id = ? AND name = ? AND worker = ? AND epic_iid IS NULL',
+            (group_id, name, worker)
+        ))
+
+    # Progress of the run: shards per status, issues done, the live workers
+    # and the sum of their counters
+    def status(self):
+        now = time.time()
+        shards = self.query('SELECT * FROM shards ORDER BY id')
+        workers = self.query('SELECT * FROM workers ORDER BY name')
+        items = {}
+        for worker in workers:
+            worker['items'] = json.loads(worker['items'] or '{}')
+            worker['alive'] = worker['heartbeat'] >= now - self.lease
+            for item, count in worker['items'].items():
+                items[item] = items.get(item, 0) + count
+        statuses = {}
+        for shard in shards:
+            statuses[shard['status']] = statuses.get(shard['status'], 0) + 1
+        return {
+            'shards': shards,
+            'statuses': statuses,
+            'issues': sum(shard['issues'] for shard in shards),
+            'workers': workers,
+            'items': items
+        }
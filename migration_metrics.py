@@ -0,0 +1,292 @@
+import inspect
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from urllib3.util.retry import Retry
+
+# Run metrics for the migration scripts: time spent per phase, requests per
+# endpoint and status, request latency histograms, bytes transferred and time
+# spent waiting on rate limits and retries. They are written as a JSON summary
+# and as a Prometheus textfile (for the node_exporter textfile collector).
+#
+# Phase times are summed over all the threads doing that phase, so with
+# several workers they can add up to more than the run time.
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Path segments holding ids, keys or file names are folded into one endpoint.
+# The API version after /api is kept.
+ID_SEGMENT = re.compile(r'(?<!/api)/[^/]*\d[^/]*')
+ATTACHMENT_PATH = re.compile(r'/secure/attachment/.*')
+
+
+# /rest/api/2/issue/PRO-12/comment -> /rest/api/2/issue/:id/comment
+def endpoint_name(method, url):
+    path = ATTACHMENT_PATH.sub('/secure/attachment/:id/:name', urlsplit(url).path)
+    return '%s %s' % (method, ID_SEGMENT.sub('/:id', path))
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    # Cumulative counts per upper bound, the last one being +Inf
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99)
+        }
+
+
+def prometheus_labels(labels):
+    return ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+
+
+# The metrics of one run. Safe to use from any thread.
+class Metrics(object):
+    def __init__(self, script, json_file=None, prom_file=None, interval=0):
+        self.script = script
+        self.json_file = json_file
+        self.prom_file = prom_file
+        self.interval = interval
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.phases = defaultdict(lambda: [0, 0.0])  # phase -> [calls, seconds]
+        self.items = Counter()  # e.g. issues created, notes created
+        self.requests = Counter()  # (remote, endpoint, status) -> requests
+        self.latency = defaultdict(Histogram)  # (remote, endpoint) -> histogram
+        self.bytes_sent = Counter()  # remote -> bytes
+        self.bytes_received = Counter()  # remote -> bytes
+        self.rate_limited = Counter()  # remote -> 429 responses
+        self.waits = defaultdict(lambda: [0, 0.0])  # (remote, reason) -> [waits, seconds]
+        self.limiters = {}  # remote -> RateLimiter of its session
+        self.stopped = threading.Event()
+        self.reporter = None
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                phase = self.phases[name]
+                phase[0] += 1
+                phase[1] += elapsed
+
+    def count(self, item, amount=1):
+        with self.lock:
+            self.items[item] += amount
+
+    # Time spent sleeping before a request, because of a rate limit or before
+    # a retry
+    def wait(self, remote, reason, seconds):
+        with self.lock:
+            wait = self.waits[(remote, reason)]
+            wait[0] += 1
+            wait[1] += seconds
+
+    # Record every response of a session, and the retries its adapters make
+    def instrument(self, session, remote):
+        metrics = self
+
+        def record_response(response, *args, **kwargs):
+            request = response.request
+            endpoint = endpoint_name(request.method, request.url)
+            sent = int(request.headers.get('Content-Length') or 0)
+            # Streamed responses aren't read yet, so count what they announce
+            received = int(response.headers.get('Content-Length') or 0)
+            with metrics.lock:
+                metrics.requests[(remote, endpoint, response.status_code)] += 1
+                metrics.latency[(remote, endpoint)].observe(response.elapsed.total_seconds())
+                metrics.bytes_sent[remote] += sent
+                metrics.bytes_received[remote] += received
+                if response.status_code == 429:
+                    metrics.rate_limited[remote] += 1
+        session.hooks['response'].append(record_response)
+
+        limiter = getattr(session, 'limiter', None)
+        if limiter is not None:
+            self.limiters[remote] = limiter
+            limiter.observer = lambda reason, seconds: metrics.wait(remote, reason, seconds)
+
+        for adapter in set(session.adapters.values()):
+            retry = adapter.max_retries
+            if type(retry) is Retry:
+                metered = type('MeteredRetry', (MeteredRetry,), {'metrics': self, 'remote': remote})
+                adapter.max_retries = metered(**retry_params(retry))
+        return session
+
+    def start(self):
+        if self.interval and (self.json_file or self.prom_file):
+            self.reporter = threading.Thread(target=self.report, daemon=True)
+            self.reporter.start()
+        return self
+
+    def report(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self.stopped.set()
+        if self.reporter:
+            self.reporter.join()
+        self.write()
+
+    def summary(self):
+        with self.lock:
+            requests = defaultdict(dict)
+            for (remote, endpoint, status), count in sorted(self.requests.items()):
+                entry = requests[remote].setdefault(endpoint, {'count': 0, 'statuses': {}})
+                entry['count'] += count
+                entry['statuses'][str(status)] = count
+            for (remote, endpoint), histogram in self.latency.items():
+                requests[remote][endpoint]['latency'] = histogram.summary()
+            return {
+                'script': self.script,
+                'started': self.started,
+                'elapsed': round(time.time() - self.started, 3),
+                'finished': self.stopped.is_set(),
+                'phases': dict(
+                    (name, {'calls': calls, 'seconds': round(seconds, 6)})
+                    for name, (calls, seconds) in sorted(self.phases.items())
+                ),
+                'items': dict(self.items),
+                'requests': dict(requests),
+                'bytes_sent': dict(self.bytes_sent),
+                'bytes_received': dict(self.bytes_received),
+                'rate_limited': dict(self.rate_limited),
+                'rates': dict((remote, round(limiter.rate, 3)) for remote, limiter in self.limiters.items()),
+                'waits': dict(
+                    ('%s %s' % key, {'count': count, 'seconds': round(seconds, 6)})
+                    for key, (count, seconds) in sorted(self.waits.items())
+                )
+            }
+
+    def prometheus(self):
+        script = ('script', self.script)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s%s{%s} %s' % (name, suffix, prometheus_labels((script,) + tuple(labels)), repr(float(value))))
+
+        with self.lock:
+            metric('migration_run_seconds', 'gauge', 'Time since the run started.',
+                   [('', (), time.time() - self.started)])
+            metric('migration_phase_seconds_total', 'counter', 'Time spent per phase, summed over threads.',
+                   [('', (('phase', name),), seconds) for name, (calls, seconds) in sorted(self.phases.items())])
+            metric('migration_phase_calls_total', 'counter', 'Number of times each phase ran.',
+                   [('', (('phase', name),), calls) for name, (calls, seconds) in sorted(self.phases.items())])
+            metric('migration_items_total', 'counter', 'Items processed, by kind.',
+                   [('', (('item', name),), count) for name, count in sorted(self.items.items())])
+            metric('migration_http_requests_total', 'counter', 'HTTP responses by endpoint and status.',
+                   [('', (('remote', remote), ('endpoint', endpoint), ('status', status)), count)
+                    for (remote, endpoint, status), count in sorted(self.requests.items())])
+            samples = []
+            for (remote, endpoint), histogram in sorted(self.latency.items()):
+                labels = (('remote', remote), ('endpoint', endpoint))
+                for bound, total in histogram.cumulative():
+                    samples.append(('_bucket', labels + (('le', '+Inf' if bound == float('inf') else repr(bound)),), total))
+                samples.append(('_sum', labels, histogram.sum))
+                samples.append(('_count', labels, histogram.count))
+            metric('migration_http_request_duration_seconds', 'histogram', 'HTTP request latency.', samples)
+            metric('migration_http_sent_bytes_total', 'counter', 'Request body bytes sent.',
+                   [('', (('remote', remote),), count) for remote, count in sorted(self.bytes_sent.items())])
+            metric('migration_http_received_bytes_total', 'counter', 'Response body bytes received.',
+                   [('', (('remote', remote),), count) for remote, count in sorted(self.bytes_received.items())])
+            metric('migration_http_rate_limited_total', 'counter', 'Responses with status 429.',
+                   [('', (('remote', remote),), count) for remote, count in sorted(self.rate_limited.items())])
+            metric('migration_http_rate', 'gauge', 'Requests per second currently allowed by the rate limiter.',
+                   [('', (('remote', remote),), limiter.rate) for remote, limiter in sorted(self.limiters.items())])
+            metric('migration_http_wait_seconds_total', 'counter', 'Time slept for rate limits and retries.',
+                   [('', (('remote', remote), ('reason', reason)), seconds)
+                    for (remote, reason), (count, seconds) in sorted(self.waits.items())])
+            metric('migration_http_waits_total', 'counter', 'Number of sleeps for rate limits and retries.',
+                   [('', (('remote', remote), ('reason', reason)), count)
+                    for (remote, reason), (count, seconds) in sorted(self.waits.items())])
+        return '\n'.join(lines) + '\n'
+
+    # Files are replaced atomically, so readers never see half of one
+    def write(self):
+        if self.json_file:
+            write_file(self.json_file, json.dumps(self.summary(), indent=2, sort_keys=True))
+        if self.prom_file:
+            write_file(self.prom_file, self.prometheus())
+
+
+def write_file(path, content):
+    with open(path + '.tmp', 'w') as output:
+        output.write(content)
+    os.replace(path + '.tmp', path)
+
+
+# The settings of a Retry, to rebuild it as a MeteredRetry
+def retry_params(retry):
+    return dict(
+        (name, getattr(retry, name)) for name in inspect.signature(Retry.__init__).parameters
+        if name != 'self' and hasattr(retry, name)
+    )
+
+
+# urllib3 retries happen inside the adapter, out of sight of the response
+# hooks. This records the sleeps between them; metrics and remote are set on
+# a subclass made per session, which Retry.new() carries over.
+class MeteredRetry(Retry):
+    metrics = None
+    remote = None
+
+    def sleep(self, response=None):
+        started = time.time()
+        super(MeteredRetry, self).sleep(response)
+        if self.metrics:
+            if response is not None and response.status == 429:
+                reason = 'rate_limit'
+            elif response is not None:
+                reason = 'retry_status'
+            else:
+                reason = 'retry_error'
+            self.metrics.wait(self.remote, reason, time.time() - started)
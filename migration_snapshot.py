@@ -0,0 +1,46 @@
+import gzip
+import json
+import os
+from collections import Counter
+
+# Snapshots of the data extracted from a source system, so it can be loaded
+# (and loaded again) without calling the source. A snapshot is gzipped NDJSON,
+# one {"type": ..., "record": ...} object per line, from a header to a
+# trailer that counts the records. It is written to a temporary file and
+# renamed once complete, so an existing snapshot was written to the end. It
+# is read back one line at a time, memory use doesn't depend on its size.
+
+
+class SnapshotWriter(object):
+    def __init__(self, path, header):
+        self.path = path
+        self.file = gzip.open(path + '.tmp', 'wt', encoding='utf-8')
+        self.counts = Counter()
+        self.write('header', header)
+
+    def write(self, kind, record):
+        self.file.write(json.dumps({'type': kind, 'record': record}) + '\n')
+        self.counts[kind] += 1
+
+    def close(self, trailer=None):
+        trailer = dict(trailer or {})
+        trailer['counts'] = dict(self.counts)
+        self.write('trailer', trailer)
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+
+# Yield the (type, record) pairs of a snapshot, header and trailer included
+def read_snapshot(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as snapshot:
+        for line in snapshot:
+            entry = json.loads(line)
+            yield entry['type'], entry['record']
+
+
+def read_header(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as snapshot:
+        entry = json.loads(snapshot.readline())
+    if entry['type'] != 'header':
+        raise ValueError('%s is not a snapshot' % path)
+    return entry['record']
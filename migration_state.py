@@ -0,0 +1,136 @@
+import json
+import sqlite3
+import threading
+
+# Migration progress, stored in SQLite so that a re-run can skip finished
+# issues with an indexed lookup and pick up half migrated ones at the step
+# where they stopped, instead of creating them again.
+#
+# issues   - one row per (Jira key, Gitlab project) with the Gitlab issue that
+#            was created for it and the steps done after creation
+# notes    - the Jira comments already copied to that Gitlab issue
+# migrated - Jira keys that are completely migrated to every project
+# meta     - run wide values, like the watermark of the last delta sync
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS issues (
+    jira_key TEXT NOT NULL,
+    project_id INTEGER NOT NULL,
+    gl_issue_id INTEGER NOT NULL,
+    gl_issue_iid INTEGER NOT NULL,
+    notes_total INTEGER NOT NULL DEFAULT 0,
+    epic_linked INTEGER NOT NULL DEFAULT 0,
+    closed INTEGER NOT NULL DEFAULT 0,
+    labels TEXT,
+    PRIMARY KEY (jira_key, project_id)
+);
+CREATE TABLE IF NOT EXISTS notes (
+    jira_key TEXT NOT NULL,
+    project_id INTEGER NOT NULL,
+    comment_id TEXT NOT NULL,
+    note_id INTEGER NOT NULL,
+    PRIMARY KEY (jira_key, project_id, comment_id)
+);
+CREATE TABLE IF NOT EXISTS migrated (
+    jira_key TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+# The connection is shared by all worker threads, access is serialized with a
+# lock. Every checkpoint is committed right away; with WAL that is cheap.
+# A shared state, used by processes on several machines through a shared
+# volume, can't use WAL and waits longer for the file lock.
+class MigrationState(object):
+    def __init__(self, path, shared=False):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60 if shared else 5, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=%s' % ('DELETE' if shared else 'WAL'))
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        # state files written before the labels were tracked
+        columns = [row['name'] for row in self.db.execute('PRAGMA table_info(issues)')]
+        if 'labels' not in columns:
+            self.db.execute('ALTER TABLE issues ADD COLUMN labels TEXT')
+
+    def execute(self, sql, params=()):
+        with self.lock, self.db:
+            return self.db.execute(sql, params).fetchall()
+
+    def is_migrated(self, jira_key):
+        return bool(self.execute('SELECT 1 FROM migrated WHERE jira_key = ?', (jira_key,)))
+
+    def mark_migrated(self, jira_key):
+        self.execute('INSERT OR IGNORE INTO migrated (jira_key) VALUES (?)', (jira_key,))
+
+    # Keys recorded by the old plain text tracking file
+    def import_migrated(self, jira_keys):
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO migrated (jira_key) VALUES (?)',
+                ((key,) for key in jira_keys if key)
+            )
+
+    # The checkpoint of an issue in a project, or None if it wasn't created yet
+    def get_issue(self, jira_key, project_id):
+        rows = self.execute(
+            'SELECT * FROM issues WHERE jira_key = ? AND project_id = ?',
+            (jira_key, project_id)
+        )
+        if not rows:
+            return None
+        issue = dict(rows[0])
+        issue['labels'] = json.loads(issue['labels']) if issue['labels'] else []
+        return issue
+
+    # labels are the ones set from Jira, so a later sync can tell them apart
+    # from labels added in Gitlab
+    def issue_created(self, jira_key, project_id, gl_issue_id, gl_issue_iid, notes_total, labels=()):
+        self.execute(
+            'INSERT INTO issues (jira_key, project_id, gl_issue_id, gl_issue_iid, notes_total, labels) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (jira_key, project_id, gl_issue_id, gl_issue_iid, notes_total, json.dumps(list(labels)))
+        )
+
+    def migrated_comments(self, jira_key, project_id):
+        rows = self.execute(
+            'SELECT comment_id FROM notes WHERE jira_key = ? AND project_id = ?',
+            (jira_key, project_id)
+        )
+        return set(row['comment_id'] for row in rows)
+
+    def note_created(self, jira_key, project_id, comment_id, note_id):
+        self.execute(
+            'INSERT OR REPLACE INTO notes (jira_key, project_id, comment_id, note_id) VALUES (?, ?, ?, ?)',
+            (jira_key, project_id, str(comment_id), note_id)
+        )
+
+    def epic_linked(self, jira_key, project_id):
+        self.execute(
+            'UPDATE issues SET epic_linked = 1 WHERE jira_key = ? AND project_id = ?',
+            (jira_key, project_id)
+        )
+
+    def issue_closed(self, jira_key, project_id):
+        self.execute(
+            'UPDATE issues SET closed = 1 WHERE jira_key = ? AND project_id = ?',
+            (jira_key, project_id)
+        )
+
+    # After a delta sync of the issue
+    def issue_synced(self, jira_key, project_id, labels, closed):
+        self.execute(
+            'UPDATE issues SET labels = ?, closed = ? WHERE jira_key = ? AND project_id = ?',
+            (json.dumps(list(labels)), int(closed), jira_key, project_id)
+        )
+
+    def get_meta(self, name, default=None):
+        rows = self.execute('SELECT value FROM meta WHERE name = ?', (name,))
+        return rows[0]['value'] if rows else default
+
+    def set_meta(self, name, value):
+        self.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))